@@ -2,10 +2,152 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+
+class FreqEncoder_torch(nn.Module):
+    def __init__(self, input_dim=3, degree=4):
+        super().__init__()
+
+        self.input_dim = input_dim
+        self.degree = degree
+        self.output_dim = input_dim + input_dim * 2 * degree
+
+        # [degree], 2^0 ... 2^(degree-1), same frequencies as the CUDA kernel
+        self.register_buffer('freq_bands', 2.0 ** torch.arange(degree, dtype=torch.float32), persistent=False)
+
+    def __repr__(self):
+        return f"FreqEncoder_torch(input_dim={self.input_dim}, degree={self.degree}, output_dim={self.output_dim})"
+
+    def forward(self, inputs, **kwargs):
+        # inputs: [..., input_dim]
+        # return: [..., output_dim], laid out as [x, sin(x), cos(x), sin(2x), cos(2x), ...] like freqencoder
+
+        xb = inputs.unsqueeze(-2) * self.freq_bands.unsqueeze(-1) # [..., degree, input_dim]
+        feats = torch.stack([torch.sin(xb), torch.cos(xb)], dim=-2) # [..., degree, 2, input_dim]
+        feats = feats.flatten(-3)
+
+        return torch.cat([inputs, feats], dim=-1)
+
+
+def sh_encode_torch(inputs, degree):
+    # inputs: [..., 3], float in [-1, 1]
+    # return: [..., degree^2], same polynomials as shencoder/src/shencoder.cu
+
+    C = degree
+    x, y, z = inputs.unbind(-1)
+
+    xy=x*y; xz=x*z; yz=y*z; x2=x*x; y2=y*y; z2=z*z
+    x4=x2*x2; y4=y2*y2; z4=z2*z2
+    x6=x4*x2; y6=y4*y2; z6=z4*z2
+
+    outputs = []
+    outputs.append(torch.full_like(x, 0.28209479177387814)) # 1/(2*sqrt(pi))
+    if C <= 1:
+        return torch.stack(outputs, dim=-1)
+    outputs.append(-0.48860251190291987*y) # -sqrt(3)*y/(2*sqrt(pi))
+    outputs.append(0.48860251190291987*z) # sqrt(3)*z/(2*sqrt(pi))
+    outputs.append(-0.48860251190291987*x) # -sqrt(3)*x/(2*sqrt(pi))
+    if C <= 2:
+        return torch.stack(outputs, dim=-1)
+    outputs.append(1.0925484305920792*xy) # sqrt(15)*xy/(2*sqrt(pi))
+    outputs.append(-1.0925484305920792*yz) # -sqrt(15)*yz/(2*sqrt(pi))
+    outputs.append(0.94617469575755997*z2 - 0.31539156525251999) # sqrt(5)*(3*z2 - 1)/(4*sqrt(pi))
+    outputs.append(-1.0925484305920792*xz) # -sqrt(15)*xz/(2*sqrt(pi))
+    outputs.append(0.54627421529603959*x2 - 0.54627421529603959*y2) # sqrt(15)*(x2 - y2)/(4*sqrt(pi))
+    if C <= 3:
+        return torch.stack(outputs, dim=-1)
+    outputs.append(0.59004358992664352*y*(-3.0*x2 + y2)) # sqrt(70)*y*(-3*x2 + y2)/(8*sqrt(pi))
+    outputs.append(2.8906114426405538*xy*z) # sqrt(105)*xy*z/(2*sqrt(pi))
+    outputs.append(0.45704579946446572*y*(1.0 - 5.0*z2)) # sqrt(42)*y*(1 - 5*z2)/(8*sqrt(pi))
+    outputs.append(0.3731763325901154*z*(5.0*z2 - 3.0)) # sqrt(7)*z*(5*z2 - 3)/(4*sqrt(pi))
+    outputs.append(0.45704579946446572*x*(1.0 - 5.0*z2)) # sqrt(42)*x*(1 - 5*z2)/(8*sqrt(pi))
+    outputs.append(1.4453057213202769*z*(x2 - y2)) # sqrt(105)*z*(x2 - y2)/(4*sqrt(pi))
+    outputs.append(0.59004358992664352*x*(-x2 + 3.0*y2)) # sqrt(70)*x*(-x2 + 3*y2)/(8*sqrt(pi))
+    if C <= 4:
+        return torch.stack(outputs, dim=-1)
+    outputs.append(2.5033429417967046*xy*(x2 - y2)) # 3*sqrt(35)*xy*(x2 - y2)/(4*sqrt(pi))
+    outputs.append(1.7701307697799304*yz*(-3.0*x2 + y2)) # 3*sqrt(70)*yz*(-3*x2 + y2)/(8*sqrt(pi))
+    outputs.append(0.94617469575756008*xy*(7.0*z2 - 1.0)) # 3*sqrt(5)*xy*(7*z2 - 1)/(4*sqrt(pi))
+    outputs.append(0.66904654355728921*yz*(3.0 - 7.0*z2)) # 3*sqrt(10)*yz*(3 - 7*z2)/(8*sqrt(pi))
+    outputs.append(-3.1735664074561294*z2 + 3.7024941420321507*z4 + 0.31735664074561293) # 3*(-30*z2 + 35*z4 + 3)/(16*sqrt(pi))
+    outputs.append(0.66904654355728921*xz*(3.0 - 7.0*z2)) # 3*sqrt(10)*xz*(3 - 7*z2)/(8*sqrt(pi))
+    outputs.append(0.47308734787878004*(x2 - y2)*(7.0*z2 - 1.0)) # 3*sqrt(5)*(x2 - y2)*(7*z2 - 1)/(8*sqrt(pi))
+    outputs.append(1.7701307697799304*xz*(-x2 + 3.0*y2)) # 3*sqrt(70)*xz*(-x2 + 3*y2)/(8*sqrt(pi))
+    outputs.append(-3.7550144126950569*x2*y2 + 0.62583573544917614*x4 + 0.62583573544917614*y4) # 3*sqrt(35)*(-6*x2*y2 + x4 + y4)/(16*sqrt(pi))
+    if C <= 5:
+        return torch.stack(outputs, dim=-1)
+    outputs.append(0.65638205684017015*y*(10.0*x2*y2 - 5.0*x4 - y4)) # 3*sqrt(154)*y*(10*x2*y2 - 5*x4 - y4)/(32*sqrt(pi))
+    outputs.append(8.3026492595241645*xy*z*(x2 - y2)) # 3*sqrt(385)*xy*z*(x2 - y2)/(4*sqrt(pi))
+    outputs.append(-0.48923829943525038*y*(3.0*x2 - y2)*(9.0*z2 - 1.0)) # -sqrt(770)*y*(3*x2 - y2)*(9*z2 - 1)/(32*sqrt(pi))
+    outputs.append(4.7935367849733241*xy*z*(3.0*z2 - 1.0)) # sqrt(1155)*xy*z*(3*z2 - 1)/(4*sqrt(pi))
+    outputs.append(0.45294665119569694*y*(14.0*z2 - 21.0*z4 - 1.0)) # sqrt(165)*y*(14*z2 - 21*z4 - 1)/(16*sqrt(pi))
+    outputs.append(0.1169503224534236*z*(-70.0*z2 + 63.0*z4 + 15.0)) # sqrt(11)*z*(-70*z2 + 63*z4 + 15)/(16*sqrt(pi))
+    outputs.append(0.45294665119569694*x*(14.0*z2 - 21.0*z4 - 1.0)) # sqrt(165)*x*(14*z2 - 21*z4 - 1)/(16*sqrt(pi))
+    outputs.append(2.3967683924866621*z*(x2 - y2)*(3.0*z2 - 1.0)) # sqrt(1155)*z*(x2 - y2)*(3*z2 - 1)/(8*sqrt(pi))
+    outputs.append(-0.48923829943525038*x*(x2 - 3.0*y2)*(9.0*z2 - 1.0)) # -sqrt(770)*x*(x2 - 3*y2)*(9*z2 - 1)/(32*sqrt(pi))
+    outputs.append(2.0756623148810411*z*(-6.0*x2*y2 + x4 + y4)) # 3*sqrt(385)*z*(-6*x2*y2 + x4 + y4)/(16*sqrt(pi))
+    outputs.append(0.65638205684017015*x*(10.0*x2*y2 - x4 - 5.0*y4)) # 3*sqrt(154)*x*(10*x2*y2 - x4 - 5*y4)/(32*sqrt(pi))
+    if C <= 6:
+        return torch.stack(outputs, dim=-1)
+    outputs.append(1.3663682103838286*xy*(-10.0*x2*y2 + 3.0*x4 + 3.0*y4)) # sqrt(6006)*xy*(-10*x2*y2 + 3*x4 + 3*y4)/(32*sqrt(pi))
+    outputs.append(2.3666191622317521*yz*(10.0*x2*y2 - 5.0*x4 - y4)) # 3*sqrt(2002)*yz*(10*x2*y2 - 5*x4 - y4)/(32*sqrt(pi))
+    outputs.append(2.0182596029148963*xy*(x2 - y2)*(11.0*z2 - 1.0)) # 3*sqrt(91)*xy*(x2 - y2)*(11*z2 - 1)/(8*sqrt(pi))
+    outputs.append(-0.92120525951492349*yz*(3.0*x2 - y2)*(11.0*z2 - 3.0)) # -sqrt(2730)*yz*(3*x2 - y2)*(11*z2 - 3)/(32*sqrt(pi))
+    outputs.append(0.92120525951492349*xy*(-18.0*z2 + 33.0*z4 + 1.0)) # sqrt(2730)*xy*(-18*z2 + 33*z4 + 1)/(32*sqrt(pi))
+    outputs.append(0.58262136251873131*yz*(30.0*z2 - 33.0*z4 - 5.0)) # sqrt(273)*yz*(30*z2 - 33*z4 - 5)/(16*sqrt(pi))
+    outputs.append(6.6747662381009842*z2 - 20.024298714302954*z4 + 14.684485723822165*z6 - 0.31784601133814211) # sqrt(13)*(105*z2 - 315*z4 + 231*z6 - 5)/(32*sqrt(pi))
+    outputs.append(0.58262136251873131*xz*(30.0*z2 - 33.0*z4 - 5.0)) # sqrt(273)*xz*(30*z2 - 33*z4 - 5)/(16*sqrt(pi))
+    outputs.append(0.46060262975746175*(x2 - y2)*(11.0*z2*(3.0*z2 - 1.0) - 7.0*z2 + 1.0)) # sqrt(2730)*(x2 - y2)*(11*z2*(3*z2 - 1) - 7*z2 + 1)/(64*sqrt(pi))
+    outputs.append(-0.92120525951492349*xz*(x2 - 3.0*y2)*(11.0*z2 - 3.0)) # -sqrt(2730)*xz*(x2 - 3*y2)*(11*z2 - 3)/(32*sqrt(pi))
+    outputs.append(0.50456490072872406*(11.0*z2 - 1.0)*(-6.0*x2*y2 + x4 + y4)) # 3*sqrt(91)*(11*z2 - 1)*(-6*x2*y2 + x4 + y4)/(32*sqrt(pi))
+    outputs.append(2.3666191622317521*xz*(10.0*x2*y2 - x4 - 5.0*y4)) # 3*sqrt(2002)*xz*(10*x2*y2 - x4 - 5*y4)/(32*sqrt(pi))
+    outputs.append(10.247761577878714*x2*y4 - 10.247761577878714*x4*y2 + 0.6831841051919143*x6 - 0.6831841051919143*y6) # sqrt(6006)*(15*x2*y4 - 15*x4*y2 + x6 - y6)/(64*sqrt(pi))
+    if C <= 7:
+        return torch.stack(outputs, dim=-1)
+    outputs.append(0.70716273252459627*y*(-21.0*x2*y4 + 35.0*x4*y2 - 7.0*x6 + y6)) # 3*sqrt(715)*y*(-21*x2*y4 + 35*x4*y2 - 7*x6 + y6)/(64*sqrt(pi))
+    outputs.append(5.2919213236038001*xy*z*(-10.0*x2*y2 + 3.0*x4 + 3.0*y4)) # 3*sqrt(10010)*xy*z*(-10*x2*y2 + 3*x4 + 3*y4)/(32*sqrt(pi))
+    outputs.append(-0.51891557872026028*y*(13.0*z2 - 1.0)*(-10.0*x2*y2 + 5.0*x4 + y4)) # -3*sqrt(385)*y*(13*z2 - 1)*(-10*x2*y2 + 5*x4 + y4)/(64*sqrt(pi))
+    outputs.append(4.1513246297620823*xy*z*(x2 - y2)*(13.0*z2 - 3.0)) # 3*sqrt(385)*xy*z*(x2 - y2)*(13*z2 - 3)/(8*sqrt(pi))
+    outputs.append(-0.15645893386229404*y*(3.0*x2 - y2)*(13.0*z2*(11.0*z2 - 3.0) - 27.0*z2 + 3.0)) # -3*sqrt(35)*y*(3*x2 - y2)*(13*z2*(11*z2 - 3) - 27*z2 + 3)/(64*sqrt(pi))
+    outputs.append(0.44253269244498261*xy*z*(-110.0*z2 + 143.0*z4 + 15.0)) # 3*sqrt(70)*xy*z*(-110*z2 + 143*z4 + 15)/(32*sqrt(pi))
+    outputs.append(0.090331607582517306*y*(-135.0*z2 + 495.0*z4 - 429.0*z6 + 5.0)) # sqrt(105)*y*(-135*z2 + 495*z4 - 429*z6 + 5)/(64*sqrt(pi))
+    outputs.append(0.068284276912004949*z*(315.0*z2 - 693.0*z4 + 429.0*z6 - 35.0)) # sqrt(15)*z*(315*z2 - 693*z4 + 429*z6 - 35)/(32*sqrt(pi))
+    outputs.append(0.090331607582517306*x*(-135.0*z2 + 495.0*z4 - 429.0*z6 + 5.0)) # sqrt(105)*x*(-135*z2 + 495*z4 - 429*z6 + 5)/(64*sqrt(pi))
+    outputs.append(0.07375544874083044*z*(x2 - y2)*(143.0*z2*(3.0*z2 - 1.0) - 187.0*z2 + 45.0)) # sqrt(70)*z*(x2 - y2)*(143*z2*(3*z2 - 1) - 187*z2 + 45)/(64*sqrt(pi))
+    outputs.append(-0.15645893386229404*x*(x2 - 3.0*y2)*(13.0*z2*(11.0*z2 - 3.0) - 27.0*z2 + 3.0)) # -3*sqrt(35)*x*(x2 - 3*y2)*(13*z2*(11*z2 - 3) - 27*z2 + 3)/(64*sqrt(pi))
+    outputs.append(1.0378311574405206*z*(13.0*z2 - 3.0)*(-6.0*x2*y2 + x4 + y4)) # 3*sqrt(385)*z*(13*z2 - 3)*(-6*x2*y2 + x4 + y4)/(32*sqrt(pi))
+    outputs.append(-0.51891557872026028*x*(13.0*z2 - 1.0)*(-10.0*x2*y2 + x4 + 5.0*y4)) # -3*sqrt(385)*x*(13*z2 - 1)*(-10*x2*y2 + x4 + 5*y4)/(64*sqrt(pi))
+    outputs.append(2.6459606618019*z*(15.0*x2*y4 - 15.0*x4*y2 + x6 - y6)) # 3*sqrt(10010)*z*(15*x2*y4 - 15*x4*y2 + x6 - y6)/(64*sqrt(pi))
+    outputs.append(0.70716273252459627*x*(-35.0*x2*y4 + 21.0*x4*y2 - x6 + 7.0*y6)) # 3*sqrt(715)*x*(-35*x2*y4 + 21*x4*y2 - x6 + 7*y6)/(64*sqrt(pi))
+    return torch.stack(outputs, dim=-1)
+
+
+class SHEncoder_torch(nn.Module):
+    def __init__(self, input_dim=3, degree=4):
+        super().__init__()
+
+        self.input_dim = input_dim # coord dims, must be 3
+        self.degree = degree # 1 ~ 8
+        self.output_dim = degree ** 2
+
+        assert self.input_dim == 3, "SH encoder only support input dim == 3"
+        assert self.degree > 0 and self.degree <= 8, "SH encoder only supports degree in [1, 8]"
+
+    def __repr__(self):
+        return f"SHEncoder_torch: input_dim={self.input_dim} degree={self.degree}"
+
+    def forward(self, inputs, size=1):
+        # inputs: [..., input_dim], normalized real world positions in [-size, size]
+        # return: [..., degree^2]
+
+        inputs = inputs / size # [-1, 1]
+
+        return sh_encode_torch(inputs, self.degree)
+
+
 def get_encoder(encoding, input_dim=3, 
                 multires=6, 
                 degree=4,
-                num_levels=16, level_dim=2, base_resolution=16, log2_hashmap_size=19, desired_resolution=2048, align_corners=False,
+                num_levels=16, level_dim=2, base_resolution=16, log2_hashmap_size=19, desired_resolution=2048, align_corners=False, interpolation='linear', sparse_grad=False,
                 **kwargs):
 
     if encoding == 'None':
@@ -15,19 +157,25 @@ def get_encoder(encoding, input_dim=3,
         from freqencoder import FreqEncoder
         encoder = FreqEncoder(input_dim=input_dim, degree=multires)
 
+    elif encoding == 'frequency_torch':
+        encoder = FreqEncoder_torch(input_dim=input_dim, degree=multires)
+
     elif encoding == 'sphere_harmonics':
         from shencoder import SHEncoder
         encoder = SHEncoder(input_dim=input_dim, degree=degree)
 
+    elif encoding == 'sphere_harmonics_torch':
+        encoder = SHEncoder_torch(input_dim=input_dim, degree=degree)
+
     elif encoding == 'hashgrid':
         from gridencoder import GridEncoder
-        encoder = GridEncoder(input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='hash', align_corners=align_corners)
+        encoder = GridEncoder(input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='hash', align_corners=align_corners, interpolation=interpolation, sparse_grad=sparse_grad)
     
     elif encoding == 'tiledgrid':
         from gridencoder import GridEncoder
-        encoder = GridEncoder(input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='tiled', align_corners=align_corners)
+        encoder = GridEncoder(input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='tiled', align_corners=align_corners, interpolation=interpolation, sparse_grad=sparse_grad)
 
     else:
-        raise NotImplementedError('Unknown encoding mode, choose from [None, frequency, sphere_harmonics, hashgrid, tiledgrid]')
+        raise NotImplementedError('Unknown encoding mode, choose from [None, frequency, frequency_torch, sphere_harmonics, sphere_harmonics_torch, hashgrid, tiledgrid]')
 
     return encoder, encoder.output_dim
\ No newline at end of file
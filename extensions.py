@@ -0,0 +1,123 @@
+import os
+import hashlib
+
+import torch
+
+# registry of the native (CUDA) extensions
+# the extensions are only built or loaded on first use, prebuilt artifacts are reused from a versioned cache dir,
+# and every op records whether it ran on the extension or on its pytorch implementation.
+#
+# env vars:
+#   NEURALLIFT_EXT_CACHE: root of the build cache, default ~/.cache/neurallift/extensions
+#   NEURALLIFT_NO_EXT=1: never load extensions, always use the pytorch implementations
+
+_extensions = {} # name -> LazyExtension
+_selected = {} # op -> 'cuda' or 'torch'
+
+
+def cache_root():
+    root = os.environ.get('NEURALLIFT_EXT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'neurallift', 'extensions'))
+    # artifacts are only valid for the torch / CUDA version they were built against
+    cuda = torch.version.cuda.replace('.', '') if torch.version.cuda is not None else 'cpu'
+    return os.path.join(root, f'torch{torch.__version__.split("+")[0]}_cu{cuda}')
+
+
+def build_directory(name, sources, flags=()):
+    # content hash of sources and flags, so an edited kernel gets a fresh dir instead of a stale .so
+    h = hashlib.sha1()
+    for path in sources:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    h.update(' '.join(flags).encode())
+    path = os.path.join(cache_root(), f'{name}_{h.hexdigest()[:10]}')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class LazyExtension:
+    ''' stands in for the module returned by torch.utils.cpp_extension.load, which only runs on the first attribute access.
+    if the build fails (no CUDA, no nvcc, ...) the error is remembered and available() returns False.
+    '''
+    def __init__(self, name, sources, extra_cflags=None, extra_cuda_cflags=None, verbose=False):
+        self.name = name
+        self.sources = sources
+        self.extra_cflags = extra_cflags or []
+        self.extra_cuda_cflags = extra_cuda_cflags or []
+        self.verbose = verbose
+
+        self._module = None
+        self._error = None
+
+        _extensions[name] = self
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else ('unavailable' if self._error is not None else 'not loaded')
+        return f"LazyExtension: name={self.name}, {state}"
+
+    def load(self):
+        if self._module is not None or self._error is not None:
+            return self._module
+
+        if os.environ.get('NEURALLIFT_NO_EXT', '0') == '1':
+            self._error = 'disabled by NEURALLIFT_NO_EXT'
+            return None
+
+        from torch.utils.cpp_extension import load, CUDA_HOME
+        if not torch.cuda.is_available() or CUDA_HOME is None:
+            self._error = 'CUDA toolchain not found'
+            return None
+
+        try:
+            build_dir = build_directory(self.name, self.sources, self.extra_cflags + self.extra_cuda_cflags)
+            # load() only recompiles when the sources are newer than the artifacts in build_dir
+            self._module = load(name=self.name, sources=self.sources, extra_cflags=self.extra_cflags, extra_cuda_cflags=self.extra_cuda_cflags, build_directory=build_dir, verbose=self.verbose)
+            print(f'[INFO] loaded extension {self.name} from {build_dir}')
+        except Exception as e:
+            self._error = repr(e)
+            print(f'[WARN] extension {self.name} is unavailable, falling back to pytorch: {self._error}')
+
+        return self._module
+
+    def available(self):
+        return self.load() is not None
+
+    def __getattr__(self, attr):
+        # only called for attributes not found on the instance, i.e. the extension's ops
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        module = self.load()
+        if module is None:
+            raise RuntimeError(f'extension {self.name} is unavailable: {self._error}')
+        return getattr(module, attr)
+
+
+def use_native(op, backend, is_cuda=True):
+    ''' decide if op runs on the native extension, and record the choice.
+    Args:
+        op: str, name reported by backend_report()
+        backend: a prebuilt extension module, a LazyExtension, or None
+        is_cuda: bool, False if the op's inputs rule out the extension (CPU tensors, unsupported options)
+    Returns:
+        bool
+    '''
+    if not is_cuda or backend is None:
+        native = False
+    elif isinstance(backend, LazyExtension):
+        native = backend.available()
+    else:
+        native = True
+
+    choice = 'cuda' if native else 'torch'
+    if _selected.get(op) != choice:
+        _selected[op] = choice
+        print(f'[INFO] {op}: using {choice} backend')
+
+    return native
+
+
+def backend_report():
+    # {op: 'cuda' | 'torch'} for every op that ran so far, and the load state of each extension
+    return {
+        'ops': dict(_selected),
+        'extensions': {name: ext._error or ('loaded' if ext._module is not None else 'not loaded') for name, ext in _extensions.items()},
+    }
@@ -1,5 +1,6 @@
 import os
-from torch.utils.cpp_extension import load
+
+from extensions import LazyExtension
 
 _src_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -37,8 +38,8 @@ elif os.name == "nt":
             raise RuntimeError("Could not locate a supported Microsoft Visual C++ installation")
         os.environ["PATH"] += ";" + cl_path
 
-# Load the CUDA extension
-_backend = load(
+# The CUDA extension is only built / loaded on first use
+_backend = LazyExtension(
     name='_freqencoder',
     extra_cflags=c_flags,
     extra_cuda_cflags=nvcc_flags,
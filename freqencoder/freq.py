@@ -4,6 +4,9 @@ import torch.nn as nn
 from torch.autograd import Function
 from torch.cuda.amp import custom_bwd, custom_fwd
 
+from extensions import use_native
+from encoding import FreqEncoder_torch
+
 # Attempt to import the CUDA extension
 try:
     import _freqencoder as _backend
@@ -80,6 +83,9 @@ class FreqEncoder(nn.Module):
         self.degree = degree
         self.output_dim = input_dim + input_dim * 2 * degree
 
+        # used when the CUDA extension is unavailable, it has no parameters and the same output layout
+        self.encoder_torch = FreqEncoder_torch(input_dim=input_dim, degree=degree)
+
     def __repr__(self):
         return f"FreqEncoder(input_dim={self.input_dim}, degree={self.degree}, output_dim={self.output_dim})"
 
@@ -95,7 +101,10 @@ class FreqEncoder(nn.Module):
         inputs = inputs.reshape(-1, self.input_dim)
 
         # Apply frequency encoding
-        outputs = freq_encode(inputs, self.degree, self.output_dim)
+        if use_native('freq_encode', _backend, inputs.is_cuda):
+            outputs = freq_encode(inputs, self.degree, self.output_dim)
+        else:
+            outputs = self.encoder_torch(inputs)
 
         # Reshape the output to match the input's batch dimensions
         outputs = outputs.reshape(prefix_shape + [self.output_dim])
@@ -1 +1 @@
-from .grid import GridEncoder
\ No newline at end of file
+from .grid import GridEncoder, suggest_log2_hashmap_size, compress_embeddings
\ No newline at end of file
@@ -1,13 +1,21 @@
 import numpy as np
+from functools import lru_cache
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import Function
 from torch.cuda.amp import custom_fwd, custom_bwd 
 
+from extensions import use_native
+
 try:
     import _gridencoder as _backend
 except ImportError:
-    from .backend import _backend
+    try:
+        from .backend import _backend
+    except Exception: # broken toolchain setup, only the pytorch implementation is available
+        _backend = None
 
 # Mapping grid type strings to IDs
 _gridtype_to_id = {
@@ -80,8 +88,280 @@ class _grid_encode(Function):
 grid_encode = _grid_encode.apply
 
 
+# ----------------------------------------
+# pure pytorch implementation
+# ----------------------------------------
+
+# same primes as fast_hash in src/gridencoder.cu
+_primes = [1, 2654435761, 805459861, 3674653429, 2097192037, 1434869437, 2165219737]
+
+
+@lru_cache(maxsize=None)
+def _level_meta(D, level_offsets, S, H, gridtype, align_corners, device):
+    ''' per-level constants of the grid, mirrors get_grid_index in src/gridencoder.cu
+    Args:
+        D: int, input dim
+        level_offsets: tuple of L + 1 ints, row offset of each level in the embedding table
+        S: float, log2(per_level_scale)
+        H: int, base resolution
+    Returns:
+        scales: float, [L]
+        strides: long, [L, D], 0 for the dims skipped once stride exceeds the hashmap size
+        use_hash: bool, [L]
+        sizes, offsets: long, [L]
+    '''
+    L = len(level_offsets) - 1
+    scales = np.zeros(L, dtype=np.float32)
+    strides = np.zeros((L, D), dtype=np.int64)
+    use_hash = np.zeros(L, dtype=bool)
+
+    for level in range(L):
+        hashmap_size = level_offsets[level + 1] - level_offsets[level]
+        # float32 math to match exp2f
+        scale = np.exp2(np.float32(level) * np.float32(S)) * np.float32(H) - np.float32(1.0)
+        resolution = int(np.ceil(scale)) + 1
+        stride = 1
+        for d in range(D):
+            if stride > hashmap_size:
+                break
+            strides[level, d] = stride
+            stride *= resolution if align_corners else resolution + 1
+        scales[level] = scale
+        use_hash[level] = gridtype == 0 and stride > hashmap_size
+
+    sizes = np.diff(np.array(level_offsets, dtype=np.int64))
+    offsets = np.array(level_offsets[:-1], dtype=np.int64)
+
+    return (torch.from_numpy(scales).to(device), torch.from_numpy(strides).to(device), torch.from_numpy(use_hash).to(device),
+            torch.from_numpy(sizes).to(device), torch.from_numpy(offsets).to(device))
+
+
+@lru_cache(maxsize=None)
+def _corners(D, device):
+    # [2^D, D], bit d of corner idx selects the upper neighbour along dim d
+    idx = torch.arange(2 ** D)
+    return ((idx[:, None] >> torch.arange(D)) & 1).to(device)
+
+
+def grid_index(inputs, meta, align_corners=False):
+    ''' look up the table rows of the 2^D grid vertices around each input, for all levels at once.
+    Args:
+        inputs: float, [B, D], in [0, 1]
+        meta: output of _level_meta
+    Returns:
+        index: long, [L, B, 2^D], global row index into the embedding table
+        frac: float, [L, B, D], position inside the cell
+        corners: long, [2^D, D]
+    '''
+    scales, strides, use_hash, sizes, offsets = meta
+    B, D = inputs.shape
+
+    pos = inputs[None] * scales[:, None, None] + (0.0 if align_corners else 0.5) # [L, B, D]
+    pos_grid = pos.floor()
+    frac = pos - pos_grid
+    pos_grid = pos_grid.long().clamp(min=0) # out of bound inputs are masked by the caller
+
+    corners = _corners(D, inputs.device)
+
+    tiled = 0
+    hashed = 0
+    for d in range(D):
+        coord = pos_grid[:, :, None, d] + corners[:, d] # [L, B, 2^D]
+        tiled = tiled + coord * strides[:, None, None, d]
+        hashed = hashed ^ ((coord * _primes[d]) & 0xFFFFFFFF)
+
+    index = torch.where(use_hash[:, None, None], hashed, tiled)
+    index = index % sizes[:, None, None] + offsets[:, None, None]
+
+    return index, frac, corners
+
+
+def _interp_weights(frac, corners, scales, interpolation='linear', calc_grad_inputs=False):
+    # frac: [L, B, D] --> weights: [L, B, 2^D], dweights: [L, B, 2^D, D] (derivative of weights w.r.t. inputs)
+    if interpolation == 'smoothstep':
+        w1 = frac * frac * (3 - 2 * frac)
+        dw1 = 6 * frac * (1 - frac)
+    else:
+        w1 = frac
+        dw1 = torch.ones_like(frac)
+
+    bits = corners.bool() # [2^D, D]
+    fw = torch.where(bits, w1[:, :, None, :], 1 - w1[:, :, None, :]) # [L, B, 2^D, D]
+    weights = fw.prod(-1)
+
+    if not calc_grad_inputs:
+        return weights, None
+
+    D = frac.shape[-1]
+    dfw = torch.where(bits, dw1[:, :, None, :], -dw1[:, :, None, :]) * scales[:, None, None, None]
+    dweights = []
+    for d in range(D):
+        others = [k for k in range(D) if k != d]
+        dweights.append(dfw[..., d] * fw[..., others].prod(-1))
+    dweights = torch.stack(dweights, dim=-1)
+
+    return weights, dweights
+
+
+class _grid_encode_torch(Function):
+    @staticmethod
+    @custom_fwd(cast_inputs=torch.float32)
+    def forward(ctx, inputs, embeddings, level_offsets, per_level_scale, base_resolution, calc_grad_inputs=False, gridtype=0, align_corners=False, interpolation='linear', sparse_grad=False):
+        # inputs: [B, D], float in [0, 1]
+        # embeddings: [sO, C], float, rows past level_offsets[-1] are not used
+        # level_offsets: tuple of L + 1 ints
+        # sparse_grad: if True, the gradient of embeddings is a sparse COO tensor holding only the looked up rows
+        # RETURN: [B, L * C], float
+
+        inputs = inputs.contiguous()
+
+        B, D = inputs.shape
+        L = len(level_offsets) - 1
+        C = embeddings.shape[1]
+        S = float(np.log2(per_level_scale))
+
+        meta = _level_meta(D, tuple(level_offsets), S, base_resolution, gridtype, align_corners, inputs.device)
+        index, frac, corners = grid_index(inputs, meta, align_corners)
+        weights, dweights = _interp_weights(frac, corners, meta[0], interpolation, calc_grad_inputs)
+
+        # inputs out of [0, 1] output 0 and receive no gradient, as in the CUDA kernel
+        inside = ((inputs >= 0) & (inputs <= 1)).all(-1) # [B]
+        weights = weights * inside[None, :, None]
+
+        # one gather over the whole table for all levels and corners
+        feats = embeddings[index] # [L, B, 2^D, C]
+        outputs = (weights.unsqueeze(-1).to(feats.dtype) * feats).sum(-2) # [L, B, C]
+        outputs = outputs.permute(1, 0, 2).reshape(B, L * C)
+
+        if calc_grad_inputs:
+            dweights = dweights * inside[None, :, None, None]
+            dy_dx = torch.einsum('lbkd,lbkc->bldc', dweights.to(feats.dtype), feats).reshape(B, L * D * C)
+        else:
+            dy_dx = None
+
+        ctx.save_for_backward(index, weights, dy_dx)
+        ctx.dims = [B, D, C, L]
+        ctx.num_rows = embeddings.shape[0]
+        ctx.sparse_grad = sparse_grad
+
+        return outputs
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad):
+        # grad: [B, L * C]
+        index, weights, dy_dx = ctx.saved_tensors
+        B, D, C, L = ctx.dims
+
+        grad = grad.view(B, L, C).permute(1, 0, 2) # [L, B, C]
+
+        # scatter each corner's share of the output gradient back to its row
+        values = weights.unsqueeze(-1) * grad.unsqueeze(2).float() # [L, B, 2^D, C]
+        if ctx.sparse_grad:
+            # uncoalesced, duplicated rows are summed by coalesce() in the optimizer
+            grad_embeddings = torch.sparse_coo_tensor(index.view(1, -1), values.reshape(-1, C), (ctx.num_rows, C))
+        else:
+            grad_embeddings = torch.zeros(ctx.num_rows, C, device=grad.device, dtype=values.dtype)
+            grad_embeddings.index_add_(0, index.view(-1), values.reshape(-1, C))
+
+        if dy_dx is not None:
+            grad_inputs = torch.einsum('bldc,blc->bd', dy_dx.view(B, L, D, C), grad.permute(1, 0, 2).to(dy_dx.dtype))
+        else:
+            grad_inputs = None
+
+        return grad_inputs, grad_embeddings, None, None, None, None, None, None, None, None
+
+
+grid_encode_torch = _grid_encode_torch.apply
+
+
+# ----------------------------------------
+# compressed inference weights
+# ----------------------------------------
+
+@torch.no_grad()
+def compress_embeddings(embeddings, level_offsets, dtype='int8', keep=None, prune_thresh=1e-4):
+    ''' quantize the embedding table per level and drop the rows that were never trained
+    Args:
+        embeddings: float, [num_rows, C]
+        level_offsets: list of L + 1 ints
+        dtype: 'int8' (symmetric, one scale per level) or 'fp16'
+        keep: bool, [num_rows], rows to keep. default: rows that moved out of the init range [-prune_thresh, prune_thresh]
+    Returns:
+        dict of cpu tensors and python values, loaded by GridEncoder.load_compressed
+    '''
+    assert dtype in ['int8', 'fp16'], f"Unknown compression dtype {dtype}"
+
+    embeddings = embeddings.detach().float()
+    num_rows, C = embeddings.shape
+    L = len(level_offsets) - 1
+
+    if keep is None:
+        keep = embeddings.abs().amax(-1) > prune_thresh
+    keep = keep.to(embeddings.device)
+
+    sizes = torch.from_numpy(np.diff(np.array(level_offsets, dtype=np.int64))).to(embeddings.device)
+    levels = torch.repeat_interleave(torch.arange(L, device=embeddings.device), sizes)[keep] # [K]
+    values = embeddings[keep] # [K, C]
+
+    if dtype == 'int8':
+        absmax = torch.zeros(L, device=values.device).scatter_reduce(0, levels, values.abs().amax(-1), reduce='amax')
+        scale = (absmax / 127).clamp(min=1e-12)
+        values = (values / scale[levels, None]).round().clamp(-127, 127).to(torch.int8)
+    else:
+        scale = torch.ones(L, device=values.device)
+        values = values.half()
+
+    return {
+        'dtype': dtype,
+        'num_rows': num_rows,
+        'level_dim': C,
+        'level_offsets': list(level_offsets),
+        'mask': torch.from_numpy(np.packbits(keep.cpu().numpy())), # 1 bit per row of the full table
+        'values': values.cpu(), # [K, C], kept rows only
+        'scale': scale.cpu(), # [L]
+    }
+
+
+@torch.no_grad()
+def grid_encode_compressed(inputs, rows, values, scale, level_offsets, per_level_scale, base_resolution, gridtype=0, align_corners=False, interpolation='linear'):
+    ''' grid_encode_torch on a pruned, quantized table, only the looked up rows are dequantized. no gradient.
+    Args:
+        inputs: float, [B, D], in [0, 1]
+        rows: long, [K], sorted rows of the full table that were kept
+        values: int8 or half, [K, C]
+        scale: float, [L]
+        level_offsets: tuple of L + 1 ints
+    Returns:
+        outputs: float, [B, L * C]
+    '''
+    B, D = inputs.shape
+    L = len(level_offsets) - 1
+    C = values.shape[1]
+
+    meta = _level_meta(D, tuple(level_offsets), float(np.log2(per_level_scale)), base_resolution, gridtype, align_corners, inputs.device)
+    index, frac, corners = grid_index(inputs.float(), meta, align_corners)
+    weights, _ = _interp_weights(frac, corners, meta[0], interpolation)
+
+    inside = ((inputs >= 0) & (inputs <= 1)).all(-1)
+    weights = weights * inside[None, :, None]
+
+    # position of each looked up row in the pruned table, pruned rows read as 0
+    index = index.view(-1)
+    pos = torch.searchsorted(rows, index).clamp(max=max(rows.shape[0] - 1, 0))
+    if rows.shape[0] > 0:
+        hit = rows[pos] == index
+        feats = values[pos].float() * hit[:, None]
+    else:
+        feats = torch.zeros(index.shape[0], C, device=inputs.device)
+    feats = feats.view(L, B, -1, C) * scale[:L, None, None, None]
+
+    outputs = (weights.unsqueeze(-1) * feats).sum(-2) # [L, B, C]
+    return outputs.permute(1, 0, 2).reshape(B, L * C)
+
+
 class GridEncoder(nn.Module):
-    def __init__(self, input_dim=3, num_levels=16, level_dim=2, per_level_scale=2.0, base_resolution=16, log2_hashmap_size=19, desired_resolution=None, gridtype='hash', align_corners=False):
+    def __init__(self, input_dim=3, num_levels=16, level_dim=2, per_level_scale=2.0, base_resolution=16, log2_hashmap_size=19, desired_resolution=None, gridtype='hash', align_corners=False, interpolation='linear', sparse_grad=False):
         super().__init__()
 
         if desired_resolution is not None:
@@ -97,18 +377,34 @@ class GridEncoder(nn.Module):
         self.gridtype = gridtype
         self.gridtype_id = _gridtype_to_id[gridtype]
         self.align_corners = align_corners
+        self.interpolation = interpolation # linear or smoothstep, smoothstep is only implemented in pytorch
+
+        self.sparse_grad = sparse_grad # emit row-sparse gradients for the embeddings, see LazyAdamW in optimizer.py
+
+        assert interpolation in ['linear', 'smoothstep'], f"Unknown interpolation {interpolation}"
+
+        # log2_hashmap_size: int, or one int per level (see suggest_log2_hashmap_size)
+        if isinstance(log2_hashmap_size, (list, tuple)):
+            assert len(log2_hashmap_size) == num_levels, f"log2_hashmap_size needs {num_levels} entries, got {len(log2_hashmap_size)}"
+            level_log2_sizes = [int(x) for x in log2_hashmap_size]
+        else:
+            level_log2_sizes = [int(log2_hashmap_size)] * num_levels
 
         # Calculate offsets for each level
         offsets = []
         offset = 0
-        self.max_params = 2 ** log2_hashmap_size
+        self.max_params = 2 ** max(level_log2_sizes)
+        self.level_dense_sizes = [] # vertices of each level's grid, the level is hashed if this exceeds its table
         for i in range(num_levels):
             resolution = int(np.ceil(base_resolution * per_level_scale ** i))
-            params_in_level = min(self.max_params, (resolution if align_corners else resolution + 1) ** input_dim)
+            dense_size = (resolution if align_corners else resolution + 1) ** input_dim
+            self.level_dense_sizes.append(dense_size)
+            params_in_level = min(2 ** level_log2_sizes[i], dense_size)
             params_in_level = int(np.ceil(params_in_level / 8) * 8)
             offsets.append(offset)
             offset += params_in_level
         offsets.append(offset)
+        self.level_offsets = offsets # python copy, slicing by level must not sync with the device
         offsets = torch.from_numpy(np.array(offsets, dtype=np.int32))
         self.register_buffer('offsets', offsets)
 
@@ -117,6 +413,13 @@ class GridEncoder(nn.Module):
         # Define the embeddings parameter
         self.embeddings = nn.Parameter(torch.empty(offset, level_dim))
         self.reset_parameters()
+
+        # table usage instrumentation, see record_stats / level_stats
+        self.track_stats = False
+        self.reset_stats()
+
+        # inference from a quantized table, see load_compressed
+        self.compressed = False
     
     def reset_parameters(self):
         """Initialize embeddings with a small random value."""
@@ -128,15 +431,158 @@ class GridEncoder(nn.Module):
                 f"level_dim={self.level_dim}, resolution={self.base_resolution} -> "
                 f"{int(round(self.base_resolution * self.per_level_scale ** (self.num_levels - 1)))}, "
                 f"per_level_scale={self.per_level_scale:.4f}, params={tuple(self.embeddings.shape)}, "
-                f"gridtype={self.gridtype}, align_corners={self.align_corners}")
+                f"gridtype={self.gridtype}, align_corners={self.align_corners}, interpolation={self.interpolation}, sparse_grad={self.sparse_grad}")
     
-    def forward(self, inputs, bound=1):
+    def forward(self, inputs, bound=1, max_level=None):
+        # inputs: [..., input_dim], normalized real world positions in [-bound, bound]
+        # max_level: number of active levels, None means all. inactive levels are not looked up and get no gradient, their outputs are 0.
+        # return: [..., num_levels * level_dim]
+
         inputs = (inputs + bound) / (2 * bound)
 
         prefix_shape = list(inputs.shape[:-1])
         inputs = inputs.view(-1, self.input_dim)
 
-        outputs = grid_encode(inputs, self.embeddings, self.offsets, self.per_level_scale, self.base_resolution, inputs.requires_grad, self.gridtype_id, self.align_corners)
+        L = self.num_levels if max_level is None else min(max(int(max_level), 1), self.num_levels)
+
+        if self.track_stats and self.training:
+            self.record_stats(inputs, L)
+
+        # the CUDA kernel can only write a dense gradient for the whole table, sparse gradients come from the pytorch implementation
+        if self.compressed:
+            outputs = grid_encode_compressed(inputs, self.q_rows, self.q_values, self.q_scale, tuple(self.level_offsets[:L + 1]), self.per_level_scale, self.base_resolution, self.gridtype_id, self.align_corners, self.interpolation)
+        elif use_native('grid_encode', _backend, inputs.is_cuda and self.interpolation == 'linear' and not self.sparse_grad):
+            # the first L levels are stored contiguously, so only their slice of the table is looked up
+            embeddings = self.embeddings if L == self.num_levels else self.embeddings[:self.level_offsets[L]]
+            outputs = grid_encode(inputs, embeddings, self.offsets[:L + 1], self.per_level_scale, self.base_resolution, inputs.requires_grad, self.gridtype_id, self.align_corners)
+        else:
+            # the levels are selected by level_offsets alone, the full table is passed since a slice can't take a sparse gradient
+            outputs = grid_encode_torch(inputs, self.embeddings, tuple(self.level_offsets[:L + 1]), self.per_level_scale, self.base_resolution, inputs.requires_grad, self.gridtype_id, self.align_corners, self.interpolation, self.sparse_grad)
+
+        if L < self.num_levels:
+            outputs = F.pad(outputs, (0, (self.num_levels - L) * self.level_dim))
+
         outputs = outputs.view(prefix_shape + [self.output_dim])
 
         return outputs
+
+    def load_compressed(self, state):
+        ''' switch to inference from the output of compress_embeddings, the fp32 table is released. '''
+        assert state['level_offsets'] == self.level_offsets and state['level_dim'] == self.level_dim, "compressed table does not match this encoder"
+
+        device = self.embeddings.device
+        # the state may have been loaded onto the gpu (load_checkpoint maps to the trainer's device)
+        keep = np.unpackbits(state['mask'].cpu().numpy(), count=state['num_rows']).astype(bool)
+        rows = torch.from_numpy(np.flatnonzero(keep)) # sorted
+
+        self.register_buffer('q_rows', rows.to(device), persistent=False)
+        self.register_buffer('q_values', state['values'].to(device), persistent=False)
+        self.register_buffer('q_scale', state['scale'].float().to(device), persistent=False)
+
+        self.embeddings.requires_grad_(False)
+        self.embeddings.data = torch.empty(0, self.level_dim, device=device)
+        self.compressed = True
+
+    # ----------------------------------------
+    # table usage instrumentation
+    # ----------------------------------------
+
+    def _level_meta(self, L, device):
+        return _level_meta(self.input_dim, tuple(self.level_offsets[:L + 1]), float(np.log2(self.per_level_scale)), self.base_resolution, self.gridtype_id, self.align_corners, device)
+
+    def reset_stats(self):
+        self.touched = None # bool, [num_rows], rows looked up since the last reset
+        self.grad_touched = None # bool, [num_rows], rows with a non-zero gradient since the last reset
+        self.stats_inputs = None # last recorded batch, used for the collision rate
+        self.active_levels = 0 # levels looked up since the last reset, the others are not scheduled yet
+
+    @torch.no_grad()
+    def record_stats(self, inputs, L=None):
+        # inputs: [B, input_dim], in [0, 1]
+        # marks the rows looked up by the first L levels. called by forward when track_stats is set.
+        L = self.num_levels if L is None else L
+
+        if self.touched is None or self.touched.device != inputs.device:
+            self.touched = torch.zeros(self.embeddings.shape[0], dtype=torch.bool, device=inputs.device)
+            self.grad_touched = torch.zeros_like(self.touched)
+
+        inputs = inputs[((inputs >= 0) & (inputs <= 1)).all(-1)].float()
+        index, _, _ = grid_index(inputs, self._level_meta(L, inputs.device), self.align_corners)
+        self.touched[index.view(-1)] = True
+        self.stats_inputs = (inputs, L)
+        self.active_levels = max(self.active_levels, L)
+
+    @torch.no_grad()
+    def record_grad(self):
+        # marks the rows that received a gradient, call after backward and before zero_grad
+        grad = self.embeddings.grad
+        if grad is None or self.grad_touched is None:
+            return
+        if grad.is_sparse:
+            self.grad_touched[grad._indices()[0]] = True
+        else:
+            self.grad_touched |= grad.ne(0).any(-1)
+
+    @torch.no_grad()
+    def level_stats(self):
+        ''' per-level table usage of the training lookups since the last reset_stats(), the trainer resets after every report
+        Returns:
+            list of dict, one per level:
+                size: rows in the level's table
+                dense_size: vertices in the level's grid, the level is hashed if dense_size > size
+                active: the level was looked up, False while the level schedule keeps it off
+                occupancy: fraction of rows looked up
+                grad_rows: fraction of rows that received a gradient
+                collision_rate: on the last recorded batch, 1 - distinct rows / distinct grid vertices
+        '''
+        stats = []
+        for level in range(self.num_levels):
+            start, end = self.level_offsets[level], self.level_offsets[level + 1]
+            stats.append({
+                'size': end - start,
+                'dense_size': self.level_dense_sizes[level],
+                'active': level < self.active_levels,
+                'occupancy': self.touched[start:end].float().mean().item() if self.touched is not None else 0.0,
+                'grad_rows': self.grad_touched[start:end].float().mean().item() if self.grad_touched is not None else 0.0,
+                'collision_rate': 0.0,
+            })
+
+        if self.stats_inputs is not None:
+            inputs, L = self.stats_inputs
+            meta = self._level_meta(L, inputs.device)
+            index, _, corners = grid_index(inputs, meta, self.align_corners)
+
+            # unique key of each grid vertex, independent of the hashing
+            pos_grid = (inputs[None] * meta[0][:, None, None] + (0.0 if self.align_corners else 0.5)).floor().long().clamp(min=0) # [L, B, D]
+            R = int(meta[0].max().ceil().item()) + 3
+            key = 0
+            for d in range(self.input_dim):
+                key = key * R + (pos_grid[:, :, None, d] + corners[:, d]) # [L, B, 2^D]
+
+            for level in range(L):
+                num_vertices = key[level].unique().numel()
+                num_rows = index[level].unique().numel()
+                stats[level]['collision_rate'] = 1 - num_rows / max(num_vertices, 1)
+
+        return stats
+
+
+def suggest_log2_hashmap_size(stats, target_load=0.5, min_log2=10, max_log2=24):
+    ''' per-level table sizes from GridEncoder.level_stats(), to be used as log2_hashmap_size of the next run.
+    Each level gets the smallest table holding its distinct vertices at target_load.
+    The vertices are estimated as touched rows / (1 - collision rate), so saturated levels grow and sparsely used ones shrink.
+    Levels that were not active keep their current size.
+    Returns:
+        list of int, one per level
+    '''
+    sizes = []
+    for s in stats:
+        if not s.get('active', True):
+            sizes.append(int(np.ceil(np.log2(s['size']))))
+            continue
+        vertices = s['occupancy'] * s['size'] / max(1 - s['collision_rate'], 1e-3)
+        log2 = int(np.ceil(np.log2(max(vertices / target_load, 1))))
+        # no need for more rows than the dense grid has
+        log2 = min(log2, int(np.ceil(np.log2(s['dense_size']))))
+        sizes.append(int(np.clip(log2, min_log2, max_log2)))
+    return sizes
@@ -5,7 +5,7 @@ import argparse
 
 from nerf.provider import NeRFDataset
 from nerf.utils_neurallift import *
-from optimizer import Shampoo
+from optimizer import Shampoo, LazyAdamW
 
 import pdb
 import os
@@ -83,7 +83,11 @@ if __name__ == '__main__':
         else:
             raise NotImplementedError(f'--guidance {opt.guidance} is not implemented.')
 
-        optimizer = lambda model: torch.optim.AdamW(model.get_params(opt.lr), betas=(0.9, 0.99), eps=1e-15)
+        if opt.sparse_grad:
+            # lazy update, only the hash grid rows touched by the batch are stepped
+            optimizer = lambda model: LazyAdamW(model.get_params(opt.lr), betas=(0.9, 0.99), eps=1e-15)
+        else:
+            optimizer = lambda model: torch.optim.AdamW(model.get_params(opt.lr), betas=(0.9, 0.99), eps=1e-15)
 
         train_loader = NeRFDataset(opt, device=device, type='train', H=opt.h, W=opt.w, size=100).dataloader()
         opt.max_epoch = int(np.ceil(opt.iters / len(train_loader)))
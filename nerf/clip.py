@@ -23,7 +23,7 @@ class CLIP(nn.Module):
 
         self.device = device
 
-        clip_name = clip_name
+        self.clip_name = clip_name
 
         self.feature_extractor = CLIPFeatureExtractor.from_pretrained(clip_name)
         self.clip_model = CLIPModel.from_pretrained(clip_name).cuda()
@@ -0,0 +1,57 @@
+import os
+import json
+import hashlib
+
+import torch
+
+
+class EmbeddingCache:
+    ''' content-addressed embeddings on disk, shared by every run that uses the same root.
+    a key is the sha1 of its parts (model name, kind, prompt, negative prompt, image hash, ...), so any change of
+    a part is a different file and nothing is ever invalidated. tensors are stored in the dtype they were computed in,
+    so a hit returns exactly what compute() returned.
+    when disabled (no root), get() computes every time.
+    '''
+    def __init__(self, root=None):
+        self.root = root
+        self.enabled = bool(root)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"EmbeddingCache: root={self.root} hits={self.hits} misses={self.misses}"
+
+    @staticmethod
+    def hash_tensor(x):
+        # content hash of a tensor, e.g. of the prepared reference image
+        x = x.detach().cpu().contiguous()
+        return hashlib.sha1(str((x.dtype, tuple(x.shape))).encode() + x.numpy().tobytes()).hexdigest()
+
+    def path(self, parts):
+        key = hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+        return os.path.join(self.root, key[:2], f'{key}.pt')
+
+    def get(self, parts, compute, device):
+        # parts: list of str, compute: () -> tensor, called on a miss
+        if not self.enabled:
+            return compute()
+
+        path = self.path(parts)
+        if os.path.exists(path):
+            try:
+                entry = torch.load(path, map_location='cpu')
+                # entries rounded to fp16 by an earlier version are recomputed
+                if str(entry['tensor'].dtype).replace('torch.', '') == entry['dtype']:
+                    self.hits += 1
+                    return entry['tensor'].to(device)
+            except Exception as e:
+                print(f'[WARN] unreadable embedding cache entry {path}: {e}, recomputing')
+
+        self.misses += 1
+        x = compute()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temp file and rename, concurrent runs of a sweep may write the same key
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        torch.save({'tensor': x.detach().cpu(), 'dtype': str(x.dtype).replace('torch.', ''), 'parts': parts}, tmp_path)
+        os.replace(tmp_path, path)
+        return x
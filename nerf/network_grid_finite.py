@@ -94,10 +94,10 @@ class NeRFNetwork(NeRFRenderer):
 
         num_levels = 16
         level_dim = 2
-        self.encoder, self.in_dim = get_encoder('hashgrid', input_dim=3, log2_hashmap_size=19, desired_resolution=2048 * self.bound, interpolation='smoothstep', num_levels=16, level_dim=2)
-        self.max_level = num_levels * level_dim
-        self.cur_level = num_levels * level_dim
-        # self.cur_level = num_levels // 2 * level_dim
+        self.encoder, self.in_dim = get_encoder('hashgrid', input_dim=3, log2_hashmap_size=self.opt.log2_hashmap_size, desired_resolution=2048 * self.bound, interpolation='linear', sparse_grad=self.opt.sparse_grad, num_levels=16, level_dim=2)
+        self.max_level = num_levels
+        self.cur_level = num_levels # active hash levels, see update_level
+        self.encoder.track_stats = self.opt.hash_stats_interval > 0 # table usage, logged by the trainer
 
         self.sigma_net = MLP_swish(self.in_dim, 4, hidden_dim, num_layers, bias=True)
         # self.sigma_net = MLP(self.in_dim, 4, hidden_dim, num_layers, bias=True)
@@ -111,7 +111,7 @@ class NeRFNetwork(NeRFRenderer):
             self.hidden_dim_bg = hidden_dim_bg
             
             # use a very simple network to avoid it learning the prompt...
-            self.encoder_bg, self.in_dim_bg = get_encoder('frequency', input_dim=3, multires=4)
+            self.encoder_bg, self.in_dim_bg = get_encoder('frequency_torch', input_dim=3, multires=4)
             self.bg_net = MLP(self.in_dim_bg, 3, hidden_dim_bg, num_layers_bg, bias=True)
             
         else:
@@ -140,9 +140,8 @@ class NeRFNetwork(NeRFRenderer):
     def common_forward(self, x):
 
         # sigma
-        enc = self.encoder(x, bound=self.bound)
+        enc = self.encoder(x, bound=self.bound, max_level=self.cur_level)
         # print('enc', enc.shape) # [..., 32]
-        enc[:, self.cur_level:] = 0
 
         h = self.sigma_net(enc)
 
@@ -151,6 +150,20 @@ class NeRFNetwork(NeRFRenderer):
 
         return sigma, albedo
 
+    # coarse-to-fine hash levels
+    def update_level(self, global_step):
+        # level_schedule: [[iter, num_levels], ...], the last entry with iter <= global_step wins
+        self.cur_level = self.max_level
+        for it, level in sorted(self.opt.level_schedule):
+            if global_step >= it:
+                self.cur_level = min(int(level), self.max_level)
+
+    def inactive_embeddings(self):
+        # rows of the levels update_level has not activated, a view of the hash table without autograd. None if all are active
+        if self.cur_level >= self.max_level:
+            return None
+        return self.encoder.embeddings.data[self.encoder.level_offsets[self.cur_level]:]
+
     # ref: https://github.com/zhaofuq/Instant-NSR/blob/main/nerf/network_sdf.py#L192
     def finite_difference_normal(self, x, epsilon=1e-2):
         # x: [N, 3]
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import torch
+
+
+class StepProfiler:
+    ''' per-phase wall-clock timers for the training step.
+    when disabled, phase() returns a no-op context and nothing is synchronized, so the timers can stay in the code.
+    when enabled, the device is synchronized around every phase so the kernels are charged to the phase that launched them.
+    times of a phase entered several times in one step are summed, and step() keeps the last `window` steps for the percentiles.
+    '''
+    def __init__(self, enabled=False, window=100, trace_range=None, trace_dir=None):
+        self.enabled = enabled
+        self.window = window
+        # torch.profiler chrome trace of steps [start, end), only if enabled
+        self.trace_range = tuple(trace_range) if trace_range else None
+        self.trace_dir = trace_dir
+
+        self.times = defaultdict(lambda: deque(maxlen=self.window)) # phase -> last window step times (ms)
+        self.current = defaultdict(float) # phase -> time in the running step (ms)
+        self.order = [] # phases in the order they were first entered
+        self.steps = 0
+        self.trace = None
+
+    def __repr__(self):
+        return f"StepProfiler: enabled={self.enabled} window={self.window} trace_range={self.trace_range}"
+
+    def sync(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def phase(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        if name not in self.order:
+            self.order.append(name)
+        # named ranges in the chrome trace
+        ctx = torch.profiler.record_function(name) if self.trace is not None else nullcontext()
+        self.sync()
+        t0 = time.perf_counter()
+        try:
+            with ctx:
+                yield
+        finally:
+            self.sync()
+            self.current[name] += (time.perf_counter() - t0) * 1000
+
+    def step(self):
+        # call once at the end of every training step
+        if not self.enabled:
+            return
+
+        for name, t in self.current.items():
+            self.times[name].append(t)
+        self.current.clear()
+        self.steps += 1
+
+        if self.trace_range is not None:
+            start, end = self.trace_range
+            if self.trace is None and start <= self.steps < end:
+                self.trace = torch.profiler.profile(
+                    activities=[torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else []),
+                    record_shapes=True,
+                )
+                self.trace.__enter__()
+            elif self.trace is not None and self.steps >= end:
+                self.close()
+
+    def close(self):
+        # stops a running trace and writes it, e.g. when training ends inside the trace range
+        if self.trace is None:
+            return
+        self.trace.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, f'trace_step{self.trace_range[0]:06d}-{self.steps:06d}.json')
+        self.trace.export_chrome_trace(path)
+        print(f'[INFO] wrote profiler trace to {path}, open it in chrome://tracing or perfetto')
+        self.trace = None
+
+    def summary(self):
+        # {phase: {mean, p50, p90, p99, max}} in ms over the window
+        out = {}
+        for name in self.order:
+            t = np.array(self.times[name])
+            if len(t) == 0:
+                continue
+            p50, p90, p99 = np.percentile(t, [50, 90, 99])
+            out[name] = {'mean': float(t.mean()), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(t.max()), 'count': len(t)}
+        return out
+
+    def report(self):
+        summary = self.summary()
+        # top level phases share the step, nested ones (guidance/unet) are parts of their parent
+        total = sum(v['mean'] for k, v in summary.items() if '/' not in k)
+        lines = [f"{'phase':<24} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'share':>6}"]
+        for name, v in summary.items():
+            share = f"{100 * v['mean'] / total:5.1f}%" if '/' not in name and total > 0 else ''
+            lines.append(f"{name:<24} {v['mean']:9.2f} {v['p50']:9.2f} {v['p90']:9.2f} {v['p99']:9.2f} {share:>6}")
+        return '\n'.join(lines)
+
+    def dump(self, path, step=None):
+        # one json line per report
+        with open(path, 'a') as f:
+            f.write(json.dumps({'step': step, 'phases_ms': self.summary()}) + '\n')
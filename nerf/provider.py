@@ -4,6 +4,8 @@ import glob
 import json
 import tqdm
 import random
+import queue
+import threading
 import numpy as np
 from scipy.spatial.transform import Slerp, Rotation
 
@@ -66,7 +68,110 @@ def get_view_direction(thetas, phis, overhead, front):
 
 import torch.nn.functional as F
 
-def rand_poses(size, device, radius_range=[1, 1.5], theta_range=[0, 100], phi_range=[0, 360], return_dirs=False, angle_overhead=30, angle_front=60, jitter=False, uniform_sphere_rate=0.5):
+class PoseSampler:
+    ''' low-discrepancy uniforms for rand_poses(samples=...), a scrambled Sobol sequence deterministic per seed.
+    consecutive draws fill [0, 1)^7 evenly, so the poses cover the view sphere without the clumps of independent samples.
+    '''
+    dims = 7 # radius, sphere / range choice, theta, phi, 3 for the uniform sphere branch
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.engine = torch.quasirandom.SobolEngine(dimension=self.dims, scramble=True, seed=seed)
+
+    def __repr__(self):
+        return f"PoseSampler: seed={self.seed} drawn={self.engine.num_generated}"
+
+    def draw(self, size):
+        return self.engine.draw(size) # [size, 7] on cpu
+
+
+class ViewSampler:
+    ''' running error of every view direction bucket (get_view_direction labels), updated by the trainer with the
+    guidance gradient magnitude of the views it trains on. NeRFDataset.collate_batch draws `oversample` times more
+    candidate views than it needs and keeps them with probability proportional to weights(), so the views whose
+    direction is still wrong are trained more often than the converged ones.
+    the weighted pick of a subset breaks the low-discrepancy coverage of a PoseSampler, the two are not meant to be combined.
+    '''
+    oversample = 4
+
+    def __init__(self, strength=0.5, decay=0.95, num_buckets=6):
+        self.strength = strength # 0: uniform views, 1: proportional to the bucket error
+        self.decay = decay
+        self.num_buckets = num_buckets
+        self.error = None # [num_buckets], on the device of the first update
+
+    def __repr__(self):
+        return f"ViewSampler: strength={self.strength} decay={self.decay}"
+
+    def update(self, bucket, value):
+        # value: scalar tensor, stays on its device so the training step is not synchronized
+        value = value.detach().float()
+        if self.error is None:
+            self.error = value.expand(self.num_buckets).clone()
+        self.error[bucket] = self.decay * self.error[bucket] + (1 - self.decay) * value
+
+    def weights(self):
+        if self.error is None:
+            return torch.ones(self.num_buckets)
+        # waits for the trainer's updates, only on the calling (producer) thread
+        error = self.error.cpu()
+        return (1 - self.strength) + self.strength * error / error.mean().clamp(min=1e-8)
+
+
+class ViewRNG:
+    ''' the random generators a training view is drawn from, for rand_poses, patch_indices and collate_batch.
+    seed None: the global torch, numpy and python rngs of the training run (seed_everything).
+    otherwise private generators seeded with it, so the PrefetchLoader thread does not share the global state with the
+    training loop, and draws the same views for a seed whatever the main thread draws in between.
+    '''
+    def __init__(self, seed=None):
+        self.seed = seed
+        if seed is None:
+            self.generator = None
+            self.np = np.random
+            self.py = random
+        else:
+            self.generator = torch.Generator().manual_seed(seed) # cpu, the draws are moved to the device
+            self.np = np.random.default_rng(seed)
+            self.py = random.Random(seed)
+
+    def __repr__(self):
+        return f"ViewRNG: seed={self.seed}"
+
+    def rand(self, shape, device=None):
+        if self.generator is None:
+            return torch.rand(shape, device=device)
+        return torch.rand(shape, generator=self.generator).to(device)
+
+    def randn(self, shape, device=None):
+        if self.generator is None:
+            return torch.randn(shape, device=device)
+        return torch.randn(shape, generator=self.generator).to(device)
+
+    def multinomial(self, weights, num_samples):
+        return torch.multinomial(weights, num_samples, replacement=False, generator=self.generator)
+
+
+def patch_indices(h, w, scale, mode='dilated', device=None, rng=None):
+    ''' pixels of an h x w patch of the (h * scale) x (w * scale) virtual image, so h * w rays train a larger image.
+    dilated: every scale-th pixel from a random offset, the full view subsampled.
+    multiscale: dilation drawn from 1..scale at a random origin, a crop of the view at a random zoom.
+    rng: ViewRNG, None for the global rngs
+    Returns:
+        inds: [h*w], row-major pixel indices of the virtual image, as taken by get_rays
+        dilation: int
+    '''
+    py = random if rng is None else rng.py
+    H, W = h * scale, w * scale
+    d = scale if mode == 'dilated' else py.randint(1, scale)
+    y0 = py.randint(0, H - (h - 1) * d - 1)
+    x0 = py.randint(0, W - (w - 1) * d - 1)
+    rows = y0 + d * torch.arange(h, device=device)
+    cols = x0 + d * torch.arange(w, device=device)
+    return (rows[:, None] * W + cols[None, :]).reshape(-1), d
+
+
+def rand_poses(size, device, radius_range=[1, 1.5], theta_range=[0, 100], phi_range=[0, 360], return_dirs=False, angle_overhead=30, angle_front=60, jitter=False, uniform_sphere_rate=0.5, samples=None, rng=None):
     ''' generate random poses from an orbit camera
     Args:
         size: batch size of generated poses.
@@ -74,6 +179,9 @@ def rand_poses(size, device, radius_range=[1, 1.5], theta_range=[0, 100], phi_ra
         radius: camera radius
         theta_range: [min, max], should be in [0, pi]
         phi_range: [min, max], should be in [0, 2 * pi]
+        uniform_sphere_rate: probability of each pose to be drawn uniformly on the sphere instead of from the ranges
+        samples: [size, 7] uniforms in [0, 1) from a PoseSampler, used instead of torch.rand (jitter stays random)
+        rng: ViewRNG of the other random draws, None for the global rngs
     Return:
         poses: [size, 4, 4]
     '''
@@ -82,42 +190,71 @@ def rand_poses(size, device, radius_range=[1, 1.5], theta_range=[0, 100], phi_ra
     phi_range_ = np.deg2rad(phi_range)
     angle_overhead = np.deg2rad(angle_overhead)
     angle_front = np.deg2rad(angle_front)
+    rng = ViewRNG() if rng is None else rng
     
-    radius = torch.rand(size, device=device) * (radius_range[1] - radius_range[0]) + radius_range[0]
-    if random.random() < uniform_sphere_rate:
+    if samples is None:
+        rand = lambda k: rng.rand(size, device=device)
+    else:
+        samples = samples.to(device)
+        rand = lambda k: samples[:, k]
+
+    radius = rand(0) * (radius_range[1] - radius_range[0]) + radius_range[0]
+
+    # chosen per pose, so a batch of poses has the same distribution as the same number of single pose calls.
+    # drawn on the cpu, the branches below are skipped without a device sync
+    if samples is not None:
+        uniform = samples[:, 1].cpu() < uniform_sphere_rate
+    elif size == 1:
+        uniform = torch.tensor([rng.py.random() < uniform_sphere_rate])
+    else:
+        uniform = rng.rand(size) < uniform_sphere_rate
+    use_uniform, use_range = bool(uniform.any()), not bool(uniform.all())
+    uniform = uniform.to(device)
+
+    thetas = torch.zeros(size, device=device)
+    phis = torch.zeros(size, device=device)
+    centers = torch.zeros(size, 3, device=device)
+
+    if use_uniform:
         unit_centers = F.normalize(
             torch.stack([
-                (torch.rand(size, device=device) - 0.5) * 2.0,
-                torch.rand(size, device=device),
-                (torch.rand(size, device=device) - 0.5) * 2.0,
+                (rand(4) - 0.5) * 2.0,
+                rand(5),
+                (rand(6) - 0.5) * 2.0,
             ], dim=-1), p=2, dim=1
         )
-        thetas = torch.acos(unit_centers[:,1])
-        thetas = thetas.clamp(1e-2, np.pi-1e-2)
-        phis = torch.atan2(unit_centers[:,0], unit_centers[:,2])
-        phis[phis < 0] += 2 * np.pi
-        centers = unit_centers * radius.unsqueeze(-1)
-    else:
+        u_thetas = torch.acos(unit_centers[:,1])
+        u_thetas = u_thetas.clamp(1e-2, np.pi-1e-2)
+        u_phis = torch.atan2(unit_centers[:,0], unit_centers[:,2])
+        u_phis[u_phis < 0] += 2 * np.pi
+        thetas = torch.where(uniform, u_thetas, thetas)
+        phis = torch.where(uniform, u_phis, phis)
+        centers = torch.where(uniform.unsqueeze(-1), unit_centers * radius.unsqueeze(-1), centers)
+
+    if use_range:
         # thetas = torch.rand(size, device=device) * (theta_range[1] - theta_range[0]) + theta_range[0]
-        thetas = torch.rand(size, device=device) * (theta_range[1] - theta_range[0]) + theta_range[0]
-        thetas = torch.deg2rad(thetas)
-        thetas = thetas.clamp(1e-2, np.pi-1e-2)
-        phis = torch.rand(size, device=device) * (phi_range[1] - phi_range[0]) + phi_range[0]
-        phis = torch.deg2rad(phis)
+        r_thetas = rand(2) * (theta_range[1] - theta_range[0]) + theta_range[0]
+        r_thetas = torch.deg2rad(r_thetas)
+        r_thetas = r_thetas.clamp(1e-2, np.pi-1e-2)
+        r_phis = rand(3) * (phi_range[1] - phi_range[0]) + phi_range[0]
+        r_phis = torch.deg2rad(r_phis)
         # phis = torch.rand(size, device=device) * (phi_range[1] - phi_range[0]) + phi_range[0]
 
-        centers = torch.stack([
-            radius * torch.sin(thetas) * torch.sin(phis),
-            radius * torch.cos(thetas),
-            radius * torch.sin(thetas) * torch.cos(phis),
+        r_centers = torch.stack([
+            radius * torch.sin(r_thetas) * torch.sin(r_phis),
+            radius * torch.cos(r_thetas),
+            radius * torch.sin(r_thetas) * torch.cos(r_phis),
         ], dim=-1) # [B, 3]
+        thetas = torch.where(uniform, thetas, r_thetas)
+        phis = torch.where(uniform, phis, r_phis)
+        centers = torch.where(uniform.unsqueeze(-1), centers, r_centers)
 
     targets = 0
 
     # jitters
     if jitter:
-        centers = centers + (torch.rand_like(centers) * 0.1 - 0.05)
-        targets = targets + torch.randn_like(centers) * 0.1
+        centers = centers + (rng.rand(centers.shape, device=device) * 0.1 - 0.05)
+        targets = targets + rng.randn(centers.shape, device=device) * 0.1
 
     # lookat
     forward_vector = safe_normalize(targets - centers)
@@ -125,7 +262,7 @@ def rand_poses(size, device, radius_range=[1, 1.5], theta_range=[0, 100], phi_ra
     right_vector = safe_normalize(torch.cross(forward_vector, up_vector, dim=-1))
     
     if jitter:
-        up_noise = torch.randn_like(up_vector) * 0.01
+        up_noise = rng.randn(up_vector.shape, device=device) * 0.01
     else:
         up_noise = 0
 
@@ -197,6 +334,14 @@ class NeRFDataset:
         self.cy = self.W / 2
         self.shading = shading
 
+        # (H, W) of the training views, changed by the trainer's render schedule through set_resolution()
+        self.resolution = (self.H, self.W)
+
+        # quasi-random training poses, None for independent torch.rand samples
+        self.sampler = PoseSampler(seed=opt.seed) if self.training and opt.pose_sampler == 'sobol' else None
+        # error-driven choice of the training view directions, updated by the trainer
+        self.view_sampler = ViewSampler(strength=opt.view_sampling) if self.training and opt.view_sampling > 0 else None
+
         # [debug] visualize poses
         # poses, dirs = rand_poses(100, self.device, return_dirs=self.opt.dir_text, radius_range=self.radius_range)
         # visualize_poses(poses.detach().cpu().numpy())
@@ -208,13 +353,7 @@ class NeRFDataset:
 
         if self.training:
             # random pose on the fly
-            poses, dirs = rand_poses(B, self.device, radius_range=self.radius_range, return_dirs=self.opt.dir_text, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, jitter=True)
-            # poses, dirs = rand_poses(B, self.device, radius_range=self.radius_range, return_dirs=self.opt.dir_text, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, jitter=self.opt.jitter_pose)
-
-            # random focal
-            fov = random.random() * (self.fovy_range[1] - self.fovy_range[0]) + self.fovy_range[0]
-            focal = self.H / (2 * np.tan(np.deg2rad(fov) / 2))
-            intrinsics = np.array([focal, focal, self.cx, self.cy])
+            return self.collate_batch(B)[0]
         else:
             # circle pose
             phi = (index[0] / self.size) * 360
@@ -229,25 +368,36 @@ class NeRFDataset:
         # sample a low-resolution but full image for CLIP
         rays = get_rays(poses, intrinsics, self.H, self.W, -1)
 
+        return self.make_data(rays['rays_o'], rays['rays_d'], dirs, fov, poses, intrinsics)
+
+    def set_resolution(self, H, W):
+        # one assignment, collate_batch() reads it once per batch on the prefetch thread.
+        # views already generated keep their own 'H' and 'W', PrefetchLoader.next() drops them
+        self.resolution = (H, W)
+
+    def make_data(self, rays_o, rays_d, dirs, fov, poses, intrinsics, H=None, W=None):
+        H = self.H if H is None else H
+        W = self.W if W is None else W
+
         if self.shading:
             data = {
-                'H': self.H,
-                'W': self.W,
-                'rays_o': rays['rays_o'],
-                'rays_d': rays['rays_d'],
+                'H': H,
+                'W': W,
+                'rays_o': rays_o,
+                'rays_d': rays_d,
                 'dir': dirs,
                 'fov': fov,
                 'poses': poses,
                 'intrinsics': intrinsics,
                 'shading': 'lambertian_df',
-                'light_dir': rays['rays_o']
+                'light_dir': rays_o
             }
         else:
             data = {
-                'H': self.H,
-                'W': self.W,
-                'rays_o': rays['rays_o'],
-                'rays_d': rays['rays_d'],
+                'H': H,
+                'W': W,
+                'rays_o': rays_o,
+                'rays_d': rays_d,
                 'dir': dirs,
                 'fov': fov,
                 'poses': poses,
@@ -256,8 +406,111 @@ class NeRFDataset:
 
         return data
 
+    def collate_batch(self, B, rng=None):
+        # B training views at once, each with the distribution of collate(): one batched rand_poses and get_rays call.
+        # rng: ViewRNG of the thread calling it, None for the global rngs
+        rng = ViewRNG() if rng is None else rng
+        M = B * ViewSampler.oversample if self.view_sampler is not None else B
+        samples = self.sampler.draw(M) if self.sampler is not None else None
+        # the direction buckets are always computed, they are only passed as 'dir' with dir_text
+        poses, buckets = rand_poses(M, self.device, radius_range=self.radius_range, return_dirs=True, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, jitter=True, samples=samples, rng=rng)
+        # poses, dirs = rand_poses(B, self.device, radius_range=self.radius_range, return_dirs=self.opt.dir_text, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, jitter=self.opt.jitter_pose)
+
+        if self.view_sampler is not None:
+            keep = rng.multinomial(self.view_sampler.weights()[buckets], B)
+            poses, buckets = poses[keep.to(poses.device)], buckets[keep]
+        dirs = buckets if self.opt.dir_text else None
+
+        # random focal per view, of the (H * patch_scale) x (W * patch_scale) virtual image
+        H, W = self.resolution
+        s = self.opt.patch_scale
+        fovs = rng.np.random(B) * (self.fovy_range[1] - self.fovy_range[0]) + self.fovy_range[0]
+        focals = H * s / (2 * np.tan(np.deg2rad(fovs) / 2))
+        intrinsics = np.stack([focals, focals, np.full(B, H * s / 2), np.full(B, W * s / 2)], axis=-1) # [B, 4]
+
+        if s > 1:
+            # an H x W patch of every virtual image, the views stay H x W images for the guidance
+            patches = [patch_indices(H, W, s, self.opt.patch_mode, self.device, rng) for _ in range(B)]
+            rays = get_rays(poses, intrinsics, H * s, W * s, inds=torch.stack([p[0] for p in patches]))
+        else:
+            rays = get_rays(poses, intrinsics, H, W, -1)
+
+        views = []
+        for b in range(B):
+            data = self.make_data(rays['rays_o'][b:b+1], rays['rays_d'][b:b+1], dirs[b:b+1] if dirs is not None else None, float(fovs[b]), poses[b:b+1], intrinsics[b], H, W)
+            data['bucket'] = int(buckets[b])
+            # s for a full view, less for a crop
+            data['patch_dilation'] = patches[b][1] if s > 1 else 1
+            views.append(data)
+        return views
 
     def dataloader(self):
+        if self.training and self.opt.prefetch_batch > 0:
+            return PrefetchLoader(self, batch=self.opt.prefetch_batch, buffer=self.opt.prefetch_buffer, seed=self.opt.seed)
         loader = DataLoader(list(range(self.size)), batch_size=1, collate_fn=self.collate, shuffle=self.training, num_workers=0)
         loader._data = self # an ugly fix... we need to access dataset in trainer.
-        return loader
\ No newline at end of file
+        return loader
+
+
+class PrefetchLoader:
+    ''' stands in for the training DataLoader of a NeRFDataset.
+    a background thread generates the random views `batch` at a time (NeRFDataset.collate_batch) into a ring buffer of
+    `buffer` ready batches, so the training loop only pops views that are already there.
+    yields the same dicts as collate(), len() and batch_size are those of the DataLoader it replaces.
+    '''
+    def __init__(self, dataset, batch=64, buffer=4, seed=None):
+        self._data = dataset
+        self.batch = batch
+        self.batch_size = 1
+        self.size = dataset.size
+
+        self.queue = queue.Queue(maxsize=buffer)
+        self.ready = [] # views of the batch being consumed
+        self.thread = None
+        # the producer thread's own generators, the global ones belong to the training loop
+        self.rng = ViewRNG(seed)
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return f"PrefetchLoader: size={self.size} batch={self.batch} buffer={self.queue.maxsize}"
+
+    def produce(self):
+        try:
+            while True:
+                # blocks while the buffer is full
+                self.queue.put(self._data.collate_batch(self.batch, self.rng))
+        except BaseException as e:
+            # handed to the training loop, raised by next()
+            self.queue.put(e)
+
+    def next(self):
+        if self.thread is None:
+            # started on first use
+            self.thread = threading.Thread(target=self.produce, daemon=True)
+            self.thread.start()
+        while True:
+            if len(self.ready) == 0:
+                self.ready = self.get()
+            data = self.ready.pop(0)
+            # views prefetched before a set_resolution() are stale
+            if (data['H'], data['W']) == self._data.resolution:
+                return data
+
+    def get(self):
+        while True:
+            try:
+                batch = self.queue.get(timeout=1)
+            except queue.Empty:
+                # the producer puts its exception before it exits, this only catches a thread killed without one
+                if not self.thread.is_alive() and self.queue.empty():
+                    raise RuntimeError('PrefetchLoader: the producer thread exited without a batch')
+                continue
+            if isinstance(batch, BaseException):
+                raise batch
+            return batch
+
+    def __iter__(self):
+        for _ in range(self.size):
+            yield self.next()
\ No newline at end of file
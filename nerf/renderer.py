@@ -393,6 +393,7 @@ class NeRFRenderer(nn.Module):
         alphas_shifted = torch.cat([torch.ones_like(alphas[..., :1]), 1 - alphas + 1e-15], dim=-1) # [N, T+t+1]
         weights = alphas * torch.cumprod(alphas_shifted, dim=-1)[..., :-1] # [N, T+t]
         results['weights'] = weights
+        results['num_samples'] = torch.full((N,), z_vals.shape[1], dtype=torch.int32, device=device) # [N], points per ray
 
         dirs = rays_d.view(-1, 1, 3).expand_as(xyzs)
         for k, v in density_outputs.items():
@@ -508,6 +509,7 @@ class NeRFRenderer(nn.Module):
 
             # weights normalization
             results['weights'] = weights
+            results['num_samples'] = rays[:, 2] # [N], points per ray
 
         else:
            
@@ -622,6 +624,7 @@ class NeRFRenderer(nn.Module):
         # convert to bitfield
         density_thresh = min(self.mean_density, self.density_thresh)
         self.density_bitfield = raymarching.packbits(self.density_grid, density_thresh, self.density_bitfield)
+        self.occupancy = (self.density_grid > density_thresh).float().mean() # on device, read by the telemetry
 
         ### update step counter
         total_step = min(16, self.local_step)
@@ -17,6 +17,8 @@ from torchvision import transforms
 # import torch.nn.functional as F
 import numpy as np
 
+from nerf.profiler import StepProfiler
+
 def spherical_dist_loss(x, y):
     x = F.normalize(x, dim=-1)
     y = F.normalize(y, dim=-1)
@@ -62,11 +64,10 @@ class StableDiffusion(nn.Module):
         # 1. Load the autoencoder model which will be used to decode the latents into image space. 
         self.vae = AutoencoderKL.from_pretrained(sd_name, subfolder="vae", use_auth_token=self.token, torch_dtype=torch.float16).to(self.device)
 
-        # 2. Load the tokenizer and text encoder to tokenize and encode the text. 
-        self.tokenizer = CLIPTokenizer.from_pretrained(sd_name, subfolder="tokenizer")
-        # self.tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
-        self.text_encoder = CLIPTextModel.from_pretrained(sd_name, subfolder="text_encoder").to(self.device)
-        # self.text_encoder = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14").to(self.device)
+        # 2. The tokenizer and text encoder to tokenize and encode the text are loaded on first use (see text_encoder),
+        # a run that finds all its prompts in the trainer's embedding cache never loads them.
+        self._tokenizer = None
+        self._text_encoder = None
 
         # 3. The UNet model for generating the latents.
         self.unet = UNet2DConditionModel.from_pretrained(sd_name, subfolder="unet", use_auth_token=self.token, torch_dtype=torch.float16).to(self.device)
@@ -92,8 +93,27 @@ class StableDiffusion(nn.Module):
             ])).float().cuda(non_blocking=True) # 4 x 3
         # self.rgb_to_latent = self.rgb_to_latent.T # 4 x 3
 
+        # disabled by default, the trainer replaces it with its own profiler
+        self.profiler = StepProfiler()
+
         print(f'[INFO] loaded stable diffusion!')
 
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = CLIPTokenizer.from_pretrained(self.sd_name, subfolder="tokenizer")
+            # self._tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
+        return self._tokenizer
+
+    @property
+    def text_encoder(self):
+        if self._text_encoder is None:
+            print(f'[INFO] loading stable diffusion text encoder...')
+            self._text_encoder = CLIPTextModel.from_pretrained(self.sd_name, subfolder="text_encoder").to(self.device)
+            # self._text_encoder = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14").to(self.device)
+            self._text_encoder.requires_grad_(False)
+        return self._text_encoder
+
     def get_text_embeds(self, prompt, negative_prompt, dir='front'):
         if True:
             # Tokenize text and get embeddings
@@ -127,7 +147,8 @@ class StableDiffusion(nn.Module):
         if use_vae:
             # interp to 512x512 to be fed into vae.
             pred_rgb_512 = F.interpolate(pred_rgb, (512, 512), mode='bilinear', align_corners=False)
-            latents = self.encode_imgs(pred_rgb_512)
+            with self.profiler.phase('guidance/vae_encode'):
+                latents = self.encode_imgs(pred_rgb_512)
         else:
             latents = pred_rgb.permute(0, 2, 3, 1) @ self.rgb_to_latent
             latents = F.interpolate(latents.permute(0, 3, 1, 2), (64, 64), mode='bilinear', align_corners=False)
@@ -142,7 +163,8 @@ class StableDiffusion(nn.Module):
                 # pred noise
                 latent_model_noisy_input = torch.cat([latents_noisy] * 2)
                 latent_model_noisy_input = latent_model_noisy_input.detach().requires_grad_()
-                noise_pred = self.unet(latent_model_noisy_input, t, encoder_hidden_states=text_embeddings).sample
+                with self.profiler.phase('guidance/unet'):
+                    noise_pred = self.unet(latent_model_noisy_input, t, encoder_hidden_states=text_embeddings).sample
 
             # perform guidance (high scale from paper!)
             noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
@@ -155,21 +177,23 @@ class StableDiffusion(nn.Module):
         sample = sample.detach().requires_grad_()
 
         sample = 1 / 0.18215 * sample
-        out_image = self.vae.decode(sample).sample
+        with self.profiler.phase('guidance/vae_decode'):
+            out_image = self.vae.decode(sample).sample
         out_image_ = (out_image / 2 + 0.5)#.clamp(0, 1)
 
-        out_image = self.resize(out_image_)
-        out_image = self.normalize(out_image)
+        with self.profiler.phase('guidance/clip'):
+            out_image = self.resize(out_image_)
+            out_image = self.normalize(out_image)
 
-        image_embeddings_clip = get_clip_img_embedding(out_image)
-        image_embeddings_clip = image_embeddings_clip / image_embeddings_clip.norm(p=2, dim=-1, keepdim=True)
-        loss_clip = 0
-        if image_ref_clip is not None:
-            loss_img = spherical_dist_loss(image_embeddings_clip, image_ref_clip).mean() * clip_guidance_scale * 50 # 100
-            loss_clip = loss_clip + loss_img
-            grads_clip = - torch.autograd.grad(loss_clip, sample, retain_graph=True)[0]
-        else:
-            grads_clip = 0
+            image_embeddings_clip = get_clip_img_embedding(out_image)
+            image_embeddings_clip = image_embeddings_clip / image_embeddings_clip.norm(p=2, dim=-1, keepdim=True)
+            loss_clip = 0
+            if image_ref_clip is not None:
+                loss_img = spherical_dist_loss(image_embeddings_clip, image_ref_clip).mean() * clip_guidance_scale * 50 # 100
+                loss_clip = loss_clip + loss_img
+                grads_clip = - torch.autograd.grad(loss_clip, sample, retain_graph=True)[0]
+            else:
+                grads_clip = 0
 
         with torch.no_grad():
             density = F.interpolate(density.detach(), (64, 64), mode='bilinear', align_corners=False)
@@ -189,9 +213,11 @@ class StableDiffusion(nn.Module):
         grad = w * (noise_pred.detach() - noise) + w * (grads_clip.detach()) # sds loss, plus clip grad
         grad = grad * spatial_weight / 2
         
-        latents.backward(gradient=grad, retain_graph=True)
+        with self.profiler.phase('guidance/vae_backward'):
+            latents.backward(gradient=grad, retain_graph=True)
 
-        return {'clip': torch.mean(grads_clip), 'sds': (noise_pred - noise).mean(), 'sjc': noise_pred.mean()} # dummy loss value
+        # grad: magnitude of the sds + clip gradient applied to the latents, tracked per view direction by the trainer
+        return {'clip': torch.mean(grads_clip), 'sds': (noise_pred - noise).mean(), 'sjc': noise_pred.mean(), 'grad': grad.detach().float().abs().mean()} # dummy loss value
 
     def produce_latents(self, text_embeddings, height=512, width=512, num_inference_steps=50, guidance_scale=7.5, latents=None):
 
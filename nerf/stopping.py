@@ -0,0 +1,70 @@
+import time
+
+
+class EarlyStopping:
+    ''' decides when Trainer.train can stop before max_epoch.
+    plateau: the monitored value is smoothed with an exponential moving average over the checks (one per epoch, or per
+    evaluation for the CLIP similarity), and training stops when it has not improved on its best by more than
+    min_delta (relative) for `patience` checks in a row.
+    budgets: max_secs of wall-clock since start(), max_rays rays rendered by the training steps. 0 disables each.
+    when nothing is enabled, should_stop() is always None and the other methods cost nothing.
+    '''
+    def __init__(self, mode='min', patience=0, min_delta=1e-3, smoothing=0.5, max_secs=0, max_rays=0):
+        self.mode = mode # min: losses, max: similarities
+        self.patience = patience
+        self.min_delta = min_delta
+        self.smoothing = smoothing
+        self.max_secs = max_secs
+        self.max_rays = max_rays
+        self.enabled = patience > 0 or max_secs > 0 or max_rays > 0
+
+        self.value = None # smoothed monitor
+        self.best = None
+        self.bad_checks = 0
+        self.rays = 0
+        self.t0 = time.time()
+
+    def __repr__(self):
+        return f"EarlyStopping: mode={self.mode} patience={self.patience} min_delta={self.min_delta} max_secs={self.max_secs} max_rays={self.max_rays}"
+
+    def start(self):
+        # the wall-clock budget counts from here
+        self.t0 = time.time()
+
+    def add_rays(self, num_rays):
+        # python int, called every training step
+        self.rays += num_rays
+
+    def update(self, value):
+        # value: float, the monitored value of this check. returns True if the smoothed value is a new best
+        if self.patience <= 0:
+            return False
+
+        self.value = value if self.value is None else self.smoothing * self.value + (1 - self.smoothing) * value
+        gain = self.value - self.best if self.best is not None else None
+        if self.mode == 'min' and gain is not None:
+            gain = - gain
+
+        if self.best is None or gain > self.min_delta * abs(self.best):
+            self.best = self.value
+            self.bad_checks = 0
+            return True
+
+        self.bad_checks += 1
+        return False
+
+    def over_budget(self):
+        # reason string if a budget is used up, else None
+        if self.max_secs > 0 and time.time() - self.t0 >= self.max_secs:
+            return f'wall-clock budget of {self.max_secs}s reached'
+        if self.max_rays > 0 and self.rays >= self.max_rays:
+            return f'compute budget of {self.max_rays} rays reached'
+        return None
+
+    def should_stop(self):
+        # reason string if training should stop, else None
+        if not self.enabled:
+            return None
+        if self.patience > 0 and self.bad_checks >= self.patience:
+            return f'plateau, no improvement over {self.min_delta:g} of the best {self.best:.6f} in {self.bad_checks} checks'
+        return self.over_budget()
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import resource
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+class Telemetry:
+    ''' machine-readable run performance, one json line per window of training steps.
+    the per-step records stay on the device (sample counts) or in cuda events (latencies), only flush() synchronizes.
+    when disabled, every method is a no-op.
+    a line holds:
+        steps_per_s, rays_per_s, queries_per_s: throughput over the window (queries = points composited by the renderer)
+        samples_per_ray_mean, samples_per_ray_max: from the renderer's num_samples
+        occupancy: fraction of occupied density grid cells (cuda_ray only)
+        latency_ms: mean time of each timer(), e.g. guidance
+        rss_peak_mb, cuda_*: host peak RSS and the cuda caching allocator stats, peaks are reset every window
+    '''
+    def __init__(self, path, device, enabled=True):
+        self.path = path
+        self.device = device
+        self.enabled = enabled
+        self.use_events = torch.cuda.is_available() and torch.device(device).type == 'cuda'
+        self.reset()
+
+    def __repr__(self):
+        return f"Telemetry: path={self.path} enabled={self.enabled}"
+
+    def reset(self):
+        self.steps = 0
+        self.rays = 0
+        self.samples = torch.zeros([], dtype=torch.float64, device=self.device)
+        self.samples_max = torch.zeros([], dtype=torch.int64, device=self.device)
+        self.timers = defaultdict(list) # name -> [(start, end)] cuda events, or [ms] on cpu
+        self.t0 = time.time()
+        if self.enabled and self.use_events:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def timer(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name)
+
+    @contextmanager
+    def _timer(self, name):
+        if self.use_events:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self.timers[name].append((start, end))
+        else:
+            t0 = time.perf_counter()
+            yield
+            self.timers[name].append((time.perf_counter() - t0) * 1000)
+
+    def record_render(self, num_rays, num_samples=None):
+        # num_samples: [N] int tensor of points per ray, as returned by the renderer
+        if not self.enabled:
+            return
+        self.rays += num_rays
+        if num_samples is not None:
+            num_samples = num_samples.detach()
+            self.samples += num_samples.sum()
+            self.samples_max = torch.maximum(self.samples_max, num_samples.max().long())
+
+    def step(self):
+        self.steps += 1
+
+    def flush(self, step, occupancy=None, **extra):
+        if not self.enabled or self.steps == 0:
+            return None
+
+        if self.use_events:
+            torch.cuda.synchronize(self.device)
+        elapsed = max(time.time() - self.t0, 1e-8)
+
+        samples = self.samples.item()
+        record = {
+            'step': step,
+            'time': time.time(),
+            'steps_per_s': self.steps / elapsed,
+            'rays_per_s': self.rays / elapsed,
+            'queries_per_s': samples / elapsed,
+            'samples_per_ray_mean': samples / max(self.rays, 1),
+            'samples_per_ray_max': self.samples_max.item(),
+            'occupancy': occupancy,
+            'latency_ms': {},
+            # ru_maxrss is in KB on linux
+            'rss_peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+        for name, times in self.timers.items():
+            if self.use_events:
+                times = [start.elapsed_time(end) for start, end in times]
+            record['latency_ms'][name] = sum(times) / len(times)
+
+        if self.use_events:
+            stats = torch.cuda.memory_stats(self.device)
+            record['cuda_allocated_mb'] = stats.get('allocated_bytes.all.current', 0) / 2**20
+            record['cuda_allocated_peak_mb'] = stats.get('allocated_bytes.all.peak', 0) / 2**20
+            record['cuda_reserved_mb'] = stats.get('reserved_bytes.all.current', 0) / 2**20
+            record['cuda_reserved_peak_mb'] = stats.get('reserved_bytes.all.peak', 0) / 2**20
+            record['cuda_alloc_retries'] = stats.get('num_alloc_retries', 0)
+            record['cuda_ooms'] = stats.get('num_ooms', 0)
+
+        record.update(extra)
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        self.reset()
+        return record
@@ -12,6 +12,8 @@ import pandas as pd
 
 import time
 from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import matplotlib.pyplot as plt
@@ -34,19 +36,29 @@ import numpy as np
 import cv2
 from PIL import Image
 
+_depth_luts = {} # (cmap, device) -> [256, 3] lut
+
 def visualize_depth(depth, cmap=cv2.COLORMAP_JET):
     """
-    depth: (H, W)
+    depth: (H, W) or (B, H, W), on any device
+    return: (3, H, W) or (B, 3, H, W) in [0, 1] on the same device, every frame normalized to its own min / max
     """
-    x = depth.cpu().numpy()
-    x = np.nan_to_num(x) # change nan to 0
-    mi = np.min(x) # get minimum depth
-    ma = np.max(x)
-    x = (x-mi)/(ma-mi+1e-8) # normalize to 0~1
-    x = (255*x).astype(np.uint8)
-    x_ = Image.fromarray(cv2.applyColorMap(x, cmap))
-    x_ = T.ToTensor()(x_) # (3, H, W)
-    return x_
+    key = (cmap, depth.device)
+    if key not in _depth_luts:
+        # the 256 colors of the cv2 colormap, channels kept in the order cv2 returns them
+        lut = cv2.applyColorMap(np.arange(256, dtype=np.uint8)[:, None], cmap)[:, 0] # [256, 3]
+        _depth_luts[key] = torch.from_numpy(lut).to(depth.device).float() / 255
+
+    batched = depth.dim() == 3
+    x = torch.nan_to_num(depth.float()) # change nan to 0
+    if not batched:
+        x = x.unsqueeze(0)
+    mi = x.amin(dim=(1, 2), keepdim=True) # get minimum depth
+    ma = x.amax(dim=(1, 2), keepdim=True)
+    x = (x - mi) / (ma - mi + 1e-8) # normalize to 0~1
+    x = (255 * x).long().clamp(0, 255)
+    x = _depth_luts[key][x].permute(0, 3, 1, 2).contiguous() # (B, 3, H, W)
+    return x if batched else x[0]
 
 def custom_meshgrid(*args):
     # ref: https://pytorch.org/docs/stable/generated/torch.meshgrid.html?highlight=meshgrid#torch.meshgrid
@@ -58,18 +70,38 @@ def custom_meshgrid(*args):
 def safe_normalize(x, eps=1e-20):
     return x / torch.sqrt(torch.clamp(torch.sum(x * x, -1, keepdim=True), min=eps))
 
+@lru_cache(maxsize=16)
+def camera_directions(H, W, fx, fy, cx, cy, device):
+    ''' camera space ray directions (z = 1 plane) of all pixels in row-major order, memoized per resolution / intrinsics / device.
+    Returns:
+        directions: [H*W, 3], shared by the callers, must not be modified in place
+    '''
+    i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device))
+    i = i.t().reshape([H*W]) + 0.5
+    j = j.t().reshape([H*W]) + 0.5
+
+    zs = torch.ones_like(i)
+    # xs = -(i - cx) / fx * zs
+    xs = (i - cx) / fx * zs
+    ys = (j - cy) / fy * zs
+    directions = torch.stack((xs, ys, zs), dim=-1)
+    # directions = safe_normalize(directions)
+    return directions
+
+
 <<<<<<< HEAD
 @torch.amp.autocast(device_type='cuda', enabled=False)
 =======
 @torch.amp.autocast("cuda", enabled=False)
 >>>>>>> repoB/main
-def get_rays(poses, intrinsics, H, W, N=-1, error_map=None):
+def get_rays(poses, intrinsics, H, W, N=-1, error_map=None, inds=None):
     ''' get rays
     Args:
         poses: [B, 4, 4], cam2world
-        intrinsics: [4]
+        intrinsics: [4], or [B, 4] for a different camera per pose
         H, W, N: int
         error_map: [B, 128 * 128], sample probability based on training error
+        inds: [B, N], the pixels to generate the rays of, overrides N and error_map
     Returns:
         rays_o, rays_d: [B, N, 3]
         inds: [B, N]
@@ -77,15 +109,28 @@ def get_rays(poses, intrinsics, H, W, N=-1, error_map=None):
 
     device = poses.device
     B = poses.shape[0]
-    fx, fy, cx, cy = intrinsics
 
-    i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device))
-    i = i.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
-    j = j.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
+    per_view = np.ndim(intrinsics) == 2
+    if per_view:
+        # pixel centers (u, v, 1) of the shared grid, mapped to ((u - cx) / fx, (v - cy) / fy, 1) per view below
+        intrinsics = torch.as_tensor(np.asarray(intrinsics), dtype=torch.float32, device=device) # [B, 4]
+        fx, fy, cx, cy = intrinsics.unbind(-1)
+        ones, zeros = torch.ones_like(fx), torch.zeros_like(fx)
+        scale = torch.stack([1 / fx, 1 / fy, ones], dim=-1).unsqueeze(1) # [B, 1, 3]
+        shift = torch.stack([- cx / fx, - cy / fy, zeros], dim=-1).unsqueeze(1) # [B, 1, 3]
+        directions = camera_directions(H, W, 1.0, 1.0, 0.0, 0.0, device) # [H*W, 3]
+    else:
+        fx, fy, cx, cy = intrinsics
+        # the pixel grid only depends on the camera, only the rotation below is per pose
+        directions = camera_directions(H, W, float(fx), float(fy), float(cx), float(cy), device) # [H*W, 3]
 
     results = {}
 
-    if N > 0:
+    if inds is not None:
+        directions = directions[inds] # [B, N, 3]
+        results['inds'] = inds
+
+    elif N > 0:
         N = min(N, H*W)
 
         if error_map is None:
@@ -105,19 +150,17 @@ def get_rays(poses, intrinsics, H, W, N=-1, error_map=None):
 
             results['inds_coarse'] = inds_coarse # need this when updating error_map
 
-        i = torch.gather(i, -1, inds)
-        j = torch.gather(j, -1, inds)
+        directions = directions[inds] # [B, N, 3]
 
         results['inds'] = inds
 
     else:
         inds = torch.arange(H*W, device=device).expand([B, H*W])
+        directions = directions.unsqueeze(0) # [1, H*W, 3]
+
+    if per_view:
+        directions = directions * scale + shift # [B, N, 3]
 
-    zs = torch.ones_like(i)
-    xs = (i - cx) / fx * zs
-    ys = (j - cy) / fy * zs
-    directions = torch.stack((xs, ys, zs), dim=-1)
-    # directions = safe_normalize(directions)
     rays_d = directions @ poses[:, :3, :3].transpose(-1, -2) # (B, N, 3)
 
     rays_o = poses[..., :3, 3] # [B, 3]
@@ -555,8 +598,17 @@ class Trainer(object):
         self.model.eval()
 
         if write_video:
-            all_preds = []
-            all_preds_depth = []
+            # frames are piped to ffmpeg as they are rendered, so encoding overlaps rendering and memory stays constant
+            writer_rgb = imageio.get_writer(os.path.join(save_path, f'{name}_rgb.mp4'), fps=25, quality=8, macro_block_size=1)
+            writer_depth = imageio.get_writer(os.path.join(save_path, f'{name}_depth.mp4'), fps=25, quality=8, macro_block_size=1)
+        else:
+            # png encoding releases the GIL, frames are written by a pool while the next ones render
+            def write_frame(i, pred, pred_depth):
+                cv2.imwrite(os.path.join(save_path, f'{name}_{i:04d}_rgb.png'), cv2.cvtColor(pred, cv2.COLOR_RGB2BGR))
+                cv2.imwrite(os.path.join(save_path, f'{name}_{i:04d}_depth.png'), pred_depth)
+
+            frame_writer = ThreadPoolExecutor(max_workers=4)
+            pending = []
 
         with torch.no_grad():
 
@@ -572,20 +624,23 @@ class Trainer(object):
                 pred_depth = (pred_depth * 255).astype(np.uint8)
 
                 if write_video:
-                    all_preds.append(pred)
-                    all_preds_depth.append(pred_depth)
+                    writer_rgb.append_data(pred)
+                    writer_depth.append_data(pred_depth)
                 else:
-                    cv2.imwrite(os.path.join(save_path, f'{name}_{i:04d}_rgb.png'), cv2.cvtColor(pred, cv2.COLOR_RGB2BGR))
-                    cv2.imwrite(os.path.join(save_path, f'{name}_{i:04d}_depth.png'), pred_depth)
+                    pending.append(frame_writer.submit(write_frame, i, pred, pred_depth))
+                    # a bounded number of frames in flight, if the disk is slower than rendering
+                    if len(pending) > 8:
+                        pending.pop(0).result()
 
                 pbar.update(loader.batch_size)
 
         if write_video:
-            all_preds = np.stack(all_preds, axis=0)
-            all_preds_depth = np.stack(all_preds_depth, axis=0)
-            
-            imageio.mimwrite(os.path.join(save_path, f'{name}_rgb.mp4'), all_preds, fps=25, quality=8, macro_block_size=1)
-            imageio.mimwrite(os.path.join(save_path, f'{name}_depth.mp4'), all_preds_depth, fps=25, quality=8, macro_block_size=1)
+            writer_rgb.close()
+            writer_depth.close()
+        else:
+            for future in pending:
+                future.result()
+            frame_writer.shutdown()
 
         self.log(f"==> Finished Test.")
     
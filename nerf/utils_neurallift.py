@@ -1,5 +1,7 @@
 import os, pdb
+import copy
 import glob
+import json
 import tqdm
 import math
 import imageio
@@ -11,7 +13,11 @@ import numpy as np
 import pandas as pd
 
 import time
+import queue
+import threading
 from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import matplotlib.pyplot as plt
@@ -34,7 +40,13 @@ import numpy as np
 import cv2
 from PIL import Image
 
-from nerf.provider import rand_poses
+from nerf.utils import visualize_depth
+from nerf.provider import rand_poses, patch_indices, PoseSampler
+from nerf.profiler import StepProfiler
+from nerf.telemetry import Telemetry
+from nerf.stopping import EarlyStopping
+from nerf.embedding_cache import EmbeddingCache
+from gridencoder import suggest_log2_hashmap_size, compress_embeddings
 # from nerf.diffaug import DiffAugment
 
 from torch_efficient_distloss import eff_distloss
@@ -42,19 +54,78 @@ from torch_efficient_distloss import eff_distloss
 from kornia.losses import ssim_loss, inverse_depth_smoothness_loss, total_variation
 from kornia.filters import gaussian_blur2d
 
-def visualize_depth(depth, cmap=cv2.COLORMAP_JET):
-    """
-    depth: (H, W)
-    """
-    x = depth.cpu().numpy()
-    x = np.nan_to_num(x) # change nan to 0
-    mi = np.min(x) # get minimum depth
-    ma = np.max(x)
-    x = (x-mi)/(ma-mi+1e-8) # normalize to 0~1
-    x = (255*x).astype(np.uint8)
-    x_ = Image.fromarray(cv2.applyColorMap(x, cmap))
-    x_ = T.ToTensor()(x_) # (3, H, W)
-    return x_
+# optional, model weights are also written as mmap-able .safetensors next to each .pth
+try:
+    from safetensors.torch import save_file as save_safetensors
+except ImportError:
+    save_safetensors = None
+
+_safetensors_dtypes = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8, 'BOOL': torch.bool,
+}
+
+def mmap_safetensors(path):
+    ''' the tensors of a .safetensors file as views of one private (copy-on-write) memory map of it, nothing is read
+    until it is used, and processes mapping the same file share its page cache. safe_open().get_tensor() copies instead.
+    Returns:
+        tensors: dict of cpu tensors
+        metadata: dict of str
+    '''
+    with open(path, 'rb') as f:
+        header_size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_size))
+    metadata = header.pop('__metadata__', None) or {}
+
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)[8 + header_size:]
+
+    tensors = {}
+    for k, v in header.items():
+        dtype = _safetensors_dtypes[v['dtype']]
+        start, end = v['data_offsets']
+        x = data[start:end]
+        # a view needs the offset aligned to the element size, safetensors does not pad between tensors
+        if (8 + header_size + start) % torch.empty(0, dtype=dtype).element_size() != 0:
+            x = x.clone()
+        tensors[k] = x.view(dtype).view(v['shape'])
+    return tensors, metadata
+
+
+class ImageLogger:
+    ''' writes tensorboard images from a background thread.
+    add() only enqueues, when the queue is full the image is dropped instead of blocking the training step.
+    '''
+    def __init__(self, writer, maxsize=8):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def full(self):
+        return self.queue.full()
+
+    def add(self, tag, image, step):
+        # image: (3, H, W) tensor on any device, the worker copies it to the host
+        try:
+            self.queue.put_nowait((tag, image.detach(), step))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            tag, image, step = item
+            self.writer.add_image(tag, image.float().cpu(), step)
+
+    def close(self):
+        # writes what is still queued, then stops the worker
+        self.queue.put(None)
+        self.thread.join()
+
 
 def custom_meshgrid(*args):
     # ref: https://pytorch.org/docs/stable/generated/torch.meshgrid.html?highlight=meshgrid#torch.meshgrid
@@ -66,18 +137,38 @@ def custom_meshgrid(*args):
 def safe_normalize(x, eps=1e-20):
     return x / torch.sqrt(torch.clamp(torch.sum(x * x, -1, keepdim=True), min=eps))
 
+@lru_cache(maxsize=16)
+def camera_directions(H, W, fx, fy, cx, cy, device):
+    ''' camera space ray directions (normalized, z = 1 plane) of all pixels in row-major order, memoized per resolution / intrinsics / device.
+    Returns:
+        directions: [H*W, 3], shared by the callers, must not be modified in place
+    '''
+    i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device))
+    i = i.t().reshape([H*W]) + 0.5
+    j = j.t().reshape([H*W]) + 0.5
+
+    zs = torch.ones_like(i)
+    # xs = -(i - cx) / fx * zs
+    xs = (i - cx) / fx * zs
+    ys = (j - cy) / fy * zs
+    directions = torch.stack((xs, ys, zs), dim=-1)
+    directions = safe_normalize(directions)
+    return directions
+
+
 <<<<<<< HEAD
 @torch.amp.autocast(device_type='cuda', enabled=False)
 =======
 @torch.amp.autocast("cuda", enabled=False)
 >>>>>>> repoB/main
-def get_rays(poses, intrinsics, H, W, N=-1, error_map=None):
+def get_rays(poses, intrinsics, H, W, N=-1, error_map=None, inds=None):
     ''' get rays
     Args:
         poses: [B, 4, 4], cam2world
         intrinsics: [4]
         H, W, N: int
         error_map: [B, 128 * 128], sample probability based on training error
+        inds: [B, N], the pixels to generate the rays of, overrides N and error_map
     Returns:
         rays_o, rays_d: [B, N, 3]
         inds: [B, N]
@@ -87,13 +178,16 @@ def get_rays(poses, intrinsics, H, W, N=-1, error_map=None):
     B = poses.shape[0]
     fx, fy, cx, cy = intrinsics
 
-    i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device))
-    i = i.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
-    j = j.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
+    # the pixel grid only depends on the camera, only the rotation below is per pose
+    directions = camera_directions(H, W, float(fx), float(fy), float(cx), float(cy), device) # [H*W, 3]
 
     results = {}
 
-    if N > 0:
+    if inds is not None:
+        directions = directions[inds] # [B, N, 3]
+        results['inds'] = inds
+
+    elif N > 0:
         N = min(N, H*W)
 
         if error_map is None:
@@ -113,20 +207,14 @@ def get_rays(poses, intrinsics, H, W, N=-1, error_map=None):
 
             results['inds_coarse'] = inds_coarse # need this when updating error_map
 
-        i = torch.gather(i, -1, inds)
-        j = torch.gather(j, -1, inds)
+        directions = directions[inds] # [B, N, 3]
 
         results['inds'] = inds
 
     else:
         inds = torch.arange(H*W, device=device).expand([B, H*W])
+        directions = directions.unsqueeze(0) # [1, H*W, 3]
 
-    zs = torch.ones_like(i)
-    # xs = -(i - cx) / fx * zs
-    xs = (i - cx) / fx * zs
-    ys = (j - cy) / fy * zs
-    directions = torch.stack((xs, ys, zs), dim=-1)
-    directions = safe_normalize(directions)
     rays_d = directions @ poses[:, :3, :3].transpose(-1, -2) # (B, N, 3)
 
     rays_o = poses[..., :3, 3] # [B, 3]
@@ -193,6 +281,33 @@ def prepare(im, h, w, interp=None):
         return cv2.resize(im, (128, 128), interp)
     return cv2.resize(im, (128, 128))
 
+class MetricAccumulator:
+    ''' running sums of per-step scalars, kept on the device. nothing is copied to the host until flush(). '''
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, name, value):
+        # value: scalar tensor or python number
+        if torch.is_tensor(value):
+            value = value.detach().float()
+        self.sums[name] = self.sums[name] + value if name in self.sums else value
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def flush(self):
+        # means since the last flush, all tensors are copied to the host with a single sync
+        means = {k: v / self.counts[k] for k, v in self.sums.items() if not torch.is_tensor(v)}
+        tensors = {k: v for k, v in self.sums.items() if torch.is_tensor(v)}
+        if len(tensors) > 0:
+            values = torch.stack(list(tensors.values())).cpu().tolist()
+            means.update({k: v / self.counts[k] for k, v in zip(tensors.keys(), values)})
+
+        self.sums.clear()
+        self.counts.clear()
+
+        return means
+
+
 class Trainer(object):
     def __init__(self, 
                  name, # name of this experiment
@@ -254,6 +369,15 @@ class Trainer(object):
         for p in self.clip.parameters():
             p.requires_grad = False
 
+        # reference view targets per training resolution, see prepare_reference().
+        # the render stage (h, w, num_steps, upsample_steps) follows opt.render_schedule, set by update_stage() during training
+        self.references = {}
+        self.stage = None
+        self.train_dataset = None
+
+        # text and reference image embeddings on disk, shared across runs. empty opt.embedding_cache to always encode
+        self.embedding_cache = EmbeddingCache(self.opt.embedding_cache)
+
         # text prompt
         if self.guidance is not None:
             
@@ -286,6 +410,53 @@ class Trainer(object):
 
         self.scaler = torch.cuda.amp.GradScaler(enabled=self.fp16)
 
+        # quasi-random poses of the shading views resampled in train_step, a separate sequence from the dataset's
+        self.pose_sampler = PoseSampler(seed=self.opt.seed + 1) if self.opt.pose_sampler == 'sobol' else None
+
+        # camera and rays of the fixed front (reference) view, generated on its first use in train_step.
+        # the rays are only cached for opt.patch_scale 1, patches of the reference view are drawn per step
+        self.front_pose, self.front_intrinsics = None, None
+        self.front_rays = None
+
+        # running per-pixel residual of the reference view on the 128 x 128 grid of get_rays,
+        # warmup steps render opt.front_error_rays pixels drawn from it instead of the full image
+        self.error_map = torch.ones(1, 128 * 128, device=self.device)
+
+        # per direction bucket error of the training views, owned by the train dataset and set in train()
+        self.view_sampler = None
+
+        # train images are written by a background thread, created with the tensorboard writer in train()
+        self.image_logger = None
+
+        # per-phase step timers, no-ops unless opt.profile. the guidance times its own sub-phases with the same profiler
+        self.profiler = StepProfiler(enabled=self.opt.profile, window=self.opt.profile_interval, trace_range=self.opt.profile_trace, trace_dir=os.path.join(self.workspace if self.workspace is not None else '.', 'profile'))
+        if self.guidance is not None:
+            self.guidance.profiler = self.profiler
+
+        # throughput / memory telemetry, one json line per opt.telemetry_interval steps in <workspace>/telemetry.jsonl
+        self.telemetry = Telemetry(os.path.join(self.workspace if self.workspace is not None else '.', 'telemetry.jsonl'), self.device, enabled=self.opt.telemetry_interval > 0 and self.workspace is not None and self.local_rank == 0)
+
+        # training losses, flushed to the log / tensorboard every opt.log_interval steps
+        self.train_metrics = MetricAccumulator()
+
+        # stops train() on a plateau of opt.early_stop_monitor or when the wall-clock / rays budget is used up
+        self.stopping = EarlyStopping(mode='max' if self.opt.early_stop_monitor == 'clip' else 'min', patience=self.opt.early_stop_patience, min_delta=self.opt.early_stop_min_delta, max_secs=self.opt.max_train_secs, max_rays=self.opt.max_train_rays)
+        # reference view loss of the front steps since the last check, and the CLIP similarity of the last validation renders to the prompt
+        self.ref_metrics = MetricAccumulator()
+        self.valid_clip = None
+
+        # checkpoints are snapshotted to cpu on the training thread and written by this one in the background
+        self.ckpt_writer = ThreadPoolExecutor(max_workers=1)
+        self.ckpt_future = None
+        self.ckpt_skipped = 0 # steps a due cadence checkpoint waited for the previous write
+        self.last_ckpt_time = time.time()
+
+        # with opt.async_eval, validation renders a snapshot of the weights on this thread, on its own cuda stream.
+        # the results are recorded by the training thread (record_evaluation), which owns the logs, writer and stats
+        self.valid_worker = ThreadPoolExecutor(max_workers=1)
+        self.valid_future = None
+        self.valid_stream = torch.cuda.Stream(self.device) if self.opt.async_eval and torch.cuda.is_available() else None
+
         # variable init
         self.epoch = 0
         self.global_step = 0
@@ -295,6 +466,7 @@ class Trainer(object):
             "valid_loss": [],
             "results": [], # metrics[0], or valid_loss
             "checkpoints": [], # record path of saved ckpt, to automatically remove old ckpt
+            "step_checkpoints": [], # the same for the step / wall-clock cadence, rotated separately
             "best_result": None,
         }
 
@@ -347,8 +519,8 @@ class Trainer(object):
             return
 
         if not self.opt.dir_text:
-            self.text_z = self.guidance.get_text_embeds([self.opt.text], [self.opt.negative])
-            self.text_z_clip = self.clip.get_text_embeds(self.opt.text)
+            self.text_z = self.sd_text_embeds(self.opt.text, self.opt.negative)
+            self.text_z_clip = self.clip_text_embeds(self.opt.text)
         else:
             self.text_z = []
             self.text_z_clip = []
@@ -368,20 +540,66 @@ class Trainer(object):
                     elif d == 'overhead': negative_text += "bottom view"
                     elif d == 'bottom': negative_text += "overhead view"
 
-                text_z = self.guidance.get_text_embeds([text], [negative_text], dir=d)
-                text_z_clip = self.clip.get_text_embeds(text)
+                text_z = self.sd_text_embeds(text, negative_text, d)
+                text_z_clip = self.clip_text_embeds(text)
                 self.text_z.append(text_z)
                 self.text_z_clip.append(text_z_clip)
-            text_z = self.guidance.get_text_embeds([self.opt.text], [f"{self.opt.negative}"], dir=d)
-            text_z_clip = self.clip.get_text_embeds(self.opt.text)
+            text_z = self.sd_text_embeds(self.opt.text, f"{self.opt.negative}", d)
+            text_z_clip = self.clip_text_embeds(self.opt.text)
             self.text_z.append(text_z)
             self.text_z_clip.append(text_z_clip)
 
+        self.prepare_reference(*self.render_stage(0)[:2])
+
+        if self.embedding_cache.enabled:
+            # the log file isn't open yet
+            print(f'[INFO] embedding cache {self.embedding_cache.root}: {self.embedding_cache.hits} hits, {self.embedding_cache.misses} encoded')
+
+    def sd_text_embeds(self, text, negative_text, d='front'):
+        # [uncond, cond] guidance embeddings of a prompt, through the embedding cache
+        parts = ['sd_text', getattr(self.guidance, 'sd_name', type(self.guidance).__name__), text, negative_text]
+        return self.embedding_cache.get(parts, lambda: self.guidance.get_text_embeds([text], [negative_text], dir=d), self.device)
+
+    def clip_text_embeds(self, text):
+        return self.embedding_cache.get(['clip_text', self.clip.clip_name, text], lambda: self.clip.get_text_embeds(text), self.device)
+
+    def render_stage(self, global_step):
+        # render_schedule: [[iter, h, w, num_steps, upsample_steps], ...], the last entry with iter <= global_step wins.
+        # before the first entry (or with an empty schedule) the h, w, num_steps and upsample_steps of the config
+        stage = (self.opt.h, self.opt.w, self.opt.num_steps, self.opt.upsample_steps)
+        for it, *values in sorted(self.opt.render_schedule):
+            if global_step >= it:
+                stage = tuple(int(v) for v in values)
+        return stage
+
+    def update_stage(self):
+        # coarse-to-fine training resolution and samples per ray, called every training step
+        stage = self.render_stage(self.global_step)
+        if stage == self.stage:
+            return
+        self.stage = stage
+        h, w, num_steps, upsample_steps = stage
+        self.prepare_reference(h, w)
+        # the front camera depends on the resolution, regenerated on its next use
+        self.front_pose, self.front_intrinsics = None, None
+        self.front_rays = None
+        if self.train_dataset is not None:
+            self.train_dataset.set_resolution(h, w)
+        self.log(f"[INFO] render stage at step {self.global_step}: {h}x{w}, num_steps={num_steps}, upsample_steps={upsample_steps}")
+
+    def prepare_reference(self, h, w):
+        # reference view targets (rgb, mask, depth) for an h x w training resolution, cached per resolution
+        if (h, w) in self.references:
+            for k, v in self.references[(h, w)].items():
+                setattr(self, k, v)
+            return
 
         mask = cv2.imread(self.opt.mask_path, 0) / 255
         mask[mask > 0.5] = 1
         mask[mask < 0.5] = 0
-        mask = prepare(mask, self.opt.h, self.opt.w, cv2.INTER_NEAREST)
+        # the reference is kept at the resolution of the virtual image the training patches are taken from
+        H, W = h * self.opt.patch_scale, w * self.opt.patch_scale
+        mask = prepare(mask, H, W, cv2.INTER_NEAREST)
         # mask = cv2.resize(mask, (self.opt.h, self.opt.w), interpolation = cv2.INTER_NEAREST)
         mask = torch.from_numpy(mask).float()
         self.fg_mask_2d = mask.cuda().unsqueeze(0).unsqueeze(0) # 1, 1, h, w
@@ -389,41 +607,67 @@ class Trainer(object):
         im = Image.open(self.opt.rgb_path).convert('RGB')
         # im = im.resize((self.opt.h, self.opt.w))
         im = np.array(im)
-        im = prepare(im, self.opt.h, self.opt.w)
+        im = prepare(im, H, W)
         # im = im[:, :, :-1] #rgba
         self.rgb = torch.tensor(im, requires_grad=False).float().permute(2, 0, 1).unsqueeze(0) / 255#.unsqueeze(0)
         self.rgb = self.rgb.cuda() # 1, 3, h, w
         self.rgb = self.rgb * self.fg_mask_2d
         self.rgb_unmasked = self.rgb.clone()
-        self.rgb_clip_embed = self.clip.get_img_embeds(self.rgb_unmasked)
+        # keyed by the prepared image itself, so the source files, mask and resolution are all part of the key
+        parts = ['clip_image', self.clip.clip_name, EmbeddingCache.hash_tensor(self.rgb_unmasked)]
+        self.rgb_clip_embed = self.embedding_cache.get(parts, lambda: self.clip.get_img_embeds(self.rgb_unmasked), self.device)
 
         if 'npy' in self.opt.depth_path:
             im = np.load(self.opt.depth_path)
         else:
             raise NotImplementedError
-        im = prepare(im, self.opt.h, self.opt.w, cv2.INTER_NEAREST)
+        im = prepare(im, H, W, cv2.INTER_NEAREST)
         self.depth = torch.FloatTensor(im).float()#.unsqueeze(0)
         self.depth = self.depth.cuda() # h, w
         self.depth = self.depth * self.fg_mask_2d # make bg region depth 0
         print('depth nonzero range', self.depth.min(), self.depth[self.depth > 0].min(), self.depth.max())
         tee = self.depth.reshape(-1)
-        self.fg_idx = tee.nonzero()
-        # fg_depth = tee
-        tee = tee[self.fg_idx]
-        # print('?????', self.fg_idx.shape, tee.shape, self.depth.reshape(-1).shape)
-        tee = tee.reshape(1, -1)
-        self.rank_loss_target = (tee - tee.T).sign().reshape(-1)
-
-    def margin_rank_loss(self, depth):
+        self.fg_idx = tee.nonzero().squeeze(-1) # [n]
+        # reference depth of the fg pixels, the ranking targets are built from it per step instead of storing n^2 signs
+        self.fg_depth = tee[self.fg_idx] # [n]
+
+        self.references[(h, w)] = {k: getattr(self, k) for k in ['fg_mask_2d', 'rgb', 'rgb_unmasked', 'rgb_clip_embed', 'depth', 'fg_idx', 'fg_depth']}
+
+    def margin_rank_loss(self, depth, inds=None):
         # high res, only calc on fg
-        output = depth.squeeze().view(-1)
-        output = output[self.fg_idx]
-        num = output.shape[0] # [n, 1]
-        # print(num)
-        output = output.reshape(1, -1)
-        o1 = output.expand(num, -1).reshape(-1)
-        o2 = output.T.expand(-1, num).reshape(-1)
-        return F.margin_ranking_loss(o1, o2, self.rank_loss_target)
+        # mean of max(0, -sign(ref_j - ref_i) * (d_j - d_i)) over the ordered pairs (i, j) of fg pixels.
+        # with opt.rank_loss_pairs > 0 every pixel is paired with that many random partners, an unbiased estimate of the
+        # all-pairs mean in O(n * pairs) memory. 0 uses all n^2 pairs.
+        # inds: [1, N] pixel indices if depth only holds those pixels, pairs with a bg pixel are left out
+        if inds is None:
+            output = depth.reshape(-1)[self.fg_idx] # [n]
+            ref = self.fg_depth
+        else:
+            output = depth.reshape(-1) # [N]
+            ref = self.depth.reshape(-1)[inds.reshape(-1)] # [N], 0 in bg
+        num = output.shape[0]
+        if self.opt.rank_loss_pairs > 0:
+            i = torch.arange(num, device=output.device).repeat_interleave(self.opt.rank_loss_pairs)
+            j = torch.randint(0, num, (num * self.opt.rank_loss_pairs,), device=output.device)
+        else:
+            i = torch.arange(num, device=output.device).repeat_interleave(num)
+            j = torch.arange(num, device=output.device).repeat(num)
+        target = (ref[j] - ref[i]).sign()
+        if inds is None:
+            return F.margin_ranking_loss(output[j], output[i], target)
+        fg = ((ref[i] > 0) & (ref[j] > 0)).float()
+        return ((- target * (output[j] - output[i])).clamp(min=0) * fg).sum() / fg.sum().clamp(min=1)
+
+    @torch.no_grad()
+    def update_error_map(self, residual, inds_coarse=None, decay=0.9):
+        # residual: [1, 1, H, W] of the full reference view, or [1, 1, N] at the inds_coarse cells get_rays sampled
+        residual = residual.float()
+        if inds_coarse is None:
+            residual = F.interpolate(residual, (128, 128), mode='nearest').reshape(1, -1)
+            self.error_map.mul_(decay).add_((1 - decay) * residual)
+        else:
+            inds_coarse = inds_coarse.reshape(-1)
+            self.error_map[0, inds_coarse] = decay * self.error_map[0, inds_coarse] + (1 - decay) * residual.reshape(-1)
     
     def __del__(self):
         if self.log_ptr: 
@@ -448,94 +692,140 @@ class Trainer(object):
         else:
             self.front_view = False
 
-        if self.front_view:
-            # horizontal, front view
-            poses, dirs = rand_poses(1, self.device, radius_range=[self.opt.init_radius, self.opt.init_radius], return_dirs=self.opt.dir_text, theta_range=[self.opt.init_theta, self.opt.init_theta], phi_range=[180, 180], jitter=False, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, uniform_sphere_rate=0)
-            fov = self.opt.front_fov
-            focal = self.opt.h / (2 * np.tan(np.deg2rad(fov) / 2))
-            intrinsics = np.array([focal, focal, self.opt.h / 2, self.opt.w / 2])
-            rays = get_rays(poses, intrinsics, self.opt.h, self.opt.w, -1)
-            rays_o = rays['rays_o'].cuda() # [B, N, 3]
-            rays_d = rays['rays_d'].cuda() # [B, N, 3]
-            shading = 'albedo'
-            ambient_ratio = 1.0
-            l_p = 0
-            l_a = 1
-
-            B, N = rays_o.shape[:2]
-            H, W = data['H'], data['W']
-            data['dir'] = 0
-        else:
-            rays_o = data['rays_o'] # [B, N, 3]
-            rays_d = data['rays_d'] # [B, N, 3]
-
-            B, N = rays_o.shape[:2]
-            H, W = data['H'], data['W']
-
-            if random.random() < self.opt.ref_perturb_prob:
-                # near by view
-                poses, dirs = rand_poses(1, self.device, radius_range=[self.opt.init_radius, self.opt.init_radius], return_dirs=self.opt.dir_text, theta_range=[self.opt.init_theta, self.opt.init_theta], phi_range=[180, 180], jitter=True, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, uniform_sphere_rate=0)
-                # poses += torch.randn(3, device=rays_o.device, dtype=torch.float)
-                fov = random.random() * (self.opt.fovy_range[1] - self.opt.fovy_range[0]) + self.opt.fovy_range[0]
-                focal = self.opt.h / (2 * np.tan(np.deg2rad(fov) / 2))
-                intrinsics = np.array([focal, focal, self.opt.h / 2, self.opt.w / 2])
-                rays = get_rays(poses, intrinsics, self.opt.h, self.opt.w, -1)
+        # reference pixels rendered by this step if it is not the full image, and the error map cells they came from
+        front_inds = None
+        front_inds_coarse = None
+        # False if the rendered pixels don't form an image (the error driven reference pixels)
+        is_image = True
+        # the view is a crop of a virtual image (opt.patch_mode multiscale), not comparable to the whole reference
+        crop = False
+        s = self.opt.patch_scale
+        # render stage of opt.render_schedule
+        h, w, num_steps, upsample_steps = self.stage
+        # direction bucket of the rendered view, if it is the dataset's view
+        bucket = None
+
+        with self.profiler.phase('rays'):
+            if self.front_view:
+                # horizontal, front view. the pose and fov are fixed, so its rays are only generated once.
+                # with opt.patch_scale > 1 the camera is that of the s times larger virtual image of the reference
+                if self.front_pose is None:
+                    poses, dirs = rand_poses(1, self.device, radius_range=[self.opt.init_radius, self.opt.init_radius], return_dirs=self.opt.dir_text, theta_range=[self.opt.init_theta, self.opt.init_theta], phi_range=[180, 180], jitter=False, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, uniform_sphere_rate=0)
+                    fov = self.opt.front_fov
+                    focal = h * s / (2 * np.tan(np.deg2rad(fov) / 2))
+                    intrinsics = np.array([focal, focal, h * s / 2, w * s / 2])
+                    self.front_pose, self.front_intrinsics = poses, intrinsics
+                    if s == 1:
+                        self.front_rays = get_rays(poses, intrinsics, h, w, -1)
+                if self.epoch <= self.opt.warmup_epoch and self.opt.front_error_rays > 0:
+                    # no guidance during warmup, so only the reference pixels are rendered, drawn by their residual.
+                    # the floor keeps every pixel reachable
+                    rays = get_rays(self.front_pose, self.front_intrinsics, h * s, w * s, self.opt.front_error_rays, error_map=self.error_map + 0.1 * self.error_map.mean())
+                    front_inds, front_inds_coarse = rays['inds'], rays['inds_coarse']
+                    is_image = False
+                elif s > 1:
+                    # every s-th reference pixel from a random offset, the full view at h x w
+                    front_inds = patch_indices(h, w, s, 'dilated', self.device)[0].unsqueeze(0) # [1, h*w]
+                    rays = get_rays(self.front_pose, self.front_intrinsics, h * s, w * s, inds=front_inds)
+                else:
+                    rays = self.front_rays
                 rays_o = rays['rays_o'].cuda() # [B, N, 3]
                 rays_d = rays['rays_d'].cuda() # [B, N, 3]
-                data['dir'] = dirs
-
-            if self.global_step < self.opt.albedo_iters:
                 shading = 'albedo'
                 ambient_ratio = 1.0
                 l_p = 0
                 l_a = 1
-            else: 
-                rand = random.random()
-                if rand < self.opt.p_albedo:
-                    shading = 'albedo'
-                    ambient_ratio = 1.0
-                    l_a = torch.ones(3, device=rays_o.device, dtype=torch.float)
-                    l_p = torch.zeros(3, device=rays_o.device, dtype=torch.float)
-                else:
-                    # re-sample pose for normal (low resolution)
-                    if random.random() < self.opt.ref_perturb_prob:
-                        # near by view
-                        poses, dirs = rand_poses(1, self.device, radius_range=[self.opt.init_radius, self.opt.init_radius], return_dirs=self.opt.dir_text, theta_range=[self.opt.init_theta, self.opt.init_theta], phi_range=[180, 180], jitter=True, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, uniform_sphere_rate=0)
-                        # poses += torch.randn(3, device=rays_o.device, dtype=torch.float)
-                        data['dir'] = dirs
-                    else:
-                        poses, dirs = rand_poses(1, self.device, radius_range=[self.opt.radius_range[0], np.mean(self.opt.radius_range)], return_dirs=self.opt.dir_text, jitter=True, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, uniform_sphere_rate=0.5)
-                        data['dir'] = dirs
-                    fov = data['fov']
-                    focal = self.opt.normal_shape / (2 * np.tan(np.deg2rad(fov) / 2))
-                    intrinsics = np.array([focal, focal, self.opt.normal_shape / 2, self.opt.normal_shape / 2])
-                    rays = get_rays(poses, intrinsics, self.opt.normal_shape, self.opt.normal_shape, -1)
+
+                B, N = rays_o.shape[:2]
+                H, W = h, w
+                data['dir'] = 0
+            else:
+                rays_o = data['rays_o'] # [B, N, 3]
+                rays_d = data['rays_d'] # [B, N, 3]
+                bucket = data.get('bucket')
+                crop = data.get('patch_dilation', s) < s
+
+                B, N = rays_o.shape[:2]
+                H, W = data['H'], data['W']
+
+                if random.random() < self.opt.ref_perturb_prob:
+                    # near by view
+                    poses, dirs = rand_poses(1, self.device, radius_range=[self.opt.init_radius, self.opt.init_radius], return_dirs=self.opt.dir_text, theta_range=[self.opt.init_theta, self.opt.init_theta], phi_range=[180, 180], jitter=True, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, uniform_sphere_rate=0)
+                    # poses += torch.randn(3, device=rays_o.device, dtype=torch.float)
+                    fov = random.random() * (self.opt.fovy_range[1] - self.opt.fovy_range[0]) + self.opt.fovy_range[0]
+                    focal = h / (2 * np.tan(np.deg2rad(fov) / 2))
+                    intrinsics = np.array([focal, focal, h / 2, w / 2])
+                    rays = get_rays(poses, intrinsics, h, w, -1)
                     rays_o = rays['rays_o'].cuda() # [B, N, 3]
                     rays_d = rays['rays_d'].cuda() # [B, N, 3]
+                    data['dir'] = dirs
+                    bucket = None
+                    crop = False
+                    H, W = h, w
 
-                    H, W = self.opt.normal_shape, self.opt.normal_shape
-                    # shading is on
-                    l_a = torch.zeros(3, device=rays_o.device, dtype=torch.float) + 0.1
-                    l_p = torch.zeros(3, device=rays_o.device, dtype=torch.float) + 0.9
-                    if random.random() > self.opt.p_textureless:
-                        shading = 'lambertian_df'
-                        ambient_ratio = random.random() * 0.6 + 0.1
+                if self.global_step < self.opt.albedo_iters:
+                    shading = 'albedo'
+                    ambient_ratio = 1.0
+                    l_p = 0
+                    l_a = 1
+                else: 
+                    rand = random.random()
+                    if rand < self.opt.p_albedo:
+                        shading = 'albedo'
+                        ambient_ratio = 1.0
+                        l_a = torch.ones(3, device=rays_o.device, dtype=torch.float)
+                        l_p = torch.zeros(3, device=rays_o.device, dtype=torch.float)
                     else:
-                        shading = 'textureless'
-                        ambient_ratio = 0
-
-
-        if self.front_view:
-            bg_color = None
-        else:
+                        # re-sample pose for normal (low resolution)
+                        if random.random() < self.opt.ref_perturb_prob:
+                            # near by view
+                            poses, dirs = rand_poses(1, self.device, radius_range=[self.opt.init_radius, self.opt.init_radius], return_dirs=self.opt.dir_text, theta_range=[self.opt.init_theta, self.opt.init_theta], phi_range=[180, 180], jitter=True, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, uniform_sphere_rate=0)
+                            # poses += torch.randn(3, device=rays_o.device, dtype=torch.float)
+                            data['dir'] = dirs
+                        else:
+                            samples = self.pose_sampler.draw(1) if self.pose_sampler is not None else None
+                            poses, dirs = rand_poses(1, self.device, radius_range=[self.opt.radius_range[0], np.mean(self.opt.radius_range)], return_dirs=self.opt.dir_text, jitter=True, angle_overhead=self.opt.angle_overhead, angle_front=self.opt.angle_front, uniform_sphere_rate=0.5, samples=samples)
+                            data['dir'] = dirs
+                        fov = data['fov']
+                        focal = self.opt.normal_shape / (2 * np.tan(np.deg2rad(fov) / 2))
+                        intrinsics = np.array([focal, focal, self.opt.normal_shape / 2, self.opt.normal_shape / 2])
+                        rays = get_rays(poses, intrinsics, self.opt.normal_shape, self.opt.normal_shape, -1)
+                        rays_o = rays['rays_o'].cuda() # [B, N, 3]
+                        rays_d = rays['rays_d'].cuda() # [B, N, 3]
+                        bucket = None
+                        crop = False
+
+                        H, W = self.opt.normal_shape, self.opt.normal_shape
+                        # shading is on
+                        l_a = torch.zeros(3, device=rays_o.device, dtype=torch.float) + 0.1
+                        l_p = torch.zeros(3, device=rays_o.device, dtype=torch.float) + 0.9
+                        if random.random() > self.opt.p_textureless:
+                            shading = 'lambertian_df'
+                            ambient_ratio = random.random() * 0.6 + 0.1
+                        else:
+                            shading = 'textureless'
+                            ambient_ratio = 0
+
+
+        with self.profiler.phase('render'):
+            if self.front_view:
+                bg_color = None
+            else:
+                bg_color = torch.rand((B * N, 3), device=rays_o.device) # pixel-wise random
+            # original light_d is None
+            light_d = None
+            outputs = self.model.render(rays_o, rays_d, staged=False, perturb=True, bg_color=bg_color, ambient_ratio=ambient_ratio, shading=shading, force_all_rays=True, light_d=light_d, l_a=l_a, l_p=l_p, **dict(vars(self.opt), num_steps=num_steps, upsample_steps=upsample_steps))
+            self.telemetry.record_render(B * N, outputs.get('num_samples'))
+            self.stopping.add_rays(B * N)
             bg_color = torch.rand((B * N, 3), device=rays_o.device) # pixel-wise random
-        # original light_d is None
-        light_d = None
-        outputs = self.model.render(rays_o, rays_d, staged=False, perturb=True, bg_color=bg_color, ambient_ratio=ambient_ratio, shading=shading, force_all_rays=True, light_d=light_d, l_a=l_a, l_p=l_p, **vars(self.opt))
-        bg_color = torch.rand((B * N, 3), device=rays_o.device) # pixel-wise random
 
-        pred_rgb = outputs['image'].reshape(B, H, W, 3).permute(0, 3, 1, 2).contiguous() # [1, 3, H, W]
-        pred_depth = outputs['depth'].reshape(B, H, W, 1).permute(0, 3, 1, 2).contiguous()
+            if is_image:
+                pred_rgb = outputs['image'].reshape(B, H, W, 3).permute(0, 3, 1, 2).contiguous() # [1, 3, H, W]
+                pred_depth = outputs['depth'].reshape(B, H, W, 1).permute(0, 3, 1, 2).contiguous()
+            else:
+                # only the pixels at front_inds
+                pred_rgb = outputs['image'].permute(0, 2, 1).contiguous() # [1, 3, N]
+                pred_depth = outputs['depth'].unsqueeze(1) # [1, 1, N]
 
         # text embeddings
         if self.opt.dir_text:
@@ -553,9 +843,9 @@ class Trainer(object):
         ww = {}
 
         # occupancy loss
-        pred_ws = outputs['weights_sum'].reshape(B, 1, H, W)
+        pred_ws = outputs['weights_sum'].reshape(B, 1, *pred_depth.shape[2:]) # [B, 1, H, W] or [B, 1, N]
 
-        if (np.random.random() < self.opt.p_randbg and shading != 'textureless'):
+        if (np.random.random() < self.opt.p_randbg and shading != 'textureless' and is_image):
             # use rand bg
             bg_color = torch.ones_like(pred_rgb) * (torch.rand((B, 3, 1, 1), device=rays_o.device) * 0.6 + 0.2)
             pred_rgb = pred_rgb * pred_ws + bg_color * (1 - pred_ws)
@@ -563,130 +853,146 @@ class Trainer(object):
         image_ref_clip = self.rgb_clip_embed
 
         if self.epoch > self.opt.warmup_epoch:
-            pred_rgb_sd = pred_rgb
-            if self.front_view:
-                sd = self.guidance.train_step(self.text_z[0], pred_rgb_sd, image_ref_clip=image_ref_clip, get_clip_img_embedding=self.clip.get_img_embeds, text_z_clip=self.text_z_clip[0], density=pred_ws, clip_guidance_scale=100 if shading != 'textureless' else 0)
-                # sd = 0
-            else:
-                if data['dir'] == 0:
-                    # front
-                    sd = self.guidance.train_step(text_z, pred_rgb_sd, image_ref_clip=image_ref_clip, get_clip_img_embedding=self.clip.get_img_embeds, text_z_clip=text_z_clip, density=pred_ws, clip_guidance_scale=100 if shading != 'textureless' else 0)
-                elif data['dir'] == 2:
-                    # back
-                    sd = self.guidance.train_step(text_z, pred_rgb_sd, image_ref_clip=image_ref_clip, get_clip_img_embedding=self.clip.get_img_embeds, text_z_clip=text_z_clip, clip_guidance_scale=50 if shading != 'textureless' else 0, guidance_scale=100, density=pred_ws)
-                else:
-                    # side
-                    sd = self.guidance.train_step(text_z, pred_rgb_sd, image_ref_clip=image_ref_clip, get_clip_img_embedding=self.clip.get_img_embeds, text_z_clip=text_z_clip, clip_guidance_scale=50 if shading != 'textureless' else 0, guidance_scale=100, density=pred_ws)
-            ww['clip'] = sd['clip'].item()
-            ww['sds'] = sd['sds'].item()
-            ww['sjc'] = sd['sjc'].item()
-            if self.opt.lambda_opacity > 0:
-                loss_opacity = (pred_ws ** 2).mean()
-                ww['opacity'] = loss_opacity.item()
-                if loss_opacity >= 0.5:
-                    loss = loss + self.opt.lambda_opacity * 10 * loss_opacity
+            with self.profiler.phase('guidance'), self.telemetry.timer('guidance'):
+                pred_rgb_sd = pred_rgb
+                if self.front_view:
+                    sd = self.guidance.train_step(self.text_z[0], pred_rgb_sd, image_ref_clip=image_ref_clip, get_clip_img_embedding=self.clip.get_img_embeds, text_z_clip=self.text_z_clip[0], density=pred_ws, clip_guidance_scale=100 if shading != 'textureless' else 0)
+                    # sd = 0
                 else:
-                    loss = loss + self.opt.lambda_opacity * loss_opacity
-
-            if self.opt.lambda_entropy > 0:
-                alphas = (pred_ws).clamp(1e-5, 1 - 1e-5)
-                # alphas = alphas ** 2 # skewed entropy, favors 0 over 1
-                loss_entropy = (- alphas * torch.log2(alphas) - (1 - alphas) * torch.log2(1 - alphas)).mean()
-                ww['entropy'] = loss_entropy.item()
+                    if data['dir'] == 0:
+                        # front
+                        sd = self.guidance.train_step(text_z, pred_rgb_sd, image_ref_clip=image_ref_clip, get_clip_img_embedding=self.clip.get_img_embeds, text_z_clip=text_z_clip, density=pred_ws, clip_guidance_scale=100 if shading != 'textureless' else 0)
+                    elif data['dir'] == 2:
+                        # back
+                        sd = self.guidance.train_step(text_z, pred_rgb_sd, image_ref_clip=image_ref_clip, get_clip_img_embedding=self.clip.get_img_embeds, text_z_clip=text_z_clip, clip_guidance_scale=50 if shading != 'textureless' else 0, guidance_scale=100, density=pred_ws)
+                    else:
+                        # side
+                        sd = self.guidance.train_step(text_z, pred_rgb_sd, image_ref_clip=image_ref_clip, get_clip_img_embedding=self.clip.get_img_embeds, text_z_clip=text_z_clip, clip_guidance_scale=50 if shading != 'textureless' else 0, guidance_scale=100, density=pred_ws)
+            ww['clip'] = sd['clip'].detach()
+            ww['sds'] = sd['sds'].detach()
+            ww['sjc'] = sd['sjc'].detach()
+            if bucket is not None and self.view_sampler is not None:
+                self.view_sampler.update(bucket, sd['grad'])
+            with self.profiler.phase('losses'):
+                if self.opt.lambda_opacity > 0:
+                    loss_opacity = (pred_ws ** 2).mean()
+                    ww['opacity'] = loss_opacity.detach()
+                    # x10 above 0.5, as a tensor op so the step doesn't wait on the value
+                    loss = loss + self.opt.lambda_opacity * torch.where(loss_opacity >= 0.5, 10 * loss_opacity, loss_opacity)
+
+                if self.opt.lambda_entropy > 0:
+                    alphas = (pred_ws).clamp(1e-5, 1 - 1e-5)
+                    # alphas = alphas ** 2 # skewed entropy, favors 0 over 1
+                    loss_entropy = (- alphas * torch.log2(alphas) - (1 - alphas) * torch.log2(1 - alphas)).mean()
+                    ww['entropy'] = loss_entropy.detach()
                         
-                loss = loss + self.opt.lambda_entropy * loss_entropy
+                    loss = loss + self.opt.lambda_entropy * loss_entropy
 
-            if self.opt.lambda_orient > 0 and 'loss_orient' in outputs:
-                loss_orient = outputs['loss_orient']
-                ww['orient'] = loss_orient.item()
-                if self.global_step < 3000:
-                    orient_weight = self.global_step / 3000 * (self.opt.lambda_orient - 1e-4) + 1e-4
+                if self.opt.lambda_orient > 0 and 'loss_orient' in outputs:
+                    loss_orient = outputs['loss_orient']
+                    ww['orient'] = loss_orient.detach()
+                    if self.global_step < 3000:
+                        orient_weight = self.global_step / 3000 * (self.opt.lambda_orient - 1e-4) + 1e-4
+                    else:
+                        orient_weight = self.opt.lambda_orient      
+                    # x5 above 1e-2
+                    loss = loss + orient_weight * torch.where(loss_orient > 1e-2, 5 * loss_orient, loss_orient)
+
+                if self.opt.lambda_smooth > 0 and 'loss_smooth' in outputs:
+                    loss_smooth = outputs['loss_smooth']
+                    ww['smooth'] = loss_smooth.detach()
+                    loss = loss + self.opt.lambda_smooth * loss_smooth
+
+                if self.opt.lambda_blur > 0 and 'normals' in outputs:
+                    normals = outputs['normals'].reshape(B, 3, self.opt.normal_shape, self.opt.normal_shape)
+                    with torch.no_grad():
+                        normals_blur = gaussian_blur2d(normals, (9, 9), (3, 3))
+                    loss_blur = (normals - normals_blur).square().mean()
+                    ww['normals_blur'] = loss_blur.detach()
+                    loss = loss + self.opt.lambda_blur * loss_blur
+
+        with self.profiler.phase('losses'):
+            if self.front_view:
+                if front_inds is None:
+                    fg_mask, rgb_ref = self.fg_mask_2d, self.rgb
                 else:
-                    orient_weight = self.opt.lambda_orient      
-                if loss_orient.item() > 1e-2:
-                    orient_weight *= 5
-                loss = loss + orient_weight * loss_orient
-
-            if self.opt.lambda_smooth > 0 and 'loss_smooth' in outputs:
-                loss_smooth = outputs['loss_smooth']
-                ww['smooth'] = loss_smooth.item()
-                loss = loss + self.opt.lambda_smooth * loss_smooth
-
-            if self.opt.lambda_blur > 0 and 'normals' in outputs:
-                normals = outputs['normals'].reshape(B, 3, self.opt.normal_shape, self.opt.normal_shape)
-                with torch.no_grad():
-                    normals_blur = gaussian_blur2d(normals, (9, 9), (3, 3))
-                loss_blur = (normals - normals_blur).square().mean()
-                ww['normals_blur'] = loss_blur.item()
-                loss = loss + self.opt.lambda_blur * loss_blur
-
-        if self.front_view:
-            if self.epoch <= self.opt.warmup_epoch:
-                mask_ws = outputs['mask'].reshape(B, H, W) # near < far
-                l_rgb = torch.mean(torch.abs(pred_rgb * self.fg_mask_2d - self.rgb * self.fg_mask_2d))
-                l_depth = self.margin_rank_loss((pred_depth * self.fg_mask_2d).squeeze()) * 10
-                l_ssim = 0
+                    fg_mask = self.fg_mask_2d.reshape(1, 1, -1)[..., front_inds[0]] # [1, 1, N]
+                    rgb_ref = self.rgb.reshape(1, 3, -1)[..., front_inds[0]] # [1, 3, N]
+                    if is_image:
+                        fg_mask, rgb_ref = fg_mask.reshape(1, 1, H, W), rgb_ref.reshape(1, 3, H, W)
+                if self.epoch <= self.opt.warmup_epoch:
+                    l_rgb = torch.mean(torch.abs(pred_rgb * fg_mask - rgb_ref * fg_mask))
+                    l_depth = self.margin_rank_loss((pred_depth * fg_mask).squeeze(), front_inds) * 10
+                    l_ssim = 0
+                else:
+                    l_rgb = torch.mean(torch.abs(pred_rgb * fg_mask - rgb_ref * fg_mask))
+                    l_depth = self.margin_rank_loss((pred_depth * fg_mask).squeeze(), front_inds) * 10
+                l_density = torch.sum(pred_ws * (1 - fg_mask)) / torch.sum(1 - fg_mask).clamp(min=1)
+                l_density = torch.where(l_density > 0.05, l_density * 10, l_density)
+                if self.opt.front_error_rays > 0:
+                    # color error in the fg, leaked density in the bg
+                    residual = torch.abs(pred_rgb - rgb_ref).mean(1, keepdim=True) * fg_mask + pred_ws * (1 - fg_mask)
+                    self.update_error_map(residual.detach(), front_inds_coarse)
+                ww['density'] = l_density.detach()
+                if not isinstance(l_rgb, int):
+                    ww['front_rgb'] = l_rgb.detach()
+                # if not isinstance(l_ssim, int):
+                #     ww['front_ssim'] = l_ssim.detach()
+                if not isinstance(l_depth, int):
+                    ww['front_depth'] = l_depth.detach()
+                loss = loss + l_rgb * self.opt.ref_rgb_weight + l_depth + l_density
+            pred_rgb_aug = pred_rgb
+            # CLIP loss
+            if self.epoch > self.opt.warmup_epoch and (not self.front_view):
+                l_clip = 0
+
+                if data['dir'] == 0 and not crop:
+                    l_clip_img = self.clip.img_loss(self.rgb_clip_embed, pred_rgb_aug)
+                    ww['clip_img'] = l_clip_img.detach()
+                    # front, use CLIP loss
+                    l_clip = l_clip + l_clip_img * self.opt.clip_img_weight
             else:
-                l_rgb = torch.mean(torch.abs(pred_rgb * self.fg_mask_2d - self.rgb * self.fg_mask_2d))
-                l_depth = self.margin_rank_loss((pred_depth * self.fg_mask_2d).squeeze()) * 10
-            l_density = torch.sum(pred_ws * (1 - self.fg_mask_2d)) / torch.sum(1 - self.fg_mask_2d)
-            if l_density > 0.05:
-                l_density = l_density * 10
-            ww['density'] = l_density.item()
-            if not isinstance(l_rgb, int):
-                ww['front_rgb'] = l_rgb.item()
-            # if not isinstance(l_ssim, int):
-            #     ww['front_ssim'] = l_ssim.item()
-            if not isinstance(l_depth, int):
-                ww['front_depth'] = l_depth.item()
-            loss = loss + l_rgb * self.opt.ref_rgb_weight + l_depth + l_density
-        pred_rgb_aug = pred_rgb
-        # CLIP loss
-        if self.epoch > self.opt.warmup_epoch and (not self.front_view):
-            l_clip = 0
-
-            if data['dir'] == 0:
-                l_clip_img = self.clip.img_loss(self.rgb_clip_embed, pred_rgb_aug)
-                ww['clip_img'] = l_clip_img.item()
-                # front, use CLIP loss
-                l_clip = l_clip + l_clip_img * self.opt.clip_img_weight
-        else:
-            l_clip = 0
+                l_clip = 0
             
 
 
-        if self.global_step % 10 == 0:
-            pred_depth = outputs['depth'].reshape(B, H, W, 1).permute(0, 3, 1, 2).contiguous()
-            with torch.no_grad():
-                im = pred_rgb
-                self.writer.add_image('train/img', im[0], self.global_step)
-                if self.front_view:
-                    self.writer.add_image('train/front_img', im[0], self.global_step)
-                depth = pred_depth.squeeze()
-                depth = visualize_depth(depth)
-                if self.front_view:
-                    self.writer.add_image('train/front_depth', depth, self.global_step)
-                self.writer.add_image('train/depth', depth, self.global_step)
-
-        idx = outputs['weights_sum'] > 1e-4
-        loss_dist = eff_distloss(outputs['weights'][idx], outputs['midpoint'][idx], outputs['deltas'][idx])
-        ww['distortion'] = loss_dist.item()
-        # if data['dir'] == 0:
-        if self.front_view:
-            loss_depth_smooth = inverse_depth_smoothness_loss(pred_depth, pred_rgb_aug.float()) * self.opt.front_dsmooth_amplify
-        else:
-            loss_depth_smooth = inverse_depth_smoothness_loss(pred_depth, pred_rgb_aug.float())
-        ww['depth_smooth'] = loss_depth_smooth.item()
-        loss = loss + l_clip + loss_depth_smooth
-        if self.epoch <= self.opt.warmup_epoch:
-            # pass
-            loss = loss + loss_dist * self.opt.distortion * self.opt.front_dist_amplify
-        elif self.front_view:
-            loss = loss + loss_dist * self.opt.distortion * self.opt.front_dist_amplify
-        elif data['dir'] == 0 or data['dir'] == 2:
-            loss = loss + loss_dist * self.opt.distortion
-        else:
-            loss = loss + loss_dist * self.opt.distortion
+            # colorized on the device and handed to the image logger thread, skipped while its queue is full
+            if self.global_step % 10 == 0 and self.image_logger is not None and not self.image_logger.full() and is_image:
+                pred_depth = outputs['depth'].reshape(B, H, W, 1).permute(0, 3, 1, 2).contiguous()
+                with torch.no_grad():
+                    im = pred_rgb.detach()
+                    self.image_logger.add('train/img', im[0], self.global_step)
+                    if self.front_view:
+                        self.image_logger.add('train/front_img', im[0], self.global_step)
+                    depth = pred_depth.detach().squeeze()
+                    depth = visualize_depth(depth)
+                    if self.front_view:
+                        self.image_logger.add('train/front_depth', depth, self.global_step)
+                    self.image_logger.add('train/depth', depth, self.global_step)
+
+            # mean over the rays with weights_sum > 1e-4. masking the weights instead of indexing avoids a sync on the number of rays
+            mask = (outputs['weights_sum'] > 1e-4).float()
+            loss_dist = eff_distloss(outputs['weights'] * mask.unsqueeze(-1), outputs['midpoint'], outputs['deltas']) * mask.numel() / mask.sum().clamp(min=1)
+            ww['distortion'] = loss_dist.detach()
+            # if data['dir'] == 0:
+            if not is_image:
+                # needs an image, not defined on the pixel subset
+                loss_depth_smooth = torch.zeros([], device=rays_o.device)
+            elif self.front_view:
+                loss_depth_smooth = inverse_depth_smoothness_loss(pred_depth, pred_rgb_aug.float()) * self.opt.front_dsmooth_amplify
+            else:
+                loss_depth_smooth = inverse_depth_smoothness_loss(pred_depth, pred_rgb_aug.float())
+            ww['depth_smooth'] = loss_depth_smooth.detach()
+            loss = loss + l_clip + loss_depth_smooth
+            if self.epoch <= self.opt.warmup_epoch:
+                # pass
+                loss = loss + loss_dist * self.opt.distortion * self.opt.front_dist_amplify
+            elif self.front_view:
+                loss = loss + loss_dist * self.opt.distortion * self.opt.front_dist_amplify
+            elif data['dir'] == 0 or data['dir'] == 2:
+                loss = loss + loss_dist * self.opt.distortion
+            else:
+                loss = loss + loss_dist * self.opt.distortion
 
         return pred_rgb, ww, loss
 
@@ -700,7 +1006,8 @@ class Trainer(object):
             self.scaler.unscale_(self.optimizer)
             self.model.encoder.grad_total_variation(lambda_tv, None, self.model.bound)
 
-    def eval_step(self, data):
+    def eval_step(self, data, model=None):
+        model = self.model if model is None else model
 
         rays_o = data['rays_o'] # [B, N, 3]
         rays_d = data['rays_d'] # [B, N, 3]
@@ -712,7 +1019,7 @@ class Trainer(object):
         ambient_ratio = data['ambient_ratio'] if 'ambient_ratio' in data else 1.0
         light_d = data['light_d'] if 'light_d' in data else None
 
-        outputs = self.model.render(rays_o, rays_d, staged=True, perturb=False, bg_color=None, light_d=light_d, ambient_ratio=ambient_ratio, shading=shading, force_all_rays=True, **vars(self.opt))
+        outputs = model.render(rays_o, rays_d, staged=True, perturb=False, bg_color=None, light_d=light_d, ambient_ratio=ambient_ratio, shading=shading, force_all_rays=True, **vars(self.opt))
         pred_rgb = outputs['image'].reshape(B, H, W, 3)
         pred_depth = outputs['depth'].reshape(B, H, W)
 
@@ -768,8 +1075,16 @@ class Trainer(object):
 
         if self.use_tensorboardX and self.local_rank == 0:
             self.writer = tensorboardX.SummaryWriter(os.path.join(self.workspace, "run", self.name))
+            self.image_logger = ImageLogger(self.writer)
+
+        # the train dataset draws its views by the direction errors this trainer reports
+        self.view_sampler = getattr(train_loader._data, 'view_sampler', None)
+        # and generates them at the resolution of the render stage
+        self.train_dataset = train_loader._data
+        self.train_dataset.set_resolution(*self.render_stage(self.global_step)[:2])
 
         start_t = time.time()
+        self.stopping.start()
         
         for epoch in range(self.epoch + 1, max_epochs + 1):
             self.epoch = epoch
@@ -777,18 +1092,53 @@ class Trainer(object):
 
             self.train_one_epoch(train_loader)
 
-            if self.workspace is not None and self.local_rank == 0:
+            # per epoch, unless a step / wall-clock cadence is set
+            if self.workspace is not None and self.local_rank == 0 and self.opt.ckpt_interval_steps <= 0 and self.opt.ckpt_interval_secs <= 0:
                 self.save_checkpoint(full=True, best=False)
 
-            if self.epoch % self.eval_interval == 0:
-                self.evaluate_one_epoch(valid_loader)
-                self.save_checkpoint(full=False, best=True)
+            evaluated = self.epoch % self.eval_interval == 0
+            if evaluated:
+                if self.opt.async_eval and self.world_size == 1:
+                    # results and the best checkpoint are reported from the validation thread
+                    self.evaluate_async(valid_loader)
+                else:
+                    self.evaluate_one_epoch(valid_loader)
+                    self.save_checkpoint(full=False, best=True)
+            # a background validation that finished during this epoch
+            self.wait_validation(block=False)
+
+            if self.stopping.enabled:
+                reason = self.early_stop()
+                if reason is not None:
+                    self.log(f"[INFO] stopping at epoch {self.epoch}, step {self.global_step}: {reason}")
+                    self.wait_validation()
+                    # the best checkpoint includes the final state
+                    if not evaluated:
+                        self.evaluate_one_epoch(valid_loader)
+                        self.save_checkpoint(full=False, best=True)
+                    break
 
         end_t = time.time()
 
         self.log(f"[INFO] training takes {(end_t - start_t)/ 60:.4f} minutes.")
 
+        self.wait_validation()
+        # the final state, whatever the checkpoint cadence and however the loop ended
+        if self.workspace is not None and self.local_rank == 0:
+            self.save_checkpoint(full=True, best=False)
+        self.wait_checkpoint()
+        if self.ckpt_skipped > 0:
+            self.log(f"[INFO] a due checkpoint was skipped at {self.ckpt_skipped} steps, the previous write was still running.")
+        self.profiler.close()
+
+        if self.opt.backbone == 'grid_finite' and self.opt.compress_dtype != 'none' and self.workspace is not None and self.local_rank == 0:
+            self.export_compressed()
+
         if self.use_tensorboardX and self.local_rank == 0:
+            self.image_logger.close()
+            if self.image_logger.dropped > 0:
+                self.log(f"[INFO] dropped {self.image_logger.dropped} train images, the image logger was behind.")
+            self.image_logger = None
             self.writer.close()
 
     def evaluate(self, loader, name=None):
@@ -812,8 +1162,17 @@ class Trainer(object):
         self.model.eval()
 
         if write_video:
-            all_preds = []
-            all_preds_depth = []
+            # frames are piped to ffmpeg as they are rendered, so encoding overlaps rendering and memory stays constant
+            writer_rgb = imageio.get_writer(os.path.join(save_path, f'{name}_rgb.mp4'), fps=25, quality=8, macro_block_size=1)
+            writer_depth = imageio.get_writer(os.path.join(save_path, f'{name}_depth.mp4'), fps=25, quality=8, macro_block_size=1)
+        else:
+            # png encoding releases the GIL, frames are written by a pool while the next ones render
+            def write_frame(i, pred, pred_depth):
+                cv2.imwrite(os.path.join(save_path, f'{name}_{i:04d}_rgb.png'), cv2.cvtColor(pred, cv2.COLOR_RGB2BGR))
+                cv2.imwrite(os.path.join(save_path, f'{name}_{i:04d}_depth.png'), pred_depth)
+
+            frame_writer = ThreadPoolExecutor(max_workers=4)
+            pending = []
 
         with torch.no_grad():
 
@@ -826,27 +1185,111 @@ class Trainer(object):
                 pred = (pred * 255).astype(np.uint8)
 
                 # pred_depth = preds_depth[0].detach().cpu().numpy()
+                # colorized and quantized on the device, only the uint8 frame is copied
                 pred_depth = visualize_depth(preds_depth[0])
-                pred_depth = (pred_depth * 255).cpu().permute(1, 2, 0).numpy().astype(np.uint8)
+                pred_depth = (pred_depth * 255).round().byte().permute(1, 2, 0).cpu().numpy()
 
                 if write_video:
-                    all_preds.append(pred)
-                    all_preds_depth.append(pred_depth)
+                    writer_rgb.append_data(pred)
+                    writer_depth.append_data(pred_depth)
                 else:
-                    cv2.imwrite(os.path.join(save_path, f'{name}_{i:04d}_rgb.png'), cv2.cvtColor(pred, cv2.COLOR_RGB2BGR))
-                    cv2.imwrite(os.path.join(save_path, f'{name}_{i:04d}_depth.png'), pred_depth)
+                    pending.append(frame_writer.submit(write_frame, i, pred, pred_depth))
+                    # a bounded number of frames in flight, if the disk is slower than rendering
+                    if len(pending) > 8:
+                        pending.pop(0).result()
 
                 pbar.update(loader.batch_size)
 
         if write_video:
-            all_preds = np.stack(all_preds, axis=0)
-            all_preds_depth = np.stack(all_preds_depth, axis=0)
-            
-            imageio.mimwrite(os.path.join(save_path, f'{name}_rgb.mp4'), all_preds, fps=25, quality=8, macro_block_size=1)
-            imageio.mimwrite(os.path.join(save_path, f'{name}_depth.mp4'), all_preds_depth, fps=25, quality=8, macro_block_size=1)
+            writer_rgb.close()
+            writer_depth.close()
+        else:
+            for future in pending:
+                future.result()
+            frame_writer.shutdown()
 
         self.log(f"==> Finished Test.")
     
+    def early_stop(self):
+        # feeds this epoch's monitor to the stopping controller, returns the reason to stop or None
+        ref = self.ref_metrics.flush().get('ref')
+        if self.opt.early_stop_monitor == 'clip':
+            # the latest evaluation not seen yet, asynchronous ones arrive an epoch or more later
+            value, self.valid_clip = self.valid_clip, None
+        else:
+            value = ref
+        if value is not None:
+            self.stopping.update(value)
+        reason = self.stopping.should_stop()
+
+        if self.world_size > 1:
+            # every rank stops if one does
+            flag = torch.tensor([reason is not None], dtype=torch.float32, device=self.device)
+            dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+            if flag.item() > 0 and reason is None:
+                reason = 'stopped by another rank'
+        return reason
+
+    def snapshot_model(self):
+        # frozen copy of the (ema) weights with the epoch / step it was taken at, for evaluate_one_epoch(snapshot=)
+        if self.ema is not None:
+            self.ema.store()
+            self.ema.copy_to()
+
+        model = copy.deepcopy(self.model).eval()
+
+        if self.ema is not None:
+            self.ema.restore()
+
+        for p in model.parameters():
+            p.requires_grad_(False)
+            p.grad = None
+
+        return model, self.epoch, self.global_step
+
+    def evaluate_async(self, loader):
+        # validation of a snapshot on the validation thread while training goes on, at most one in flight
+        self.wait_validation()
+        snapshot = self.snapshot_model()
+        self.log(f"++> Evaluate {self.workspace} at epoch {self.epoch} in the background ...")
+        if self.valid_stream is not None:
+            # the copy was made on the training stream
+            self.valid_stream.wait_stream(torch.cuda.current_stream(self.device))
+        self.valid_future = self.valid_worker.submit(self._evaluate_snapshot, loader, snapshot)
+
+    def _evaluate_snapshot(self, loader, snapshot):
+        # runs on the validation thread, touches no state of the trainer
+        with torch.cuda.stream(self.valid_stream):
+            result = self.evaluate_one_epoch(loader, snapshot=snapshot)
+            if self.valid_stream is not None:
+                # the snapshot is used by the training thread from here on
+                self.valid_stream.synchronize()
+        return result, snapshot
+
+    def wait_validation(self, block=True):
+        # record the pending asynchronous validation and save its best checkpoint, once done.
+        # block=False returns at once if it is still running
+        if self.valid_future is None or not (block or self.valid_future.done()):
+            return
+        future, self.valid_future = self.valid_future, None
+        try:
+            result, snapshot = future.result()
+        except Exception as e:
+            self.log(f"[WARN] validation failed: {e}")
+            return
+        self.record_evaluation(result)
+        self.save_checkpoint(full=False, best=True, snapshot=snapshot)
+
+    def optimizer_step(self):
+        # a dense optimizer decays every row of the hash table, the levels update_level has not activated keep their values.
+        # the lazy sparse step never touches them
+        inactive = self.model.inactive_embeddings() if self.opt.backbone == 'grid_finite' and not self.opt.sparse_grad else None
+        frozen = inactive.clone() if inactive is not None else None
+        self.scaler.step(self.optimizer)
+        if frozen is not None:
+            inactive.copy_(frozen)
+        self.scaler.update()
+
     # [GUI] train text step.
     def train_gui(self, train_loader, epoch, step=100):
 
@@ -855,6 +1298,13 @@ class Trainer(object):
         self.guidance.set_epoch(epoch)
 
         total_loss = torch.tensor([0], dtype=torch.float32, device=self.device)
+
+        self.train_dataset = train_loader._data
+        self.train_dataset.set_resolution(*self.render_stage(self.global_step)[:2])
+
+        # the train images go to the writer the caller set, if any, through the same logger thread as train()
+        if self.image_logger is None and getattr(self, 'writer', None) is not None and self.local_rank == 0:
+            self.image_logger = ImageLogger(self.writer)
         
         loader = iter(train_loader)
 
@@ -871,6 +1321,13 @@ class Trainer(object):
             if self.model.cuda_ray and self.global_step % self.opt.update_extra_interval == 0:
                 with torch.cuda.amp.autocast(enabled=self.fp16):
                     self.model.update_extra_state()
+
+            # coarse-to-fine hash levels
+            if self.opt.backbone == 'grid_finite':
+                self.model.update_level(self.global_step)
+
+            # coarse-to-fine resolution and samples per ray
+            self.update_stage()
             
             self.global_step += 1
 
@@ -880,8 +1337,7 @@ class Trainer(object):
                 pred_rgbs, pred_ws, loss = self.train_step(data)
          
             self.scaler.scale(loss).backward()
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
+            self.optimizer_step()
             
             if self.scheduler_update_every_step:
                 self.lr_scheduler.step()
@@ -965,10 +1421,29 @@ class Trainer(object):
 
         return outputs
 
+    def log_hash_stats(self):
+        stats = self.model.encoder.level_stats()
+        suggestion = suggest_log2_hashmap_size(stats)
+
+        if self.use_tensorboardX:
+            for i, s in enumerate(stats):
+                self.writer.add_scalar(f"hashgrid/occupancy_{i}", s['occupancy'], self.global_step)
+                self.writer.add_scalar(f"hashgrid/collision_rate_{i}", s['collision_rate'], self.global_step)
+                self.writer.add_scalar(f"hashgrid/grad_rows_{i}", s['grad_rows'], self.global_step)
+
+        self.log(f"[INFO] hash grid occupancy: {[round(s['occupancy'], 3) for s in stats]}")
+        self.log(f"[INFO] hash grid collision rate: {[round(s['collision_rate'], 3) for s in stats]}")
+        self.log(f"[INFO] suggested log2_hashmap_size: {suggestion}")
+
+        # the suggestion can be copied to log2_hashmap_size in the config of the next run
+        if self.workspace is not None:
+            with open(os.path.join(self.workspace, 'hashgrid_stats.json'), 'w') as f:
+                json.dump({'step': self.global_step, 'levels': stats, 'suggested_log2_hashmap_size': suggestion}, f, indent=2)
+
     def train_one_epoch(self, loader):
         self.log(f"==> Start Training {self.workspace} Epoch {self.epoch}, lr={self.optimizer.param_groups[0]['lr']:.6f} ...")
 
-        total_loss = 0
+        total_loss = torch.tensor([0], dtype=torch.float32, device=self.device)
         if self.local_rank == 0 and self.report_metric_at_train:
             for metric in self.metrics:
                 metric.clear()
@@ -989,8 +1464,15 @@ class Trainer(object):
             
             # update grid every 16 steps
             if self.model.cuda_ray and self.global_step % self.opt.update_extra_interval == 0:
-                with torch.cuda.amp.autocast(enabled=self.fp16):
+                with torch.cuda.amp.autocast(enabled=self.fp16), self.profiler.phase('grid_update'):
                     self.model.update_extra_state()
+
+            # coarse-to-fine hash levels
+            if self.opt.backbone == 'grid_finite':
+                self.model.update_level(self.global_step)
+
+            # coarse-to-fine resolution and samples per ray
+            self.update_stage()
                     
             self.local_step += 1
             self.global_step += 1
@@ -1000,37 +1482,78 @@ class Trainer(object):
             with torch.cuda.amp.autocast(enabled=self.fp16):
                 pred_rgbs, ww, loss = self.train_step(data)
          
-            self.scaler.scale(loss).backward()
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
+            with self.profiler.phase('backward'):
+                self.scaler.scale(loss).backward()
+            with self.profiler.phase('optimizer'):
+                self.optimizer_step()
+
+            self.profiler.step()
+            self.telemetry.step()
+            if self.telemetry.enabled and self.global_step % self.opt.telemetry_interval == 0:
+                self.telemetry.flush(self.global_step, occupancy=self.model.occupancy.item() if hasattr(self.model, 'occupancy') else None, epoch=self.epoch)
+            if self.profiler.enabled and self.global_step % self.opt.profile_interval == 0 and self.local_rank == 0:
+                self.log(f"[INFO] step timings (ms) over the last {self.opt.profile_interval} steps:\n{self.profiler.report()}")
+                if self.workspace is not None:
+                    self.profiler.dump(os.path.join(self.workspace, 'profile.jsonl'), step=self.global_step)
+
+            # step / wall-clock checkpoint cadence
+            if self.workspace is not None and self.local_rank == 0 and self.checkpoint_due():
+                if self.ckpt_future is not None and not self.ckpt_future.done():
+                    # the previous write is still running: skipped instead of stalling the step, a time cadence retries next step
+                    self.ckpt_skipped += 1
+                else:
+                    self.save_checkpoint(full=True, best=False, rotation='step_checkpoints')
+
+            # hash table usage
+            if self.opt.backbone == 'grid_finite' and self.opt.hash_stats_interval > 0:
+                self.model.encoder.record_grad()
+                if self.global_step % self.opt.hash_stats_interval == 0:
+                    if self.local_rank == 0:
+                        self.log_hash_stats()
+                    # every report covers the steps since the previous one
+                    self.model.encoder.reset_stats()
 
             if self.scheduler_update_every_step:
                 self.lr_scheduler.step()
 
-            loss_val = loss.item()
-            total_loss += loss_val
+            # losses stay on the device, they are only read back every log_interval steps
+            total_loss += loss.detach()
+            self.train_metrics.add('loss', loss)
+            for k, v in ww.items():
+                if k == 'tot':
+                    continue
+                if k == 'sd_component':
+                    continue
+                self.train_metrics.add(f'loss_{k}', v)
+            if self.stopping.enabled and 'front_rgb' in ww:
+                # the reference view terms as they enter the loss
+                self.ref_metrics.add('ref', ww['front_rgb'] * self.opt.ref_rgb_weight + ww.get('front_depth', 0))
 
             if self.local_rank == 0:
-                if self.use_tensorboardX:
-                    self.writer.add_scalar("train/loss", loss_val, self.global_step)
-                    self.writer.add_scalar("train/lr", self.optimizer.param_groups[0]['lr'], self.global_step)
-                    for k, v in ww.items():
-                        if k == 'tot':
-                            continue
-                        if k == 'sd_component':
-                            continue
-                        self.writer.add_scalar(f"train/loss_{k}", v, self.global_step)
-
-                if self.scheduler_update_every_step:
-                    pbar.set_description(f"loss={loss_val:.4f} ({total_loss/self.local_step:.4f}), lr={self.optimizer.param_groups[0]['lr']:.6f}")
-                else:
-                    pbar.set_description(f"loss={loss_val:.4f} ({total_loss/self.local_step:.4f})")
+                if self.global_step % self.opt.log_interval == 0:
+                    means = self.train_metrics.flush()
+                    loss_val = means.pop('loss')
+
+                    if self.use_tensorboardX:
+                        self.writer.add_scalar("train/loss", loss_val, self.global_step)
+                        self.writer.add_scalar("train/lr", self.optimizer.param_groups[0]['lr'], self.global_step)
+                        for k, v in means.items():
+                            self.writer.add_scalar(f"train/{k}", v, self.global_step)
+
+                    if self.scheduler_update_every_step:
+                        pbar.set_description(f"loss={loss_val:.4f}, lr={self.optimizer.param_groups[0]['lr']:.6f}")
+                    else:
+                        pbar.set_description(f"loss={loss_val:.4f}")
                 pbar.update(loader.batch_size)
 
+            # a used up budget ends the epoch here. distributed ranks only stop together, after the epoch
+            if self.world_size == 1 and self.stopping.enabled and self.stopping.over_budget() is not None:
+                break
+
         if self.ema is not None:
             self.ema.update()
 
-        average_loss = total_loss / self.local_step
+        average_loss = total_loss.item() / self.local_step
         self.stats["loss"].append(average_loss)
 
         if self.local_rank == 0:
@@ -1051,34 +1574,42 @@ class Trainer(object):
         self.log(f"==> Finished Epoch {self.epoch}.")
 
 
-    def evaluate_one_epoch(self, loader, name=None):
-        self.log(f"++> Evaluate {self.workspace} at epoch {self.epoch} ...")
+    def evaluate_one_epoch(self, loader, name=None, snapshot=None):
+        # snapshot: (model, epoch, global_step) from snapshot_model(), evaluated instead of the live model, on the validation thread.
+        # then only renders and returns the results for record_evaluation() on the training thread
+        model, epoch, _ = snapshot if snapshot is not None else (self.model, self.epoch, self.global_step)
+
+        if snapshot is None:
+            self.log(f"++> Evaluate {self.workspace} at epoch {epoch} ...")
 
         if name is None:
-            name = f'{self.name}_ep{self.epoch:04d}'
+            name = f'{self.name}_ep{epoch:04d}'
 
         total_loss = 0
-        if self.local_rank == 0:
-            for metric in self.metrics:
-                metric.clear()
 
-        self.model.eval()
+        model.eval()
 
-        if self.ema is not None:
+        # a snapshot already holds the ema weights
+        if self.ema is not None and snapshot is None:
             self.ema.store()
             self.ema.copy_to()
 
         if self.local_rank == 0:
-            pbar = tqdm.tqdm(total=len(loader) * loader.batch_size, bar_format='{desc}: {percentage:3.0f}% {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]')
+            # no progress bar next to the training one
+            pbar = tqdm.tqdm(total=len(loader) * loader.batch_size, bar_format='{desc}: {percentage:3.0f}% {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]', disable=snapshot is not None)
+
+        # renders at the CLIP input size, scored against the prompt by record_evaluation()
+        clip_views = [] if getattr(self, 'text_z_clip', None) is not None else None
 
         with torch.no_grad():
-            self.local_step = 0
+            # a local counter, training may go on meanwhile
+            local_step = 0
 
             for data in loader:    
-                self.local_step += 1
+                local_step += 1
 
                 with torch.cuda.amp.autocast(enabled=self.fp16):
-                    preds, preds_depth, loss = self.eval_step(data)
+                    preds, preds_depth, loss = self.eval_step(data, model)
 
                 # all_gather/reduce the statistics (NCCL only support all_*)
                 if self.world_size > 1:
@@ -1092,6 +1623,11 @@ class Trainer(object):
                     preds_depth_list = [torch.zeros_like(preds_depth).to(self.device) for _ in range(self.world_size)] # [[B, ...], [B, ...], ...]
                     dist.all_gather(preds_depth_list, preds_depth)
                     preds_depth = torch.cat(preds_depth_list, dim=0)
+
+                if clip_views is not None:
+                    views = F.interpolate(preds.permute(0, 3, 1, 2).float(), size=(224, 224), mode='bilinear', align_corners=False, antialias=True)
+                    # to the cpu from the validation stream, the training thread reads them
+                    clip_views.append(views if snapshot is None else views.cpu())
                 
                 loss_val = loss.item()
                 total_loss += loss_val
@@ -1100,8 +1636,8 @@ class Trainer(object):
                 if self.local_rank == 0:
 
                     # save image
-                    save_path = os.path.join(self.workspace, 'validation', f'{name}_{self.local_step:04d}_rgb.png')
-                    save_path_depth = os.path.join(self.workspace, 'validation', f'{name}_{self.local_step:04d}_depth.png')
+                    save_path = os.path.join(self.workspace, 'validation', f'{name}_{local_step:04d}_rgb.png')
+                    save_path_depth = os.path.join(self.workspace, 'validation', f'{name}_{local_step:04d}_depth.png')
 
                     #self.log(f"==> Saving validation image to {save_path}")
                     os.makedirs(os.path.dirname(save_path), exist_ok=True)
@@ -1115,46 +1651,81 @@ class Trainer(object):
                     cv2.imwrite(save_path, cv2.cvtColor(pred, cv2.COLOR_RGB2BGR))
                     cv2.imwrite(save_path_depth, pred_depth)
 
-                    pbar.set_description(f"loss={loss_val:.4f} ({total_loss/self.local_step:.4f})")
+                    pbar.set_description(f"loss={loss_val:.4f} ({total_loss/local_step:.4f})")
                     pbar.update(loader.batch_size)
 
 
-        average_loss = total_loss / self.local_step
+        if self.local_rank == 0:
+            pbar.close()
+
+        if self.ema is not None and snapshot is None:
+            self.ema.restore()
+
+        result = {
+            'epoch': epoch,
+            'loss': total_loss / local_step,
+            'clip_views': torch.cat(clip_views) if clip_views is not None else None,
+        }
+        if snapshot is not None:
+            return result
+        self.record_evaluation(result)
+
+    def record_evaluation(self, result):
+        # stats, logs and the CLIP score of an evaluation, on the training thread
+        epoch = result['epoch']
+        average_loss = result['loss']
         self.stats["valid_loss"].append(average_loss)
 
+        # CLIP similarity of the renders to the prompt (without direction)
+        valid_clip = None
+        if result['clip_views'] is not None:
+            text_z_clip = self.text_z_clip[-1] if isinstance(self.text_z_clip, list) else self.text_z_clip
+            with torch.no_grad():
+                image_z = self.clip.get_img_embeds(result['clip_views'].to(self.device))
+            valid_clip = float((image_z * text_z_clip).sum(-1).mean())
+
         if self.local_rank == 0:
-            pbar.close()
+            if valid_clip is not None:
+                self.log(f"[INFO] validation CLIP similarity to the prompt: {valid_clip:.4f}")
+                if self.use_tensorboardX:
+                    self.writer.add_scalar("evaluate/clip", valid_clip, epoch)
             if not self.use_loss_as_metric and len(self.metrics) > 0:
                 result = self.metrics[0].measure()
                 self.stats["results"].append(result if self.best_mode == 'min' else - result) # if max mode, use -result
+            elif valid_clip is not None:
+                self.stats["results"].append(- valid_clip) # the validation loss is always 0, choose best by the CLIP similarity
             else:
                 self.stats["results"].append(average_loss) # if no metric, choose best by min loss
 
             for metric in self.metrics:
                 self.log(metric.report(), style="blue")
                 if self.use_tensorboardX:
-                    metric.write(self.writer, self.epoch, prefix="evaluate")
+                    metric.write(self.writer, epoch, prefix="evaluate")
                 metric.clear()
 
-        if self.ema is not None:
-            self.ema.restore()
+        # read (and cleared) by the clip monitor of early_stop()
+        self.valid_clip = valid_clip
 
-        self.log(f"++> Evaluate epoch {self.epoch} Finished.")
+        self.log(f"++> Evaluate epoch {epoch} Finished.")
 
-    def save_checkpoint(self, name=None, full=False, best=False):
+    def save_checkpoint(self, name=None, full=False, best=False, snapshot=None, rotation='checkpoints'):
+        # snapshot: (model, epoch, global_step) of an asynchronous evaluation, saved as the best instead of the live model
+        # rotation: stats list of the checkpoints this one is rotated with, each keeps max_keep_ckpt
+        model, epoch, global_step = snapshot if snapshot is not None else (self.model, self.epoch, self.global_step)
 
         if name is None:
-            name = f'{self.name}_ep{self.epoch:04d}'
+            # sorts in the order of training, load_checkpoint takes the last one as the latest
+            name = f'{self.name}_ep{epoch:04d}_step{global_step:06d}'
 
         state = {
-            'epoch': self.epoch,
-            'global_step': self.global_step,
+            'epoch': epoch,
+            'global_step': global_step,
             'stats': self.stats,
         }
 
-        if self.model.cuda_ray:
-            state['mean_count'] = self.model.mean_count
-            state['mean_density'] = self.model.mean_density
+        if model.cuda_ray:
+            state['mean_count'] = model.mean_count
+            state['mean_density'] = model.mean_density
 
         if full:
             state['optimizer'] = self.optimizer.state_dict()
@@ -1169,14 +1740,18 @@ class Trainer(object):
 
             file_path = f"{name}.pth"
 
-            self.stats["checkpoints"].append(file_path)
+            # a rewrite at the same step (the final save of train()) is only listed once, in the last rotation
+            for checkpoints in [self.stats.get("checkpoints", []), self.stats.get("step_checkpoints", [])]:
+                if file_path in checkpoints:
+                    checkpoints.remove(file_path)
+            checkpoints = self.stats.setdefault(rotation, [])
+            checkpoints.append(file_path)
 
-            if len(self.stats["checkpoints"]) > self.max_keep_ckpt:
-                old_ckpt = os.path.join(self.ckpt_path, self.stats["checkpoints"].pop(0))
-                if os.path.exists(old_ckpt):
-                    os.remove(old_ckpt)
+            old_ckpt = None
+            if len(checkpoints) > self.max_keep_ckpt:
+                old_ckpt = os.path.join(self.ckpt_path, checkpoints.pop(0))
 
-            torch.save(state, os.path.join(self.ckpt_path, file_path))
+            self.write_checkpoint(state, os.path.join(self.ckpt_path, file_path), remove=old_ckpt)
 
         else:    
             if len(self.stats["results"]) > 0:
@@ -1185,19 +1760,132 @@ class Trainer(object):
                     self.stats["best_result"] = self.stats["results"][-1]
 
                     # save ema results 
-                    if self.ema is not None:
+                    if self.ema is not None and snapshot is None:
                         self.ema.store()
                         self.ema.copy_to()
 
-                    state['model'] = self.model.state_dict()
+                    state['model'] = model.state_dict()
 
-                    if self.ema is not None:
+                    if self.ema is not None and snapshot is None:
                         self.ema.restore()
                     
-                    torch.save(state, self.best_path)
+                    self.write_checkpoint(state, self.best_path)
             else:
                 self.log(f"[WARN] no evaluated results found, skip saving best checkpoint.")
             
+    def checkpoint_due(self):
+        if self.opt.ckpt_interval_steps > 0 and self.global_step % self.opt.ckpt_interval_steps == 0:
+            return True
+        if self.opt.ckpt_interval_secs > 0 and time.time() - self.last_ckpt_time >= self.opt.ckpt_interval_secs:
+            return True
+        return False
+
+    def write_checkpoint(self, state, checkpoint, remove=None):
+        # copy every tensor to cpu now, so training can go on modifying the originals while the writer serializes
+        def snapshot(x):
+            if torch.is_tensor(x):
+                return x.detach().to('cpu', copy=True)
+            if isinstance(x, dict):
+                return {k: snapshot(v) for k, v in x.items()}
+            if isinstance(x, (list, tuple)):
+                return type(x)(snapshot(v) for v in x)
+            return x
+
+        state = snapshot(state)
+        self.last_ckpt_time = time.time()
+
+        # at most one write in flight, so snapshots don't pile up in memory if the disk is slow.
+        # the step / wall-clock cadence skips its saves while one runs, the epoch, final and best ones wait for it
+        self.wait_checkpoint()
+        self.ckpt_future = self.ckpt_writer.submit(self._write_checkpoint, state, checkpoint, remove)
+
+    def _write_checkpoint(self, state, checkpoint, remove=None):
+        # runs on the writer thread. write to a temp file and rename, so a crash never leaves a truncated checkpoint
+        tmp_path = checkpoint + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, checkpoint)
+        self.save_model_tensors(state, checkpoint)
+
+        if remove is not None:
+            for path in [remove, os.path.splitext(remove)[0] + '.safetensors']:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def wait_checkpoint(self):
+        # block until the pending checkpoint write is done
+        if self.ckpt_future is not None:
+            try:
+                self.ckpt_future.result()
+            except Exception as e:
+                self.log(f"[WARN] failed to write checkpoint: {e}")
+            self.ckpt_future = None
+
+    def save_model_tensors(self, state, checkpoint):
+        # model weights only, next to the .pth. load_checkpoint memory-maps it for model-only / inference loads,
+        # on cpu processes loading the same file share its page cache instead of each unpickling a copy.
+        if save_safetensors is None:
+            return
+
+        tensors = {k: v.detach().cpu().contiguous() for k, v in state['model'].items()}
+        metadata = {'epoch': str(state['epoch']), 'global_step': str(state['global_step'])}
+        if 'mean_count' in state:
+            metadata['mean_count'] = str(state['mean_count'])
+            metadata['mean_density'] = str(state['mean_density'])
+
+        tensors_path = os.path.splitext(checkpoint)[0] + '.safetensors'
+        save_safetensors(tensors, tensors_path + '.tmp', metadata=metadata)
+        os.replace(tensors_path + '.tmp', tensors_path)
+
+    def load_model_tensors(self, path, model_only=False):
+        state_dict, metadata = mmap_safetensors(path)
+
+        # on cpu, the params become the mmapped tensors (torch >= 2.1), pages are only copied if they are written.
+        # on gpu, load_state_dict still copies every tensor to the device, read from the mapping without a host copy
+        if self.device.type == 'cpu' and pver.parse(torch.__version__) >= pver.parse('2.1'):
+            missing_keys, unexpected_keys = self.model.load_state_dict(state_dict, strict=False, assign=True)
+        else:
+            missing_keys, unexpected_keys = self.model.load_state_dict(state_dict, strict=False)
+        self.log(f"[INFO] loaded model from {path}.")
+        if len(missing_keys) > 0:
+            self.log(f"[WARN] missing keys: {missing_keys}")
+        if len(unexpected_keys) > 0:
+            self.log(f"[WARN] unexpected keys: {unexpected_keys}")
+
+        if self.model.cuda_ray and 'mean_count' in metadata:
+            self.model.mean_count = int(metadata['mean_count'])
+            self.model.mean_density = float(metadata['mean_density'])
+
+        if not model_only:
+            self.epoch = int(metadata.get('epoch', self.epoch))
+            self.global_step = int(metadata.get('global_step', self.global_step))
+            self.log(f"[INFO] load at epoch {self.epoch}, global step {self.global_step}")
+
+    def export_compressed(self, name=None):
+        # inference weights: the hash grid quantized per level with the untrained rows pruned, no optimizer state.
+        # load with load_checkpoint(path), e.g. --ckpt <workspace>/export/<name>.pth
+        if name is None:
+            name = f'{self.name}_ep{self.epoch:04d}_{self.opt.compress_dtype}'
+
+        encoder = self.model.encoder
+        state = {
+            'epoch': self.epoch,
+            'global_step': self.global_step,
+            # rows that moved out of the init range, the usage masks only cover the steps since the last hash stats report
+            'encoder_compressed': compress_embeddings(encoder.embeddings, encoder.level_offsets, self.opt.compress_dtype),
+            'model': {k: v for k, v in self.model.state_dict().items() if k != 'encoder.embeddings'},
+        }
+
+        if self.model.cuda_ray:
+            state['mean_count'] = self.model.mean_count
+            state['mean_density'] = self.model.mean_density
+
+        export_path = os.path.join(self.workspace, 'export')
+        os.makedirs(export_path, exist_ok=True)
+        file_path = os.path.join(export_path, f'{name}.pth')
+        torch.save(state, file_path)
+
+        self.log(f"[INFO] exported compressed model to {file_path} ({os.path.getsize(file_path) / 2 ** 20:.2f} MB)")
+
     def load_checkpoint(self, checkpoint=None, model_only=False):
         if checkpoint is None:
             checkpoint_list = sorted(glob.glob(f'{self.ckpt_path}/*.pth'))
@@ -1208,7 +1896,23 @@ class Trainer(object):
                 self.log("[WARN] No checkpoint found, model randomly initialized.")
                 return
 
+        # model only or test: skip unpickling the full checkpoint if the weights have a .safetensors file
+        tensors_path = os.path.splitext(checkpoint)[0] + '.safetensors'
+        if os.path.exists(tensors_path) and (model_only or self.opt.test or checkpoint.endswith('.safetensors')):
+            self.load_model_tensors(tensors_path, model_only=model_only)
+            return
+
         checkpoint_dict = torch.load(checkpoint, map_location=self.device)
+
+        # compressed inference weights from export_compressed
+        if 'encoder_compressed' in checkpoint_dict:
+            self.model.encoder.load_compressed(checkpoint_dict['encoder_compressed'])
+            self.model.load_state_dict(checkpoint_dict['model'], strict=False)
+            if self.model.cuda_ray:
+                self.model.mean_count = checkpoint_dict.get('mean_count', self.model.mean_count)
+                self.model.mean_density = checkpoint_dict.get('mean_density', self.model.mean_density)
+            self.log(f"[INFO] loaded compressed model ({checkpoint_dict['encoder_compressed']['dtype']}), inference only.")
+            return
         
         if 'model' not in checkpoint_dict:
             self.model.load_state_dict(checkpoint_dict)
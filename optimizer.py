@@ -467,4 +467,78 @@ class Shampoo(optim.Optimizer):
           momentum_update.mul_(group['momentum']).add_(wd_update)
 
         # Final update
-        p.data.add_(momentum_update, alpha=-lr)    
\ No newline at end of file
+        p.data.add_(momentum_update, alpha=-lr)    
+
+class LazyAdamW(optim.Optimizer):
+  """AdamW with lazy updates for sparse gradients.
+
+  Dense gradients get the usual AdamW update. For a sparse gradient (the hash
+  grid embeddings with sparse_grad=True) the moments, the weight decay and the
+  parameter are only updated at the rows present in the gradient, as in
+  torch.optim.SparseAdam, so the step costs O(touched rows) instead of
+  O(table size). Rows that are not looked up keep stale moments until they
+  are touched again.
+  """
+
+  def __init__(self,
+               params,
+               lr=1e-3,
+               betas=(0.9, 0.999),
+               eps=1e-8,
+               weight_decay=1e-2):
+    defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+    super(LazyAdamW, self).__init__(params, defaults)
+
+  @torch.no_grad()
+  def step(self, closure=None):
+    loss = None
+    if closure is not None:
+      with torch.enable_grad():
+        loss = closure()
+
+    for group in self.param_groups:
+      lr = group['lr']
+      beta1, beta2 = group['betas']
+      eps = group['eps']
+      weight_decay = group['weight_decay']
+
+      for p in group['params']:
+        if p.grad is None:
+          continue
+        grad = p.grad
+        state = self.state[p]
+
+        if len(state) == 0:
+          state['step'] = 0
+          state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+          state['exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+
+        state['step'] += 1
+        exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+        bias_correction1 = 1 - beta1 ** state['step']
+        bias_correction2_sqrt = (1 - beta2 ** state['step']) ** 0.5
+        step_size = lr / bias_correction1
+
+        if grad.is_sparse:
+          # sum duplicated rows, then work on the touched rows only
+          grad = grad.coalesce()
+          rows = grad.indices()[0]
+          values = grad.values()
+
+          exp_avg_rows = exp_avg[rows].mul_(beta1).add_(values, alpha=1 - beta1)
+          exp_avg_sq_rows = exp_avg_sq[rows].mul_(beta2).addcmul_(values, values, value=1 - beta2)
+          exp_avg.index_copy_(0, rows, exp_avg_rows)
+          exp_avg_sq.index_copy_(0, rows, exp_avg_sq_rows)
+
+          denom = (exp_avg_sq_rows.sqrt() / bias_correction2_sqrt).add_(eps)
+          p_rows = p[rows].mul_(1 - lr * weight_decay)
+          p_rows.addcdiv_(exp_avg_rows, denom, value=-step_size)
+          p.index_copy_(0, rows, p_rows)
+        else:
+          p.mul_(1 - lr * weight_decay)
+          exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+          exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+          denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt).add_(eps)
+          p.addcdiv_(exp_avg, denom, value=-step_size)
+
+    return loss
@@ -1,5 +1,6 @@
 import os
-from torch.utils.cpp_extension import load
+
+from extensions import LazyExtension
 
 _src_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -28,13 +29,14 @@ elif os.name == "nt":
             raise RuntimeError("Could not locate a supported Microsoft Visual C++ installation")
         os.environ["PATH"] += ";" + cl_path
 
-_backend = load(name='_raymarching',
-                extra_cflags=c_flags,
-                extra_cuda_cflags=nvcc_flags,
-                sources=[os.path.join(_src_path, 'src', f) for f in [
-                    'raymarching.cu',
-                    'bindings.cpp',
-                ]],
-                )
+# only built / loaded on first use
+_backend = LazyExtension(name='_raymarching',
+                         extra_cflags=c_flags,
+                         extra_cuda_cflags=nvcc_flags,
+                         sources=[os.path.join(_src_path, 'src', f) for f in [
+                             'raymarching.cu',
+                             'bindings.cpp',
+                         ]],
+                         )
 
 __all__ = ['_backend']
\ No newline at end of file
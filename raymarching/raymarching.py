@@ -6,6 +6,8 @@ import torch.nn as nn
 from torch.autograd import Function
 from torch.cuda.amp import custom_bwd, custom_fwd
 
+from extensions import use_native
+
 try:
     import _raymarching as _backend
 except ImportError:
@@ -46,7 +48,37 @@ class _near_far_from_aabb(Function):
 
         return nears, fars
 
-near_far_from_aabb = _near_far_from_aabb.apply
+
+
+def near_far_from_aabb_torch(rays_o, rays_d, aabb, min_near=0.2):
+    ''' near_far_from_aabb, pytorch implementation, same outputs as the CUDA kernel
+    Rays that miss the aabb get near = far = float max.
+    '''
+    rays_o = rays_o.contiguous().view(-1, 3)
+    rays_d = rays_d.contiguous().view(-1, 3)
+    aabb = aabb.to(rays_o)
+
+    rd = 1 / rays_d
+    t0 = (aabb[:3] - rays_o) * rd # [N, 3]
+    t1 = (aabb[3:] - rays_o) * rd
+
+    nears = torch.minimum(t0, t1).amax(dim=-1)
+    fars = torch.maximum(t0, t1).amin(dim=-1)
+
+    miss = nears > fars
+    nears = nears.clamp(min=min_near)
+
+    max_val = torch.finfo(rays_o.dtype).max
+    nears = nears.masked_fill(miss, max_val)
+    fars = fars.masked_fill(miss, max_val)
+
+    return nears, fars
+
+
+def near_far_from_aabb(rays_o, rays_d, aabb, min_near=0.2):
+    if use_native('near_far_from_aabb', _backend, rays_o.is_cuda):
+        return _near_far_from_aabb.apply(rays_o, rays_d, aabb, min_near)
+    return near_far_from_aabb_torch(rays_o, rays_d, aabb, min_near)
 
 
 class _sph_from_ray(Function):
@@ -77,7 +109,33 @@ class _sph_from_ray(Function):
 
         return coords
 
-sph_from_ray = _sph_from_ray.apply
+
+
+def sph_from_ray_torch(rays_o, rays_d, radius):
+    ''' sph_from_ray, pytorch implementation, same outputs as the CUDA kernel '''
+    rays_o = rays_o.contiguous().view(-1, 3)
+    rays_d = rays_d.contiguous().view(-1, 3)
+
+    # solve t from || o + td || = radius
+    A = (rays_d * rays_d).sum(-1)
+    B = (rays_o * rays_d).sum(-1) # in fact B / 2
+    C = (rays_o * rays_o).sum(-1) - radius * radius
+
+    t = (- B + torch.sqrt(B * B - A * C)) / A # always use the larger solution (positive)
+
+    # solve theta, phi (assume y is the up axis)
+    x, y, z = (rays_o + t.unsqueeze(-1) * rays_d).unbind(-1)
+    theta = torch.atan2(torch.sqrt(x * x + z * z), y) # [0, PI)
+    phi = torch.atan2(z, x) # [-PI, PI)
+
+    # normalize to [-1, 1]
+    return torch.stack([2 * theta / np.pi - 1, phi / np.pi], dim=-1)
+
+
+def sph_from_ray(rays_o, rays_d, radius):
+    if use_native('sph_from_ray', _backend, rays_o.is_cuda):
+        return _sph_from_ray.apply(rays_o, rays_d, radius)
+    return sph_from_ray_torch(rays_o, rays_d, radius)
 
 
 class _morton3D(Function):
@@ -6,6 +6,9 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd 
 
+from extensions import use_native
+from encoding import sh_encode_torch
+
 try:
     import _shencoder as _backend
 except ImportError:
@@ -81,7 +84,10 @@ class SHEncoder(nn.Module):
         prefix_shape = list(inputs.shape[:-1])
         inputs = inputs.reshape(-1, self.input_dim)
 
-        outputs = sh_encode(inputs, self.degree, inputs.requires_grad)
+        if use_native('sh_encode', _backend, inputs.is_cuda):
+            outputs = sh_encode(inputs, self.degree, inputs.requires_grad)
+        else:
+            outputs = sh_encode_torch(inputs, self.degree)
         outputs = outputs.reshape(prefix_shape + [self.output_dim])
 
         return outputs
\ No newline at end of file
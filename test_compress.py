@@ -0,0 +1,57 @@
+import torch
+
+from gridencoder import GridEncoder, compress_embeddings
+
+# round trip of the compressed inference export (gridencoder/grid.py): compress_embeddings, then
+# GridEncoder.load_compressed, against the fp32 encoder. runs on the cpu:
+#   python test_compress.py
+
+
+def make_encoder():
+    torch.manual_seed(0)
+    encoder = GridEncoder(input_dim=3, num_levels=4, level_dim=2, base_resolution=4, log2_hashmap_size=10)
+    with torch.no_grad():
+        encoder.embeddings.normal_()
+    return encoder.eval()
+
+
+def roundtrip(dtype, keep=None):
+    # outputs of the loaded export, and of the fp32 encoder with the pruned rows zeroed
+    encoder = make_encoder()
+    state = compress_embeddings(encoder.embeddings, encoder.level_offsets, dtype, keep=keep)
+    if keep is not None:
+        with torch.no_grad():
+            encoder.embeddings[~keep] = 0
+
+    compressed = make_encoder()
+    compressed.load_compressed(state)
+    assert compressed.compressed and compressed.embeddings.numel() == 0
+
+    inputs = torch.rand(256, 3) * 2 - 1
+    with torch.no_grad():
+        return compressed(inputs), encoder(inputs)
+
+
+def test_fp16():
+    out, ref = roundtrip('fp16')
+    assert torch.allclose(out, ref, atol=1e-2)
+
+
+def test_int8():
+    out, ref = roundtrip('int8')
+    # the interpolation weights sum to 1, the error is at most half a step of the largest level scale (|N(0, 1)| < 6)
+    assert (out - ref).abs().max() < 0.5 * 6 / 127
+
+
+def test_pruned():
+    # pruned rows read as 0
+    keep = torch.rand(make_encoder().embeddings.shape[0]) < 0.5
+    out, ref = roundtrip('fp16', keep)
+    assert torch.allclose(out, ref, atol=1e-2)
+
+
+if __name__ == '__main__':
+    test_fp16()
+    test_int8()
+    test_pruned()
+    print('compressed grid: ok')
@@ -0,0 +1,100 @@
+import numpy as np
+import torch
+
+from gridencoder.grid import grid_encode_torch, _primes
+
+# numerical check of the pytorch grid encoder (gridencoder/grid.py) on a tiny grid, runs on the cpu:
+# the outputs against a per point loop over the formulas of src/gridencoder.cu, and the gradients with gradcheck.
+#   python test_grid.py
+
+D = 3
+level_offsets = (0, 32, 64) # level 0 fits its 32 rows and is tiled, level 1 is hashed
+per_level_scale = 2.0
+base_resolution = 2
+
+
+def reference(inputs, embeddings, gridtype=0, align_corners=False, interpolation='linear'):
+    B = inputs.shape[0]
+    L = len(level_offsets) - 1
+    C = embeddings.shape[1]
+    S = np.log2(per_level_scale)
+    outputs = torch.zeros(B, L, C, dtype=embeddings.dtype)
+
+    for level in range(L):
+        hashmap_size = level_offsets[level + 1] - level_offsets[level]
+        scale = np.exp2(np.float32(level) * np.float32(S)) * np.float32(base_resolution) - np.float32(1.0)
+        resolution = int(np.ceil(scale)) + 1
+
+        for b in range(B):
+            x = inputs[b]
+            if (x < 0).any() or (x > 1).any():
+                continue
+            pos = x * float(scale) + (0.0 if align_corners else 0.5)
+            pos_grid = pos.floor()
+            frac = pos - pos_grid
+            if interpolation == 'smoothstep':
+                frac = frac * frac * (3 - 2 * frac)
+
+            for corner in range(2 ** D):
+                w = 1.0
+                index = 0
+                stride = 1
+                hashed = 0
+                for d in range(D):
+                    bit = (corner >> d) & 1
+                    coord = int(pos_grid[d]) + bit
+                    w = w * (frac[d] if bit else 1 - frac[d])
+                    if stride <= hashmap_size:
+                        index += coord * stride
+                        stride *= resolution if align_corners else resolution + 1
+                    hashed ^= (coord * _primes[d]) & 0xFFFFFFFF
+                if gridtype == 0 and stride > hashmap_size:
+                    index = hashed
+                index = index % hashmap_size + level_offsets[level]
+                outputs[b, level] += w * embeddings[index]
+
+    return outputs.reshape(B, L * C)
+
+
+def test_forward():
+    torch.manual_seed(0)
+    inputs = torch.rand(64, D, dtype=torch.float64)
+    inputs[:4] = torch.tensor([-0.1, 1.1, 0.0, 1.0], dtype=torch.float64)[:, None] # out of bound and edge inputs
+    embeddings = torch.randn(level_offsets[-1], 2, dtype=torch.float64)
+
+    for gridtype in [0, 1]:
+        for align_corners in [False, True]:
+            for interpolation in ['linear', 'smoothstep']:
+                out = grid_encode_torch(inputs, embeddings, level_offsets, per_level_scale, base_resolution, False, gridtype, align_corners, interpolation, False)
+                ref = reference(inputs, embeddings, gridtype, align_corners, interpolation)
+                assert torch.allclose(out, ref, atol=1e-10), (gridtype, align_corners, interpolation, (out - ref).abs().max())
+
+
+def test_gradcheck():
+    torch.manual_seed(0)
+    # away from the cell borders, where the input gradient jumps
+    inputs = (torch.rand(8, D, dtype=torch.float64) * 0.8 + 0.1).requires_grad_()
+    embeddings = torch.randn(level_offsets[-1], 2, dtype=torch.float64, requires_grad=True)
+
+    for interpolation in ['linear', 'smoothstep']:
+        f = lambda x, e: grid_encode_torch(x, e, level_offsets, per_level_scale, base_resolution, True, 0, False, interpolation, False)
+        assert torch.autograd.gradcheck(f, (inputs, embeddings))
+
+
+def test_sparse_grad():
+    # the row-sparse gradient of the embeddings sums to the dense one
+    torch.manual_seed(0)
+    inputs = torch.rand(64, D)
+    grads = []
+    for sparse_grad in [False, True]:
+        embeddings = torch.randn(level_offsets[-1], 2, generator=torch.Generator().manual_seed(1), requires_grad=True)
+        grid_encode_torch(inputs, embeddings, level_offsets, per_level_scale, base_resolution, False, 0, False, 'linear', sparse_grad).square().sum().backward()
+        grads.append(embeddings.grad.to_dense())
+    assert torch.allclose(grads[0], grads[1], atol=1e-6)
+
+
+if __name__ == '__main__':
+    test_forward()
+    test_gradcheck()
+    test_sparse_grad()
+    print('grid_encode_torch: ok')
@@ -0,0 +1,34 @@
+import torch
+
+from optimizer import LazyAdamW
+
+# LazyAdamW (optimizer.py) takes the same steps as torch.optim.AdamW on dense gradients,
+# and on sparse gradients that touch every row.
+#   python test_lazy_adamw.py
+
+hps = dict(lr=1e-2, betas=(0.9, 0.99), eps=1e-15, weight_decay=1e-2)
+
+
+def run(optimizer_class, sparse=False, steps=10):
+    torch.manual_seed(0)
+    param = torch.nn.Parameter(torch.randn(16, 4))
+    optimizer = optimizer_class([param], **hps)
+    for _ in range(steps):
+        grad = torch.randn(16, 4)
+        param.grad = grad.to_sparse(1) if sparse else grad # row-sparse, as emitted by the grid encoder
+        optimizer.step()
+    return param.detach()
+
+
+def test_dense():
+    assert torch.allclose(run(LazyAdamW), run(torch.optim.AdamW), rtol=1e-5, atol=1e-7)
+
+
+def test_sparse_all_rows():
+    assert torch.allclose(run(LazyAdamW, sparse=True), run(torch.optim.AdamW), rtol=1e-5, atol=1e-7)
+
+
+if __name__ == '__main__':
+    test_dense()
+    test_sparse_all_rows()
+    print('LazyAdamW: ok')